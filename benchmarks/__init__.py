@@ -0,0 +1,19 @@
+"""Benchmarks for pymake on synthetic dependency graphs.
+
+Run them from the top of the repository with the pymake under test on the
+path, e.g.
+
+PYTHONPATH=lib python -m benchmarks -n 1000,100000 -o new.json
+
+and compare two sets of results, e.g. from before and after a change, with
+
+python -m benchmarks --compare old.json new.json
+
+The graphs are made by the generators in benchmarks.dags.  Each case is
+run in a fresh process, so its peak memory is its own.  See
+benchmarks.suite for the phases which are timed.
+
+The checks that different ways of building give the same result are in
+tests/pymake_checks.py, and are run by pymake.test().
+
+"""
@@ -0,0 +1,74 @@
+"""Run the benchmarks, or compare saved results; see benchmarks."""
+
+import optparse
+
+from benchmarks import dags, suite
+
+
+def main():
+    usage = ("usage: %prog [options]\n"
+             "       %prog --compare OLD.json NEW.json")
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-s", "--shapes", dest="shapes",
+                      default=",".join(dags.SHAPES),
+                      help=("comma separated graph shapes. "
+                            "DEFAULT: %default"))
+    parser.add_option("-n", "--sizes", dest="sizes", default="1000,10000",
+                      help=("comma separated numbers of targets. "
+                            "DEFAULT: %default"))
+    parser.add_option("-x", "--execute", dest="execute",
+                      action="store_true", default=False,
+                      help=("execute the recipes. "
+                            "DEFAULT: dry runs"))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      default=None, metavar="N",
+                      help=("execute at most N recipes at once. "
+                            "DEFAULT: the number of CPUs"))
+    parser.add_option("--sample", dest="sample", type="int", default=1000,
+                      metavar="N",
+                      help=("match rules for N targets. "
+                            "DEFAULT: %default"))
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      metavar="FILE",
+                      help=("save the results to FILE as JSON. "
+                            "DEFAULT: don't save"))
+    parser.add_option("--compare", dest="compare", action="store_true",
+                      default=False,
+                      help=("compare the results in two files"))
+    opts, args = parser.parse_args()
+
+    if opts.compare:
+        if len(args) != 2:
+            parser.error("--compare takes two result files")
+        print("{:<12} {:>9} {:<15} {:>10} {:>10} {:>7}".\
+              format("shape", "size", "phase", "old (s)", "new (s)", "ratio"))
+        for row in suite.compare(suite.load(args[0]), suite.load(args[1])):
+            print("{:<12} {:>9} {:<15} {:>10.4f} {:>10.4f} {:>7.2f}".\
+                  format(*row))
+        return
+
+    shapes = opts.shapes.split(",")
+    for shape in shapes:
+        if shape not in dags.SHAPES:
+            parser.error("unknown shape: {}".format(shape))
+    sizes = [int(size) for size in opts.sizes.split(",")]
+    cases = []
+    print("{:<12} {:>9} {:<15} {:>10} {:>12} {:>9}".\
+          format("shape", "size", "phase", "seconds", "per second",
+                 "peak MB"))
+    for case in suite.run_cases(shapes, sizes, execute=opts.execute,
+                                jobs=opts.jobs, sample=opts.sample):
+        cases.append(case)
+        for phase, timing in case['phases'].items():
+            if 'seconds' in timing:
+                print("{:<12} {:>9} {:<15} {:>10.4f} {:>12.0f} {:>9.1f}".\
+                      format(case['shape'], case['size'], phase,
+                             timing['seconds'],
+                             timing.get('per_second', float('nan')),
+                             timing['peak_rss_mb']))
+    if opts.output is not None:
+        suite.save(opts.output, cases)
+
+
+if __name__ == '__main__':
+    main()
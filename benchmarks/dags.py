@@ -0,0 +1,99 @@
+"""Generators of parameterized rule sets and the files they start from.
+
+Each generator takes the approximate number of targets *size* and returns
+a Graph: the rules, the target to make, and the source files which must
+exist beforehand.  Recipes only touch their target.
+
+"""
+
+import os
+import collections
+
+from pymake import Rule
+
+
+Graph = collections.namedtuple("Graph", ["rules", "root", "sources"])
+
+RECIPE = "touch {trgt}"
+
+
+def fan_out(size):
+    """One target with *size* prerequisites, each made from its own source.
+
+    All of the tasks share one pattern rule.
+
+    """
+    rules = [Rule("all", ["t{}".format(i) for i in range(size)]),
+             Rule(r"t([0-9]+)", ["s{0}"], RECIPE)]
+    return Graph(rules, "all", ["s{}".format(i) for i in range(size)])
+
+
+def chain(size):
+    """A chain of *size* targets, each made from the one before it.
+
+    A rule can only be used once along a path, so every link has a literal
+    rule of its own.
+
+    """
+    rules = [Rule("c{}".format(i), ["c{}".format(i - 1)], RECIPE)
+             for i in range(size - 1, 0, -1)]
+    rules.append(Rule("c0", ["src"], RECIPE))
+    return Graph(rules, "c{}".format(size - 1), ["src"])
+
+
+def diamonds(size):
+    """A chain of about *size* / 3 diamonds.
+
+    Each diamond splits into two targets made from the previous diamond
+    and joins them again, so every requirement is reached by two paths.
+
+    """
+    count = max(1, size // 3)
+    rules = []
+    for i in range(count - 1, 0, -1):
+        rules.extend([Rule("d{}".format(i), ["l{}".format(i),
+                                             "r{}".format(i)], RECIPE),
+                      Rule("l{}".format(i), ["d{}".format(i - 1)], RECIPE),
+                      Rule("r{}".format(i), ["d{}".format(i - 1)], RECIPE)])
+    rules.append(Rule("d0", ["src"], RECIPE))
+    return Graph(rules, "d{}".format(count - 1), ["src"])
+
+
+def regex_rules(size, patterns=100):
+    """*size* targets spread over *patterns* regex rules.
+
+    Half of the rules have a literal prefix which the RuleIndex can use;
+    the other half only differ in their suffix, so they have to be tried
+    in turn.
+
+    """
+    rules = []
+    trgts = []
+    sources = []
+    for j in range(patterns):
+        if j % 2:
+            rules.append(Rule(r"p{}_([0-9]+)".format(j),
+                              ["s{}_{{0}}".format(j)], RECIPE))
+            trgt = "p{}_{{}}".format(j)
+        else:
+            rules.append(Rule(r"([0-9]+)\.q{}".format(j),
+                              ["s{}_{{0}}".format(j)], RECIPE))
+            trgt = "{{}}.q{}".format(j)
+        count = size // patterns + (j < size % patterns)
+        trgts.extend(trgt.format(i) for i in range(count))
+        sources.extend("s{}_{}".format(j, i) for i in range(count))
+    rules.insert(0, Rule("all", trgts))
+    return Graph(rules, "all", sources)
+
+
+SHAPES = collections.OrderedDict([("fan_out", fan_out),
+                                  ("chain", chain),
+                                  ("diamonds", diamonds),
+                                  ("regex_rules", regex_rules)])
+
+
+def make_tree(graph, directory="."):
+    """Create the source files of *graph* in *directory*."""
+    for path in graph.sources:
+        with open(os.path.join(directory, path), 'w'):
+            pass
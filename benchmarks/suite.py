@@ -0,0 +1,184 @@
+"""Time the phases of a build on the graphs in benchmarks.dags.
+
+The phases of a case are:
+
+"make_req" - constructing the requirement graph
+"extract_rule" - finding the rule for each of a sample of targets with
+                 extract_rule(), which scans the rules in order
+"rule_index" - the same with a RuleIndex
+"prefetch" - filling the stat cache
+"check_uptodate" - deciding what needs to run
+"run" - running the graph; a dry run unless recipes are executed
+"recheck" - with recipes executed, building and checking the graph again
+            in a new session, when everything is up-to-date
+
+"""
+
+import os
+import sys
+import time
+import json
+import logging
+import platform
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+
+import pymake
+
+from benchmarks import dags
+
+
+def peak_rss():
+    """Return the peak resident memory of this process in megabytes."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class Timer():
+    """Collect the duration, throughput and memory of each phase."""
+
+    def __init__(self):
+        self.phases = {}
+
+    def time(self, name, func, *args, count=None, **kwargs):
+        """Time *func*(*args, **kwargs) as phase *name* and return its value.
+
+        *count* - [optional] the number of items handled, for the throughput
+
+        """
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        self.phases[name] = dict(seconds=seconds, peak_rss_mb=peak_rss())
+        if count is not None:
+            self.phases[name].update(count=count,
+                                     per_second=count / max(seconds, 1e-9))
+        return value
+
+
+def match_all(trgts, rules):
+    """Find the rule for each of *trgts* with extract_rule()."""
+    for trgt in trgts:
+        pymake.extract_rule(trgt, rules)
+
+
+def index_all(trgts, rules):
+    """Find the rule for each of *trgts* with a RuleIndex."""
+    index = pymake.RuleIndex(rules)
+    for trgt in trgts:
+        index.match(trgt)
+
+
+def run_case(shape, size, execute=False, jobs=None, sample=1000):
+    """Return the timings of each phase for the graph *shape* of *size*.
+
+    *execute* - run the recipes, rather than doing a dry run
+    *jobs* - the number of recipes run at once
+    *sample* - the number of targets to match rules for
+
+    Works in a temporary directory, which is removed afterwards.
+
+    """
+    logging.getLogger(pymake.__name__).setLevel(logging.WARNING)
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pymake-bench-") as directory:
+        os.chdir(directory)
+        try:
+            graph = dags.SHAPES[shape](size)
+            dags.make_tree(graph)
+            timer = Timer()
+            timer.phases['setup'] = dict(peak_rss_mb=peak_rss())
+            root = timer.time("make_req", pymake.make_req,
+                              graph.root, graph.rules)
+            nodes = sum(1 for _ in pymake.iter_reqs(root))
+            timer.phases['make_req'].update(
+                    count=nodes,
+                    per_second=nodes / timer.phases['make_req']['seconds'])
+            trgts = [req.trgt for req in pymake.iter_reqs(root)
+                     if isinstance(req, pymake.HierReq)][:sample]
+            timer.time("extract_rule", match_all, trgts, graph.rules,
+                       count=len(trgts))
+            timer.time("rule_index", index_all, trgts, graph.rules,
+                       count=len(trgts))
+            timer.time("prefetch", root.session.prefetch, root, count=nodes)
+            timer.time("check_uptodate", root.check_uptodate, count=nodes)
+            timer.time("run", root.run, execute=execute, jobs=jobs,
+                       output="none", count=nodes)
+            root.session.close()
+            if execute:
+                session = pymake.BuildSession()
+                root = pymake.make_req(graph.root, graph.rules, session)
+                timer.time("recheck", root.check_uptodate, count=nodes)
+                session.close()
+        finally:
+            os.chdir(start_dir)
+    return dict(shape=shape, size=size, nodes=nodes, rules=len(graph.rules),
+                execute=execute, jobs=jobs, phases=timer.phases,
+                peak_rss_mb=peak_rss())
+
+
+def run_cases(shapes, sizes, **kwargs):
+    """Run every case in *shapes* x *sizes*, each in a new process.
+
+    *kwargs* are passed to run_case().  Yields the result of each case.
+
+    """
+    context = multiprocessing.get_context("spawn")
+    for shape in shapes:
+        for size in sizes:
+            with context.Pool(1) as pool:
+                yield pool.apply(run_case, (shape, size), kwargs)
+
+
+def git_commit():
+    """Return the commit checked out where pymake was imported from."""
+    try:
+        return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(pymake.__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Return a description of the code and machine being benchmarked."""
+    return dict(pymake=os.path.abspath(pymake.__file__),
+                commit=git_commit(),
+                python=sys.version,
+                platform=platform.platform(),
+                cpus=os.cpu_count(),
+                date=time.strftime("%Y-%m-%dT%H:%M:%S%z"))
+
+
+def save(path, cases):
+    """Write *cases* and a description of the environment to *path*."""
+    with open(path, 'w') as handle:
+        json.dump(dict(environment=environment(), cases=cases), handle,
+                  indent=2)
+
+
+def load(path):
+    """Return the cases saved in *path*."""
+    with open(path) as handle:
+        return json.load(handle)['cases']
+
+
+def compare(old, new):
+    """Yield the time in *new* relative to *old* for each common phase.
+
+    Yields (shape, size, phase, old seconds, new seconds, ratio) tuples.
+
+    """
+    old_cases = {(case['shape'], case['size']): case for case in old}
+    for case in new:
+        old_case = old_cases.get((case['shape'], case['size']))
+        if old_case is None:
+            continue
+        for phase, timing in case['phases'].items():
+            old_timing = old_case['phases'].get(phase, {})
+            if 'seconds' in timing and 'seconds' in old_timing:
+                yield (case['shape'], case['size'], phase,
+                       old_timing['seconds'], timing['seconds'],
+                       timing['seconds'] / max(old_timing['seconds'], 1e-9))
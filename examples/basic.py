@@ -40,7 +40,7 @@ rules = [Rule("all", preqs=["test_end.{EXT}"], EXT=EXT),
                       "sleep 1")),
          # If an error occurs in a task, the pipeline will fail any
          # downstream tasks, but everything else will run as expected.
-         Rule("all-fail", preqs=["test_end.{EXT}", "fail"]),
+         Rule("all-fail", preqs=["test_end.{EXT}", "fail"], EXT=EXT),
          Rule(trgt="fail", recipe="[ 8 == 7 ]"),
          # If no argument is given, the first rule in the iterable will be,
          # run.
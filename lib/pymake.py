@@ -5,16 +5,137 @@
 
 import re
 import os
+import sys
+import stat
 import contextlib
 import threading
+import queue
+import heapq
+import concurrent.futures
 import math
+import hashlib
+import sqlite3
+import pickle
+import array
 import subprocess
 import logging
 import optparse
+import socket
+import json
+import itertools
+import functools
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+import collections
+import urllib.parse
+import asyncio
+import shutil
+import fcntl
+import tempfile
+import shlex
+import string
+import http.client
+import http.server
 
 
 LOG = logging.getLogger(__name__)
 
+STATE_DIR = ".pymake"
+LOG_DIR = os.path.join(STATE_DIR, "logs")
+CACHE_DIR = os.path.join(STATE_DIR, "cache")
+OUTPUT_MODES = ("stream", "buffer", "log", "none")
+ENGINES = ("threads", "asyncio")
+
+
+class SpaceList(list):
+    """A list whose str() is its items delimited by spaces."""
+
+    __slots__ = ()
+
+    def __str__(self):
+        return " ".join(self.__iter__())
+
+
+def compile_template(template, names=(), env={}, groups=0, unknown=None):
+    """Return *template* with every field that only depends on *env*
+    filled in, ready for str.format().
+
+    The fields left are those named in *names* and the positional fields,
+    of which there are *groups*.  Raises ValueError for any other field,
+    unless *unknown* is a list, in which case the field is left as it is
+    and its name appended to *unknown*.  A positional field beyond
+    *groups* always raises ValueError.
+
+    >>> compile_template("{0}.{ext} {{x}}", env=dict(ext="txt"), groups=1)
+    '{0}.txt {{x}}'
+    >>> compile_template("cat {preqs} > {trgt}", names=("preqs", "trgt"))
+    'cat {preqs} > {trgt}'
+    >>> compile_template("{} {}", groups=2)
+    '{0} {1}'
+    >>> compile_template("{outdir}/{trgt}")
+    Traceback (most recent call last):
+        ...
+    ValueError: unknown field 'outdir' in template '{outdir}/{trgt}'
+    >>> unknown = []
+    >>> compile_template("{outdir}/{trgt}", ("trgt",), unknown=unknown)
+    '{outdir}/{trgt}'
+    >>> unknown
+    ['outdir']
+
+    """
+    formatter = string.Formatter()
+    auto = itertools.count()
+    numbering = set()
+    def compile_spec(spec):
+        return compile_template(spec, names, env, groups, unknown) \
+               if "{" in spec else spec
+    def escape(text):
+        return text.replace("{", "{{").replace("}", "}}")
+    parts = []
+    for literal, field, spec, conversion in formatter.parse(template):
+        parts.append(escape(literal))
+        if field is None:
+            continue
+        root = re.match(r"[^.\[]*", field).group()
+        if root == "":
+            numbering.add("auto")
+            root = str(next(auto))
+            field = root + field
+        elif root.isdigit():
+            numbering.add("manual")
+        if len(numbering) > 1:
+            raise ValueError("cannot switch between automatic and manual "
+                             "field numbering in template {!r}".\
+                             format(template))
+        if root.isdigit() and int(root) >= groups:
+            raise ValueError(("field {!r} in template {!r} is beyond the "
+                              "{} groups of the target pattern").\
+                             format(field, template, groups))
+        if root.isdigit() or root in names or \
+                (unknown is not None and root not in env):
+            if not (root.isdigit() or root in names):
+                unknown.append(root)
+            parts.append("{" + field +
+                         ("!" + conversion if conversion else "") +
+                         (":" + compile_spec(spec) if spec else "") + "}")
+        elif root in env:
+            spec = compile_spec(spec)
+            if "{" in spec:
+                raise ValueError(("the format of {!r} in template {!r} "
+                                  "depends on the target").\
+                                 format(field, template))
+            value = formatter.get_field(field, (), env)[0]
+            value = formatter.convert_field(value, conversion)
+            parts.append(escape(format(value, spec.replace("{{", "{").
+                                                   replace("}}", "}"))))
+        else:
+            raise ValueError("unknown field {!r} in template {!r}".\
+                             format(root, template))
+    return "".join(parts)
+
 
 class Rule():
     """Prescription for going from prerequisites to target.
@@ -31,7 +152,9 @@ class Rule():
 
     """
 
-    def __init__(self, trgt, preqs=[], recipe="", order_only=False, **env):
+    def __init__(self, trgt, preqs=[], recipe="", order_only=False,
+                 outputs=[], batch=1, batch_recipe="", batch_wait=0.5,
+                 threads=1, mem=0, **env):
         """Create a new Rule object.
 
         *trgt* - a regex pattern which matches applicable targets
@@ -40,25 +163,101 @@ class Rule():
         *recipe* - [optional] a str.format() style recipe (shell commands)
         *order_only* - should the target be updated when prerequisites are
                        newer.
+        *outputs* - [optional] a list of str.format() style templates of
+                    all of the files one run of the recipe makes, filled
+                    with the groups matched in the target.  *trgt* must
+                    match each of them.
+        *batch* - [optional] run up to this many ready tasks made from
+                  the rule in one shell; see TaskBatch
+        *batch_recipe* - [optional] a str.format() style recipe for a
+                         whole batch, given the lists {trgts}, {preqs}
+                         and {outputs} of the tasks in it
+        *batch_wait* - [optional] how many seconds to wait for more
+                       tasks to fill a batch
+        *threads* - [optional] the number of CPUs the recipe uses
+        *mem* - [optional] the memory the recipe uses; see parse_size()
         *env* - additional variables available to templates
 
+        *threads* and *mem* are also available to templates, and like
+        other variables they can be overridden by update_env().  The
+        filled *outputs* are available as {outputs}, and with *outputs*,
+        {trgt} is always the first of them, whichever was asked for.
+
+        The templates are compiled with the env when the rule is made and
+        whenever the env is updated; see compile_template().  Only the
+        fields which depend on the target are left to fill for each match.
+        A field which is not in the env may still be given to make(),
+        which raises a ValueError for any that are missing before making
+        the graph; a rule used without make() raises it when first used.
+
         """
         self.trgt_pattern = trgt
+        self.trgt_regex = re.compile("^" + trgt + "$")
         self.preqs_template = preqs
         self.recipe_template = recipe
         self.order_only = order_only
+        self.outputs_template = outputs
+        self.batch = batch
+        self.batch_recipe = batch_recipe
+        self.batch_wait = batch_wait
         self.env = env
+        self.env.update(threads=threads, mem=mem)
+        self.compile()
 
     def __repr__(self):
         return ("{self.__class__.__name__}(trgt={self.trgt_pattern!r}, "
                 "preqs={self.preqs_template!r}, "
                 "recipe={self.recipe_template!r}, "
                 "order_only={self.order_only}, "
+                "outputs={self.outputs_template!r}, "
                 "**{self.env})").format(self=self)
 
     def update_env(self, env):
         """Add or update the *self.env* dictionary with *env*."""
         self.env.update(env)
+        self.compile()
+
+    def compile(self):
+        """Compile the templates with the current *self.env*.
+
+        Fields which are not in the env are left in the templates and
+        noted in *self.unknown*, a list of (field, template) pairs.
+
+        """
+        groups = self.trgt_regex.groups
+        self.unknown = []
+        def compile_one(template, names, groups=groups):
+            unknown = []
+            compiled = compile_template(template, names, self.env, groups,
+                                        unknown)
+            self.unknown.extend((name, template) for name in unknown)
+            return compiled
+        self._outputs_formats = [compile_one(template, ())
+                                 for template in self.outputs_template]
+        self._preqs_formats = [compile_one(template, ("trgt",))
+                               for template in self.preqs_template]
+        self._recipe_format = compile_one(self.recipe_template,
+                                          ("trgt", "preqs", "outputs"))
+        self._batch_format = compile_one(self.batch_recipe,
+                                         ("trgts", "preqs", "outputs"), 0)
+
+    def check(self):
+        """Raise ValueError if a template has a field the env lacks."""
+        if self.unknown:
+            raise ValueError("unknown field {!r} in template {!r}".\
+                             format(*self.unknown[0]))
+
+    def resources(self):
+        """Return the number of CPUs and the bytes of memory recipes use."""
+        return int(self.env['threads']), parse_size(self.env['mem'])
+
+    def match(self, trgt):
+        """Return groups matched by the target pattern in *trgt* or None."""
+        match = self.trgt_regex.match(trgt)
+        if match is not None:
+            return match.groups()
+        else:
+            return None
 
     def _match(self, trgt):
         """Return groups matched by the target pattern in *trgt*.
@@ -66,448 +265,4624 @@ class Rule():
         value: A tuple of strings.
 
         """
-        pattern = "^" + self.trgt_pattern + "$"
-        match = re.match(pattern, trgt)
-        if match is not None:
-            return match.groups()
+        groups = self.match(trgt)
+        if groups is not None:
+            return groups
         else:
             raise ValueError("{ptrn} does not match {trgt}".\
-                             format(trgt=trgt, ptrn=pattern))
+                             format(trgt=trgt, ptrn=self.trgt_regex.pattern))
+
+    def applies(self, trgt):
+        """Return if the value of *trgt* matches the target pattern."""
+        return self.match(trgt) is not None
+
+    def get_outputs(self, trgt, groups=None):
+        """Return the files made along with *trgt*, starting with the one
+        which names the group.
+
+        *groups* - [optional] the groups already matched in *trgt*
+
+        """
+        if self.unknown:
+            self.check()
+        if not self.outputs_template:
+            return [trgt]
+        if groups is None:
+            groups = self._match(trgt)
+        outputs = [template.format(*groups)
+                   for template in self._outputs_formats]
+        if trgt not in outputs:
+            raise ValueError("{trgt!r} is not one of the outputs {outputs} "
+                             "of {rule!r}".format(trgt=trgt, outputs=outputs,
+                                                  rule=self))
+        return outputs
+
+    def get_preqs(self, trgt, groups=None):
+        """Return the prerequisite templates filled for *trgt*.
+
+        *groups* - [optional] the groups already matched in *trgt*
+
+        """
+        if self.unknown:
+            self.check()
+        if groups is None:
+            groups = self._match(trgt)
+        preqs = [template.format(*groups, trgt=trgt)
+                 for template in self._preqs_formats]
+        return preqs
+
+    def get_recipe(self, trgt, groups=None, preqs=None):
+        """Return the recipe template filled for *trgt*.
+
+        *groups* - [optional] the groups already matched in *trgt*
+        *preqs* - [optional] the prerequisites already filled for *trgt*
+
+        """
+        if self.unknown:
+            self.check()
+        if groups is None:
+            groups = self._match(trgt)
+        if preqs is None:
+            preqs = self.get_preqs(trgt, groups)
+        # Make the str representation of *preqs* a space delimited list.
+        wrapped_preqs = SpaceList(preqs)
+        outputs = SpaceList(self.get_outputs(trgt, groups))
+        recipe = self._recipe_format.format(*groups, trgt=trgt,
+                                            preqs=wrapped_preqs,
+                                            outputs=outputs)
+        return recipe
+
+    def get_batch_recipe(self, reqs):
+        """Return the batch recipe template filled for the TaskReq objects
+        *reqs*.
+
+        """
+        if self.unknown:
+            self.check()
+        trgts = SpaceList(req.trgt for req in reqs)
+        preqs = SpaceList(dict.fromkeys(preq.trgt for req in reqs
+                                        for preq in req.requires))
+        outputs = SpaceList(output for req in reqs
+                            for output in req.outputs)
+        return self._batch_format.format(trgts=trgts, preqs=preqs,
+                                         outputs=outputs)
+
+
+SIZE_UNITS = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(size):
+    """Return the number of bytes in *size*.
+
+    Numbers are megabytes; strings may also end with a K, M, G or T unit
+    (powers of 1024).
+
+    >>> parse_size(512)
+    536870912
+    >>> parse_size("60G")
+    64424509440
+
+    """
+    if isinstance(size, str):
+        size = size.strip().upper().rstrip("B")
+        if size and size[-1] in SIZE_UNITS:
+            return int(float(size[:-1]) * SIZE_UNITS[size[-1]])
+    return int(float(size) * SIZE_UNITS["M"])
+
+
+def total_memory():
+    """Return the bytes of physical memory, or None if unknown."""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+REGEX_SPECIAL = set(".^$*+?{}[]|()")
+
+
+def literal_prefix(pattern):
+    r"""Return the literal prefix of the regex *pattern*.
+
+    value: A tuple of the prefix and whether all of *pattern* is literal.
+
+    Every string matched by *pattern* starts with the prefix.  The analysis
+    is conservative: escapes other than escaped punctuation end the prefix,
+    and any alternation gives an empty prefix.
+
+    >>> literal_prefix(r"data/(.*)\.txt")
+    ('data/', False)
+    >>> literal_prefix(r"out\.txt")
+    ('out.txt', True)
+    >>> literal_prefix(r"ab?c")
+    ('a', False)
+
+    """
+    prefix = []
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                prefix.append(pattern[i + 1])
+                i += 2
+                continue
+            break
+        elif char in REGEX_SPECIAL:
+            break
+        prefix.append(char)
+        i += 1
+    else:
+        return "".join(prefix), True
+    if "|" in pattern:
+        return "", False
+    if pattern[i] in "*?{" and prefix:
+        # The last literal character is optional.
+        prefix.pop()
+    return "".join(prefix), False
+
+
+class RuleIndex():
+    """A compiled index of *rules* for finding the rule that builds a target.
+
+    Literal target patterns are looked up by their value and other patterns
+    by their literal prefix, so only candidate rules are tested against
+    a target.  Matches respect the order of *rules*: the first applicable
+    rule wins.
+
+    """
+
+    def __init__(self, rules):
+        """Create a new RuleIndex for the sequence *rules*."""
+        self.rules = list(rules)
+        self.literals = {}
+        self.prefixes = {}
+        for i, rule in enumerate(self.rules):
+            prefix, is_literal = literal_prefix(rule.trgt_pattern)
+            if is_literal:
+                self.literals.setdefault(prefix, []).append(i)
+            else:
+                by_prefix = self.prefixes.setdefault(len(prefix), {})
+                by_prefix.setdefault(prefix, []).append(i)
+        self.prefix_lengths = sorted(self.prefixes)
+
+    def candidates(self, trgt):
+        """Return the positions of rules which might apply to *trgt*, in order.
+
+        """
+        candidates = list(self.literals.get(trgt, ()))
+        for length in self.prefix_lengths:
+            if length > len(trgt):
+                break
+            candidates.extend(self.prefixes[length].get(trgt[:length], ()))
+        candidates.sort()
+        return candidates
+
+    def match(self, trgt, exclude=()):
+        """Return the first rule applying to *trgt* which is not excluded.
+
+        *exclude* - positions of rules to skip
+
+        value: A tuple of the position of the rule, the rule, and the groups
+               matched in *trgt*, or (None, None, None) if no rule applies.
+
+        """
+        for i in self.candidates(trgt):
+            if i in exclude:
+                continue
+            rule = self.rules[i]
+            groups = rule.match(trgt)
+            if groups is not None:
+                return i, rule, groups
+        return None, None, None
+
+
+def debug(message, *args, **kwargs):
+    """Log *message*.format(*args, **kwargs) at the DEBUG level.
+
+    The message is only formatted when DEBUG messages are logged, so
+    debugging calls on hot paths cost next to nothing otherwise.
+
+    """
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug(message.format(*args, **kwargs))
+
+
+@contextlib.contextmanager
+def backup(path, append="~", prepend="", on_fail=None):
+    """Backup path while context manager is active.
+
+    Names the backup using the prefix *prepend* and the suffix *append*.
+
+    If an error occurs while active, *on_fail* is called on *path* before
+    exiting.
+
+    """
+    backup_path = os.path.join(os.path.dirname(path),
+                               prepend + os.path.basename(path) + append)
+    original_exists = os.path.exists(path)
+    if original_exists:
+        os.rename(path, backup_path)
+    try:
+        yield
+    except Exception as err:
+        new_exists = os.path.exists(path)
+        if original_exists:
+            os.rename(backup_path, path)
+        elif new_exists and on_fail:
+            on_fail(path)
+        raise err
+    else:
+        if original_exists:
+            os.remove(backup_path)
+
+
+class StatCache():
+    """A per-build cache of os.stat() results.
+
+    The first lookup in a directory lists it with os.scandir(), so that
+    missing files cost no further system calls and each file is stat'ed
+    at most once.  prefetch() fills the cache for many paths at once,
+    one directory per worker thread.
+
+    """
+
+    def __init__(self):
+        """Create a new, empty StatCache."""
+        self.stats = {}
+        self.dirs = {}
+        self.direct = set()
+
+    def _scan(self, dirpath):
+        """Return a dict of the entries in *dirpath*, or None if unreadable.
+
+        """
+        try:
+            with os.scandir(dirpath or os.curdir) as entries:
+                return {entry.name: entry for entry in entries}
+        except OSError:
+            return None
+
+    def _lookup(self, path):
+        """Return the stat result for *path* without using *self.stats*."""
+        dirpath, name = os.path.split(path)
+        entry = None
+        if path not in self.direct and name not in ("", os.curdir, os.pardir):
+            if dirpath not in self.dirs:
+                self.dirs[dirpath] = self._scan(dirpath)
+            entries = self.dirs[dirpath]
+            if entries is not None:
+                entry = entries.get(name)
+                if entry is None:
+                    return None
+        try:
+            if entry is None:
+                return os.stat(path)
+            else:
+                return entry.stat()
+        except OSError:
+            return None
+
+    def stat(self, path):
+        """Return the os.stat() result for *path*, or None if it is missing.
+
+        """
+        try:
+            return self.stats[path]
+        except KeyError:
+            stat = self.stats[path] = self._lookup(path)
+            return stat
+
+    def exists(self, path):
+        """Return if *path* exists."""
+        return self.stat(path) is not None
+
+    def getmtime(self, path):
+        """Return the modification time of *path*, or NaN if it is missing.
+
+        """
+        stat = self.stat(path)
+        if stat is None:
+            return float('nan')
+        else:
+            return stat.st_mtime
+
+    def invalidate(self, path):
+        """Forget what is known about *path*; it will be stat'ed again."""
+        self.direct.add(path)
+        self.stats.pop(path, None)
+
+    def prefetch(self, paths, threads=16):
+        """Fill the cache for all of *paths* using *threads* worker threads.
+
+        """
+        by_dir = {}
+        for path in paths:
+            if path not in self.stats:
+                by_dir.setdefault(os.path.dirname(path), []).append(path)
+        def fill(dir_paths):
+            for path in dir_paths:
+                self.stat(path)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as \
+                pool:
+            for _ in pool.map(fill, by_dir.values()):
+                pass
+
+
+def file_hash(path):
+    """Return the SHA-256 hex digest of the contents of *path*."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StateDB():
+    """A persistent store of file hashes and of how each target was built.
+
+    Kept in an SQLite database in *state_dir*.  A file is only re-hashed
+    when its size or modification time has changed since it was last
+    hashed.  The database is read once when opened and written by flush().
+
+    """
+
+    large_file = 1 << 24
+
+    def __init__(self, state_dir=STATE_DIR, stat_cache=None):
+        """Open (or create) the state database in *state_dir*.
+
+        *stat_cache* - [optional] the StatCache used to look up files
+
+        """
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, "state.db")
+        self.stat_cache = stat_cache or StatCache()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY,
+                                              size INTEGER,
+                                              mtime_ns INTEGER,
+                                              hash TEXT);
+            CREATE TABLE IF NOT EXISTS targets (trgt TEXT PRIMARY KEY,
+                                                recipe TEXT,
+                                                inputs TEXT,
+                                                hash TEXT);
+            """)
+        self.files = {path: (size, mtime_ns, digest) for
+                      path, size, mtime_ns, digest in
+                      self.conn.execute("SELECT * FROM files")}
+        self.targets = {trgt: (recipe, inputs, digest) for
+                        trgt, recipe, inputs, digest in
+                        self.conn.execute("SELECT * FROM targets")}
+        self.dirty_files = set()
+        self.dirty_targets = set()
+        self.lock = threading.Lock()
+
+    def _known_hash(self, path, stat):
+        """Return the stored hash of *path* if *stat* shows it unchanged."""
+        known = self.files.get(path)
+        if known is not None and \
+                known[:2] == (stat.st_size, stat.st_mtime_ns):
+            return known[2]
+        return None
+
+    def _store_hash(self, path, stat, digest):
+        self.files[path] = (stat.st_size, stat.st_mtime_ns, digest)
+        self.dirty_files.add(path)
+
+    def file_hash(self, path):
+        """Return the hash of the contents of *path*, or None if missing."""
+        stat = self.stat_cache.stat(path)
+        if stat is None:
+            return None
+        digest = self._known_hash(path, stat)
+        if digest is None:
+            try:
+                digest = file_hash(path)
+            except OSError:
+                return None
+            self._store_hash(path, stat, digest)
+        return digest
+
+    def prefetch(self, paths, threads=16):
+        """Hash all changed files among *paths* concurrently.
+
+        Files of at least *large_file* bytes are hashed in a process pool
+        and smaller ones on *threads* threads.
+
+        """
+        small, large = [], []
+        for path in paths:
+            file_stat = self.stat_cache.stat(path)
+            if file_stat is None or not stat.S_ISREG(file_stat.st_mode) or \
+                    self._known_hash(path, file_stat) is not None:
+                continue
+            if file_stat.st_size >= self.large_file:
+                large.append((path, file_stat))
+            else:
+                small.append((path, file_stat))
+        if not (small or large):
+            return
+        with contextlib.ExitStack() as stack:
+            pools = [(stack.enter_context(
+                        concurrent.futures.ThreadPoolExecutor(
+                            max_workers=threads)), small)]
+            if large:
+                pools += [(stack.enter_context(
+                              concurrent.futures.ProcessPoolExecutor()),
+                           large)]
+            futures = {}
+            for pool, todo in pools:
+                for path, file_stat in todo:
+                    futures[pool.submit(file_hash, path)] = (path, file_stat)
+            for future in concurrent.futures.as_completed(futures):
+                path, file_stat = futures[future]
+                try:
+                    self._store_hash(path, file_stat, future.result())
+                except OSError:
+                    pass
+
+    def get_target(self, trgt):
+        """Return the recipe, inputs signature and hash recorded for *trgt*.
+
+        value: A tuple of strings, or None if *trgt* has no record.
+
+        """
+        return self.targets.get(trgt)
+
+    def set_target(self, trgt, recipe, inputs, digest):
+        """Record that *trgt*, with hash *digest*, was built by *recipe* from
+        prerequisites with signature *inputs*.
+
+        """
+        self.targets[trgt] = (recipe, inputs, digest)
+        self.dirty_targets.add(trgt)
+
+    def flush(self):
+        """Write all new records to the database."""
+        with self.lock:
+            files = [(path,) + self.files[path] for path in self.dirty_files]
+            targets = [(trgt,) + self.targets[trgt]
+                       for trgt in self.dirty_targets]
+            self.dirty_files = set()
+            self.dirty_targets = set()
+            with self.conn:
+                self.conn.executemany(
+                        "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)",
+                        files)
+                self.conn.executemany(
+                        "INSERT OR REPLACE INTO targets VALUES (?, ?, ?, ?)",
+                        targets)
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.conn.close()
+
+
+def signature(items):
+    """Return a hash summarizing the sequence of strings *items*."""
+    digest = hashlib.sha256()
+    for item in items:
+        digest.update(item.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+class History():
+    """A record of how long tasks took, kept in an SQLite database.
+
+    The last duration of each target is kept, as well as the mean duration
+    of the tasks made from each rule (identified by its target pattern), so
+    that tasks which have never run can be estimated from others made by
+    the same rule.
+
+    """
+
+    default = 1.0
+
+    def __init__(self, state_dir=STATE_DIR):
+        """Open (or create) the history database in *state_dir*."""
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, "history.db")
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS targets (trgt TEXT PRIMARY KEY,
+                                                seconds REAL);
+            CREATE TABLE IF NOT EXISTS rules (pattern TEXT PRIMARY KEY,
+                                              total REAL,
+                                              count INTEGER);
+            """)
+        self.targets = dict(self.conn.execute("SELECT * FROM targets"))
+        self.rules = {pattern: (total, count) for pattern, total, count in
+                      self.conn.execute("SELECT * FROM rules")}
+        self.dirty_targets = set()
+        self.dirty_rules = set()
+        self.lock = threading.Lock()
+
+    def record(self, req, seconds):
+        """Record that the recipe of *req* took *seconds* to run."""
+        with self.lock:
+            self.targets[req.trgt] = seconds
+            self.dirty_targets.add(req.trgt)
+            if req.rule is not None:
+                pattern = req.rule.trgt_pattern
+                total, count = self.rules.get(pattern, (0.0, 0))
+                self.rules[pattern] = (total + seconds, count + 1)
+                self.dirty_rules.add(pattern)
+
+    def rule_mean(self, rule):
+        """Return the mean duration of tasks made from *rule*, or None."""
+        total, count = self.rules.get(rule.trgt_pattern, (0.0, 0))
+        if count:
+            return total / count
+        return None
+
+    def estimate(self, req):
+        """Return the expected duration of the recipe of *req*.
+
+        That is its last duration, or else the mean for its rule, or else
+        *default*.
+
+        """
+        seconds = self.targets.get(req.trgt)
+        if seconds is None and req.rule is not None:
+            seconds = self.rule_mean(req.rule)
+        if seconds is None:
+            seconds = self.default
+        return seconds
+
+    def flush(self):
+        """Write all new durations to the database."""
+        with self.lock:
+            targets = [(trgt, self.targets[trgt])
+                       for trgt in self.dirty_targets]
+            rules = [(pattern,) + self.rules[pattern]
+                     for pattern in self.dirty_rules]
+            self.dirty_targets = set()
+            self.dirty_rules = set()
+            with self.conn:
+                self.conn.executemany(
+                        "INSERT OR REPLACE INTO targets VALUES (?, ?)",
+                        targets)
+                self.conn.executemany(
+                        "INSERT OR REPLACE INTO rules VALUES (?, ?, ?)",
+                        rules)
+
+    def close(self):
+        """Flush and close the database."""
+        self.flush()
+        self.conn.close()
+
+
+FICLONE = 0x40049409
+
+
+def clone_file(src, dst, link=False):
+    """Make *dst* a copy of the file *src*, as cheaply as possible.
+
+    The copy shares the storage of *src* where the filesystem can clone
+    files (a reflink); otherwise it is a hard link if *link* is set, or
+    else a plain copy.  *dst* is replaced atomically.
+
+    """
+    tmp = "{}.{}.tmp".format(dst, threading.get_ident())
+    try:
+        if link:
+            os.link(src, tmp)
+        else:
+            with open(src, 'rb') as source, open(tmp, 'wb') as target:
+                try:
+                    fcntl.ioctl(target.fileno(), FICLONE, source.fileno())
+                except OSError:
+                    shutil.copyfileobj(source, target, 1 << 20)
+            shutil.copymode(src, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.remove(tmp)
+        raise
+
+
+def cache_key(req):
+    """Return the key of the outputs of *req* in a cache, or None if it
+    has none.
+
+    The key covers the target, the filled recipe and the names and
+    contents of the prerequisites.
+
+    """
+    inputs = req.inputs_signature()
+    if inputs is None:
+        return None
+    return signature([req.trgt, req.recipe, inputs])
+
+
+class ArtifactCache():
+    """A size-bounded store of the outputs of recipes.
+
+    The outputs of a task are stored under a key made from its target,
+    the filled recipe (which includes whatever variables the recipe uses)
+    and the names and contents of the prerequisites.  The contents
+    themselves are stored once per hash, in *cache_dir*/objects, and an
+    SQLite index records the keys and when each was last used.  When the
+    objects grow past *max_size*, the least recently used keys are dropped
+    along with objects no longer referred to.
+
+    The size of the objects is counted when the cache is opened and kept
+    up to date as entries are stored and evicted, so storing costs the
+    same however big the cache is.  Objects stored by another process
+    sharing *cache_dir* are only counted when the cache is next opened.
+
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_size="10G", link=False):
+        """Open (or create) the cache in *cache_dir*.
+
+        *max_size* - the size the objects are kept within; see parse_size()
+        *link* - restore outputs as hard links to the stored objects when
+                 they cannot be cloned.  Faster than copying, but a target
+                 modified in place would then corrupt the cache.
+
+        """
+        self.cache_dir = cache_dir
+        self.objects = os.path.join(cache_dir, "objects")
+        os.makedirs(self.objects, exist_ok=True)
+        self.max_size = parse_size(max_size)
+        self.link = link
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.db"),
+                                    check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY,
+                                                hash TEXT,
+                                                size INTEGER,
+                                                used REAL);
+            CREATE INDEX IF NOT EXISTS entries_used ON entries (used);
+            CREATE INDEX IF NOT EXISTS entries_hash ON entries (hash);
+            """)
+        self.lock = threading.Lock()
+        self.counts = dict(hits=0, misses=0, stores=0, evictions=0,
+                           restored_bytes=0)
+        self.total = self.size()
+        self.evict()
+
+    def _object(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def key(self, req):
+        """Return the key of the output of *req*, or None if it has none.
+
+        """
+        return cache_key(req)
+
+    def restore(self, key, trgts):
+        """Restore the outputs stored under *key* to the files *trgts*.
+
+        Returns True on a hit, when every output was restored, and False on
+        a miss.
+
+        """
+        keys = [signature([key, trgt]) for trgt in trgts]
+        now = time.time()
+        with self.lock:
+            rows = [self.conn.execute(
+                        "SELECT hash, size FROM entries WHERE key = ?",
+                        (output_key,)).fetchone() for output_key in keys]
+            hit = None not in rows
+            if hit:
+                self.conn.executemany(
+                        "UPDATE entries SET used = ? WHERE key = ?",
+                        [(now, output_key) for output_key in keys])
+        if hit:
+            try:
+                for trgt, (digest, _) in zip(trgts, rows):
+                    clone_file(self._object(digest), trgt, self.link)
+                    # A restored file is as new as one the recipe made.
+                    os.utime(trgt)
+            except OSError as err:
+                LOG.warning("could not restore {!r} from the cache: {}".\
+                            format(trgt, err))
+                hit = False
+        with self.lock:
+            if not hit:
+                self.counts['misses'] += 1
+                return False
+            self.counts['hits'] += 1
+            self.counts['restored_bytes'] += sum(size for _, size in rows)
+        return True
+
+    def store(self, key, trgts, digests=None):
+        """Store the files *trgts*, with contents hashes *digests*, under
+        *key*.
+
+        Nothing is stored unless every one is a regular file.
+
+        """
+        entries = []
+        try:
+            for i, trgt in enumerate(trgts):
+                file_stat = os.stat(trgt)
+                if not stat.S_ISREG(file_stat.st_mode):
+                    return
+                digest = digests[i] if digests else None
+                if digest is None:
+                    digest = file_hash(trgt)
+                path = self._object(digest)
+                if not os.path.exists(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                    clone_file(trgt, path)
+                entries.append((signature([key, trgt]), digest,
+                                file_stat.st_size, time.time()))
+        except OSError as err:
+            LOG.warning("could not store {!r} in the cache: {}".\
+                        format(trgt, err))
+            return
+        doomed = []
+        with self.lock:
+            for entry in entries:
+                output_key, digest, size, _ = entry
+                old = self.conn.execute(
+                        "SELECT hash, size FROM entries WHERE key = ?",
+                        (output_key,)).fetchone()
+                if not self._referenced(digest):
+                    self.total += size
+                self.conn.execute(
+                        "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                        entry)
+                if old is not None and old[0] != digest and \
+                        not self._referenced(old[0]):
+                    doomed.append(old[0])
+                    self.total -= old[1]
+            self.counts['stores'] += 1
+        for digest in doomed:
+            with contextlib.suppress(OSError):
+                os.remove(self._object(digest))
+        self.evict()
+
+    def _referenced(self, digest):
+        """Return if an entry refers to the object *digest*.  The caller
+        holds *self.lock*.
+
+        """
+        return self.conn.execute(
+                "SELECT 1 FROM entries WHERE hash = ? LIMIT 1",
+                (digest,)).fetchone() is not None
+
+    def size(self):
+        """Return the total size of the stored objects."""
+        with self.lock:
+            return self.conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM "
+                    "(SELECT DISTINCT hash, size FROM entries)").fetchone()[0]
+
+    def evict(self):
+        """Drop the least recently used entries until the objects fit in
+        *max_size*.
+
+        """
+        doomed = []
+        with self.lock:
+            while self.total > self.max_size:
+                rows = self.conn.execute(
+                        "SELECT key, hash, size FROM entries ORDER BY used "
+                        "LIMIT 64").fetchall()
+                if not rows:
+                    break
+                for key, digest, size in rows:
+                    if self.total <= self.max_size:
+                        break
+                    self.conn.execute("DELETE FROM entries WHERE key = ?",
+                                      (key,))
+                    self.counts['evictions'] += 1
+                    if not self._referenced(digest):
+                        doomed.append(digest)
+                        self.total -= size
+        for digest in doomed:
+            with contextlib.suppress(OSError):
+                os.remove(self._object(digest))
+
+    def stats(self):
+        """Return the counts of this session and the size of the cache."""
+        stats = dict(self.counts, size=self.size(), max_size=self.max_size)
+        with self.lock:
+            stats['entries'] = self.conn.execute(
+                    "SELECT COUNT(*) FROM entries").fetchone()[0]
+        return stats
+
+    def summary(self):
+        """Return a description of the use of the cache in this session."""
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        return ("cache {cache_dir}: {hits} hits, {misses} misses "
+                "({rate:.0%} hit rate), {restored:.1f} MiB restored, "
+                "{stores} stored, {evictions} evicted; "
+                "{entries} entries using {size:.1f} of {max_size:.1f} MiB").\
+               format(cache_dir=self.cache_dir,
+                      rate=stats['hits'] / lookups if lookups else 0.0,
+                      restored=stats['restored_bytes'] / SIZE_UNITS["M"],
+                      size=stats['size'] / SIZE_UNITS["M"],
+                      max_size=stats['max_size'] / SIZE_UNITS["M"],
+                      **{name: stats[name] for name in
+                         ('hits', 'misses', 'stores', 'evictions',
+                          'entries')})
+
+    def flush(self):
+        """Write the index to disk."""
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        """Flush and close the index."""
+        self.flush()
+        self.conn.close()
+
+
+class RemoteCache():
+    """An ArtifactCache shared over HTTP; see CacheServer.
+
+    Outputs are looked up by the same key as in an ArtifactCache.  The
+    protocol is plain GET, HEAD and PUT:
+
+    /ac/KEY - a JSON action result: the path, hash, size and permission
+              bits of each output
+    /cas/HASH - the contents with that SHA-256 hash
+
+    Each thread keeps its own persistent connection.  store() only queues
+    an upload, which happens in the background; flush() waits for the
+    queued uploads.  The server being unreachable counts as a miss, and
+    does not stop the build.  Once a new connection to it fails, it is
+    taken to be down for the rest of the session: every lookup is a miss
+    and nothing more is uploaded, so a dead server costs one timeout, not
+    one per task.
+
+    """
+
+    def __init__(self, url, workers=8, timeout=30.0):
+        """Use the cache served at *url*.
+
+        *workers* - the number of uploads run at once
+        *timeout* - how many seconds to wait on the server
+
+        """
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ("http", "https"):
+            raise ValueError("not an HTTP URL: {!r}".format(url))
+        self.url = url
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.prefix = parts.path.rstrip("/")
+        self.workers = workers
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.uploads = concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="pymake-upload")
+        self.pending = set()
+        self.counts = dict(hits=0, misses=0, stores=0, errors=0,
+                           restored_bytes=0, uploaded_bytes=0)
+        self.warned = False
+        self.down = False
+
+    def key(self, req):
+        """Return the key of the output of *req*, or None if it has none.
+
+        """
+        return cache_key(req)
+
+    def _request(self, method, path, body=None):
+        """Return the status and body of the response to a request.
+
+        Retries once on a new connection if the old one was closed.  A
+        new connection failing marks the server as down.
+
+        """
+        if self.down:
+            raise ConnectionError("the remote cache is down")
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            fresh = conn is None
+            if fresh:
+                cls = http.client.HTTPSConnection if self.scheme == "https" \
+                      else http.client.HTTPConnection
+                conn = self.local.conn = cls(self.netloc,
+                                             timeout=self.timeout)
+            try:
+                conn.request(method, self.prefix + path, body=body)
+                response = conn.getresponse()
+                return response.status, response.read()
+            except (http.client.HTTPException, OSError) as err:
+                conn.close()
+                self.local.conn = None
+                if fresh or attempt:
+                    if isinstance(err, OSError):
+                        self._give_up(err)
+                    raise
+
+    def _give_up(self, err):
+        """Stop using the server for the rest of the session, reporting
+        it once.
+
+        """
+        with self.lock:
+            down, self.down = self.down, True
+            self.warned = True
+        if not down:
+            LOG.warning("could not reach the remote cache {}: {}; building "
+                        "without it".format(self.url, err))
+
+    def _failed(self, action, err):
+        """Count and, the first time, report an error talking to the
+        server.
+
+        """
+        with self.lock:
+            self.counts['errors'] += 1
+            warned, self.warned = self.warned, True
+        if not warned:
+            LOG.warning("could not {} the remote cache {}: {}".\
+                        format(action, self.url, err))
+
+    def restore(self, key, trgts):
+        """Fetch the outputs stored under *key* to the files *trgts*.
+
+        Returns True on a hit, when every output was fetched, and False on
+        a miss.  No file is replaced unless they all were fetched.
+
+        """
+        if self.down:
+            with self.lock:
+                self.counts['misses'] += 1
+            return False
+        tmps = []
+        try:
+            status, body = self._request("GET", "/ac/" + key)
+            hit = status == 200
+            if hit:
+                # Results stored before permission bits were kept have
+                # none.
+                outputs = {output[0]: (output[1], output[2], output[3:])
+                           for output
+                           in json.loads(body.decode())['outputs']}
+                hit = all(trgt in outputs for trgt in trgts)
+            if hit:
+                for trgt in trgts:
+                    digest, size, mode = outputs[trgt]
+                    status, data = self._request("GET", "/cas/" + digest)
+                    if status != 200 or \
+                            hashlib.sha256(data).hexdigest() != digest:
+                        hit = False
+                        break
+                    tmp = "{}.{}.tmp".format(trgt, threading.get_ident())
+                    tmps.append((tmp, trgt))
+                    with open(tmp, 'wb') as handle:
+                        handle.write(data)
+                    if mode:
+                        os.chmod(tmp, mode[0])
+            if hit:
+                for tmp, trgt in tmps:
+                    os.replace(tmp, trgt)
+                tmps = []
+        except (http.client.HTTPException, OSError, ValueError,
+                KeyError, IndexError, TypeError) as err:
+            self._failed("fetch from", err)
+            hit = False
+        finally:
+            for tmp, _ in tmps:
+                with contextlib.suppress(OSError):
+                    os.remove(tmp)
+        with self.lock:
+            if not hit:
+                self.counts['misses'] += 1
+                return False
+            self.counts['hits'] += 1
+            self.counts['restored_bytes'] += sum(outputs[trgt][1]
+                                                 for trgt in trgts)
+        return True
+
+    def store(self, key, trgts, digests=None):
+        """Queue the files *trgts*, with contents hashes *digests*, to be
+        uploaded under *key*.  Does nothing once the server is down.
+
+        """
+        if self.down:
+            return
+        future = self.uploads.submit(self._upload, key, list(trgts),
+                                     digests)
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._uploaded)
+
+    def _uploaded(self, future):
+        with self.lock:
+            self.pending.discard(future)
+
+    def _upload(self, key, trgts, digests):
+        """Upload the files *trgts* and then the action result for *key*.
+
+        Nothing is uploaded for a file which changed after it was hashed.
+
+        """
+        outputs = []
+        try:
+            for i, trgt in enumerate(trgts):
+                with open(trgt, 'rb') as handle:
+                    data = handle.read()
+                    mode = stat.S_IMODE(os.fstat(handle.fileno()).st_mode)
+                digest = hashlib.sha256(data).hexdigest()
+                if digests and digests[i] not in (None, digest):
+                    return
+                status, _ = self._request("HEAD", "/cas/" + digest)
+                if status != 200:
+                    status, _ = self._request("PUT", "/cas/" + digest, data)
+                    if status not in (200, 201, 204):
+                        raise OSError("status {} for {!r}".\
+                                      format(status, trgt))
+                    with self.lock:
+                        self.counts['uploaded_bytes'] += len(data)
+                outputs.append([trgt, digest, len(data), mode])
+            body = json.dumps(dict(outputs=outputs)).encode()
+            status, _ = self._request("PUT", "/ac/" + key, body)
+            if status not in (200, 201, 204):
+                raise OSError("status {} for the action result".\
+                              format(status))
+        except (http.client.HTTPException, OSError) as err:
+            self._failed("upload to", err)
+            return
+        with self.lock:
+            self.counts['stores'] += 1
+
+    def stats(self):
+        """Return the counts of this session."""
+        with self.lock:
+            return dict(self.counts, pending=len(self.pending))
+
+    def summary(self):
+        """Return a description of the use of the cache in this session."""
+        stats = self.stats()
+        lookups = stats['hits'] + stats['misses']
+        return ("cache {url}: {hits} hits, {misses} misses "
+                "({rate:.0%} hit rate), {restored:.1f} MiB fetched, "
+                "{stores} stored ({uploaded:.1f} MiB uploaded), "
+                "{errors} errors").\
+               format(url=self.url,
+                      rate=stats['hits'] / lookups if lookups else 0.0,
+                      restored=stats['restored_bytes'] / SIZE_UNITS["M"],
+                      uploaded=stats['uploaded_bytes'] / SIZE_UNITS["M"],
+                      **{name: stats[name] for name in
+                         ('hits', 'misses', 'stores', 'errors')})
+
+    def flush(self):
+        """Wait for the queued uploads."""
+        with self.lock:
+            pending = list(self.pending)
+        concurrent.futures.wait(pending)
+
+    def close(self):
+        """Finish the queued uploads and stop."""
+        self.flush()
+        self.uploads.shutdown()
+
+
+class CacheHandler(http.server.BaseHTTPRequestHandler):
+    """Serve the RemoteCache protocol from the directory of the server."""
+
+    protocol_version = "HTTP/1.1"
+    path_pattern = re.compile(r"^/(ac|cas)/([0-9a-f]{64})$")
+
+    def _path(self):
+        """Return the file for the request, or None if it is invalid."""
+        match = self.path_pattern.match(self.path)
+        if match is None:
+            return None
+        kind, name = match.groups()
+        return os.path.join(self.server.directory, kind, name[:2], name)
+
+    def _reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_GET(self):
+        path = self._path()
+        try:
+            with open(path, 'rb') as handle:
+                body = handle.read()
+        except (TypeError, OSError):
+            self._reply(404)
+        else:
+            self._reply(200, body)
+
+    def do_HEAD(self):
+        path = self._path()
+        if path is not None and os.path.exists(path):
+            self.send_response(200)
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.end_headers()
+        else:
+            self._reply(404)
+
+    def do_PUT(self):
+        path = self._path()
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if path is None:
+            return self._reply(400)
+        if self.path.startswith("/cas/") and \
+                hashlib.sha256(body).hexdigest() != os.path.basename(path):
+            return self._reply(400)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp, 'wb') as handle:
+            handle.write(body)
+        os.replace(tmp, path)
+        self._reply(201)
+
+    def log_message(self, format, *args):
+        debug(format, *args)
+
+
+class CacheServer(http.server.ThreadingHTTPServer):
+    """A reference server for RemoteCache, keeping everything in
+    *directory*.
+
+    Nothing is ever evicted.  Meant for testing and small teams, not as a
+    hardened service.
+
+    """
+
+    daemon_threads = True
+
+    def __init__(self, directory, address=("127.0.0.1", 0)):
+        """Serve *directory* at *address* (DEFAULT: a free port on
+        localhost).
+
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        super(CacheServer, self).__init__(address, CacheHandler)
+
+    @property
+    def url(self):
+        """The URL to give a RemoteCache."""
+        host, port = self.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+
+def cache_server_main(argv=None):
+    """Run a CacheServer from the command line."""
+    usage = "usage: %prog [options] [HOST:]PORT"
+    parser = optparse.OptionParser(usage=usage,
+                                   description=("Serve a shared pymake "
+                                                "cache over HTTP."))
+    parser.add_option("-d", "--directory", dest="directory",
+                      default="pymake-cache", metavar="DIR",
+                      help=("keep the cached outputs in DIR. "
+                            "DEFAULT: %default"))
+    parser.add_option("-v", "--verbose", action="store_true",
+                      dest="verbose", default=False,
+                      help="print each request. DEFAULT: False")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected one [HOST:]PORT")
+    host, _, port = args[0].rpartition(":")
+    logging.basicConfig(level=logging.DEBUG if opts.verbose else logging.INFO,
+                        format="%(message)s")
+    server = CacheServer(opts.directory, (host or "127.0.0.1", int(port)))
+    LOG.info("serving {!r} at {}".format(opts.directory, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+class Tracer():
+    """Collect a timeline of a build as Chrome trace events.
+
+    The JSON written by save() can be opened in chrome://tracing or
+    Perfetto.  Graph construction and checks are on the first track,
+    each recipe on the track of the slot it ran in, and the time tasks
+    spent waiting for a slot on tracks of their own.
+
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.pid = os.getpid()
+        self.events = []
+        self.tracks = set()
+
+    def now(self):
+        """Return the current time in the units of the trace."""
+        return (time.perf_counter() - self.start) * 1e6
+
+    def name_track(self, tid, name):
+        """Name the track *tid* once."""
+        if tid not in self.tracks:
+            self.tracks.add(tid)
+            self.events.append(dict(ph="M", name="thread_name",
+                                    pid=self.pid, tid=tid,
+                                    args=dict(name=name)))
+
+    def complete(self, name, cat, start, end, tid=0, **args):
+        """Add a span from *start* to *end* (see now()) on track *tid*."""
+        self.events.append(dict(ph="X", name=name, cat=cat, ts=start,
+                                dur=end - start, pid=self.pid, tid=tid,
+                                args=args))
+
+    @contextlib.contextmanager
+    def span(self, name, cat="build", tid=0, **args):
+        """Add a span for the time the context manager is active."""
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.complete(name, cat, start, self.now(), tid, **args)
+
+    def waited(self, name, cat, start, end, ident):
+        """Add a span, which may overlap others, to an async track."""
+        for phase, ts in (("b", start), ("e", end)):
+            self.events.append(dict(ph=phase, name=name, cat=cat, ts=ts,
+                                    id=ident, pid=self.pid, tid=0))
+
+    def counter(self, name, **values):
+        """Record the current *values* of the counter *name*."""
+        self.events.append(dict(ph="C", name=name, ts=self.now(),
+                                pid=self.pid, tid=0, args=values))
+
+    def save(self, path):
+        """Write the trace to *path*."""
+        with open(path, 'w') as handle:
+            json.dump(dict(traceEvents=self.events, displayTimeUnit="ms"),
+                      handle)
+
+
+class BuildSession():
+    """The state of a build.
+
+    A session owns the registry of requirements by target, the StatCache
+    and, in content-hash mode, the StateDB.  Separate sessions share
+    nothing, so builds can run side by side in one process, and a graph
+    is released along with its session.  Rules are shared, though, so
+    side-by-side builds should not update the env of the same rules.
+
+    """
+
+    def __init__(self, state_dir=STATE_DIR, use_hash=False, history=False,
+                 trace=False, cache=None):
+        """Create a new BuildSession.
+
+        *state_dir* - where persistent state is kept
+        *use_hash* - decide what is up-to-date using the contents of files
+                     rather than their modification times
+        *history* - record how long tasks take, and use that to run the
+                    tasks on the longest paths first.  Off by default, so
+                    that a session made for a lone Req opens no database;
+                    make() turns it on.
+        *trace* - collect a timeline of the build in *self.tracer*
+        *cache* - [optional] an ArtifactCache or RemoteCache to restore
+                  outputs from rather than running recipes.  It is not
+                  closed with the session.
+
+        """
+        self.tracer = Tracer() if trace else None
+        self.cache = cache
+        self.hashes = {}
+        self.state_dir = state_dir
+        self.instances = {}
+        self.stat_cache = StatCache()
+        self.state_db = None
+        if use_hash:
+            self.state_db = StateDB(state_dir, self.stat_cache)
+        self.history = None
+        if history:
+            try:
+                self.history = History(state_dir)
+            except (OSError, sqlite3.Error) as err:
+                LOG.warning("not recording task durations: {}".format(err))
+
+    def span(self, name, **args):
+        """Return a context manager tracing a step of the build as *name*.
+
+        """
+        if self.tracer is None:
+            return contextlib.nullcontext()
+        return self.tracer.span(name, **args)
+
+    def file_hash(self, path):
+        """Return the hash of the contents of *path*, or None if missing.
+
+        Hashes are kept in the StateDB in content-hash mode, and otherwise
+        only for the life of the session.
+
+        """
+        if self.state_db is not None:
+            return self.state_db.file_hash(path)
+        file_stat = self.stat_cache.stat(path)
+        if file_stat is None:
+            return None
+        version = (file_stat.st_size, file_stat.st_mtime_ns)
+        known = self.hashes.get(path)
+        if known is not None and known[0] == version:
+            return known[1]
+        try:
+            digest = file_hash(path)
+        except OSError:
+            return None
+        self.hashes[path] = (version, digest)
+        return digest
+
+    def prefetch(self, root):
+        """Fill the caches for *root* and every requirement below it."""
+        trgts = [output for req in iter_reqs(root)
+                 for output in getattr(req, 'outputs', (req.trgt,))]
+        self.stat_cache.prefetch(trgts)
+        if self.state_db is not None:
+            self.state_db.prefetch(trgts)
+
+    def flush(self):
+        """Write all new persistent state."""
+        if self.state_db is not None:
+            self.state_db.flush()
+        if self.history is not None:
+            self.history.flush()
+        if self.cache is not None:
+            self.cache.flush()
+
+    def close(self):
+        """Write all new persistent state and release it."""
+        if self.state_db is not None:
+            self.state_db.close()
+            self.state_db = None
+        if self.history is not None:
+            self.history.close()
+            self.history = None
+        if self.cache is not None:
+            self.cache.flush()
+
+
+def extract_rule(trgt, rules):
+    """Return the first rule in *rules* that matches *trgt* and the remainder.
+
+    """
+    rules = list(rules)
+    req = None
+    for i, rule in enumerate(rules):
+        if rule.applies(trgt):
+            del rules[i]
+            return rule, rules
+    else:
+        return None, rules
+
+
+def make_req(trgt, rules, session=None, visitor=None):
+    """Return a fully initialized Req object for *trgt*.
+
+    Will fill the requirements of trgt, depth-first, without recursion.
+    *rules* may be a sequence of rules or a RuleIndex.  A rule is not used
+    twice along any one path through the graph.  The requirements are
+    registered in *session* (DEFAULT: a new BuildSession).  A TaskReq with
+    several outputs is registered, and shared, under each of them.
+
+    *visitor* - [optional] an object whose push(trgt, rule, groups) method
+                is called when a target is found to be made by a rule,
+                and whose made(req) method is called with each
+                requirement as it is added to a parent, or returned;
+                see GraphFeed
+
+    """
+    if session is None:
+        session = BuildSession()
+    if not isinstance(rules, RuleIndex):
+        rules = RuleIndex(rules)
+    # Each frame is (trgt, i, rule, groups, preqs, requires) for a target
+    # whose prerequisites are still being made; the frames are the current
+    # path and *used* holds the positions of their rules.
+    stack = []
+    used = set()
+    def start(trgt):
+        """Return the Req for *trgt*, or None if a frame was pushed."""
+        if trgt in session.instances:
+            return session.instances[trgt]
+        i, rule, groups = rules.match(trgt, exclude=used)
+        if rule is None:
+            return FileReq(trgt, session=session)
+        if rule.outputs_template:
+            # The group of outputs is named by the first of them.
+            first = rule.get_outputs(trgt, groups)[0]
+            if first != trgt:
+                trgt, groups = first, rule._match(first)
+                if trgt in session.instances:
+                    return session.instances[trgt]
+        stack.append((trgt, i, rule, groups, rule.get_preqs(trgt, groups),
+                      []))
+        used.add(i)
+        if visitor is not None:
+            visitor.push(trgt, rule, groups)
+        return None
+    req = start(trgt)
+    while True:
+        if req is not None:
+            if visitor is not None:
+                visitor.made(req)
+            if not stack:
+                return req
+            stack[-1][5].append(req)
+        trgt, i, rule, groups, preqs, requires = stack[-1]
+        if len(requires) < len(preqs):
+            req = start(preqs[len(requires)])
+            continue
+        stack.pop()
+        used.remove(i)
+        # The recipe is only filled in if the task runs.
+        if rule.recipe_template:
+            req = TaskReq(trgt, requires, order_only=rule.order_only,
+                          rule=rule, session=session,
+                          outputs=rule.get_outputs(trgt, groups))
+        else:
+            req = DummyReq(trgt, requires, rule=rule, session=session)
+
+
+GRAPH_FORMAT = 3
+GRAPH_FILE, GRAPH_TASK, GRAPH_DUMMY = range(3)
+
+
+def graph_fingerprint(trgt, rules):
+    """Return a hash identifying the graph made for *trgt* from *rules*.
+
+    Rules are identified by their repr(), which includes their env.
+
+    """
+    return signature([str(GRAPH_FORMAT), trgt] +
+                     [repr(rule) for rule in rules])
+
+
+def save_graph(path, root, rules, fingerprint):
+    """Write the graph below *root* to *path*.
+
+    The graph is stored with pickle as flat arrays: the targets in
+    post-order, the kind of each requirement, its recipe if it was not
+    made from a rule, its other outputs, and the position in *rules* of
+    the rule it was made from, plus the prerequisites of every requirement
+    as offsets into one edge array.
+
+    """
+    positions = {id(rule): i for i, rule in enumerate(rules)}
+    nodes = postorder(root)
+    ids = {id(req): i for i, req in enumerate(nodes)}
+    kinds = bytearray()
+    recipes = []
+    outputs = {}
+    order_only = bytearray()
+    rule_ids = array.array('l')
+    offsets = array.array('L', [0])
+    edges = array.array('L')
+    for req in nodes:
+        if isinstance(req, TaskReq):
+            kinds.append(GRAPH_TASK)
+            # Recipes are filled again from the rule when needed.
+            recipes.append(req._recipe if req.rule is None else None)
+            order_only.append(req.order_only)
+            if len(req.outputs) > 1:
+                outputs[len(recipes) - 1] = req.outputs
+        else:
+            kinds.append(GRAPH_DUMMY if isinstance(req, DummyReq)
+                         else GRAPH_FILE)
+            recipes.append(None)
+            order_only.append(False)
+        rule_ids.append(positions.get(id(getattr(req, 'rule', None)), -1))
+        edges.extend(ids[id(preq)] for preq in getattr(req, 'requires', ()))
+        offsets.append(len(edges))
+    data = (fingerprint, [req.trgt for req in nodes], bytes(kinds), recipes,
+            outputs, bytes(order_only), rule_ids, offsets, edges)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + "~"
+    with open(tmp_path, 'wb') as handle:
+        pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_graph(path, rules, fingerprint, session):
+    """Return the root of the graph saved in *path* by save_graph().
+
+    The requirements are registered in *session*.  Returns None if there
+    is no saved graph for *fingerprint*.
+
+    """
+    try:
+        with open(path, 'rb') as handle:
+            data = pickle.load(handle)
+    except (OSError, ValueError, pickle.UnpicklingError, EOFError):
+        return None
+    if data[0] != fingerprint:
+        return None
+    _, trgts, kinds, recipes, outputs, order_only, rule_ids, offsets, \
+            edges = data
+    reqs = []
+    for i, trgt in enumerate(trgts):
+        rule = rules[rule_ids[i]] if rule_ids[i] >= 0 else None
+        if kinds[i] == GRAPH_FILE:
+            reqs.append(FileReq(trgt, session=session))
+            continue
+        requires = [reqs[j] for j in edges[offsets[i]:offsets[i + 1]]]
+        if kinds[i] == GRAPH_TASK:
+            reqs.append(TaskReq(trgt, requires, recipes[i],
+                                order_only=bool(order_only[i]), rule=rule,
+                                session=session, outputs=outputs.get(i)))
+        else:
+            reqs.append(DummyReq(trgt, requires, rule=rule,
+                                 session=session))
+    return reqs[-1]
+
+
+def cached_make_req(trgt, rules, session=None):
+    """Return the Req object for *trgt*, as make_req().
+
+    The resolved graph is saved in the state directory of *session* and
+    loaded from there instead of being built again, for as long as *trgt*
+    and *rules* are unchanged.
+
+    """
+    if session is None:
+        session = BuildSession()
+    rules = list(rules)
+    fingerprint = graph_fingerprint(trgt, rules)
+    path = os.path.join(session.state_dir, "graph",
+                        signature([trgt])[:16] + ".pickle")
+    root = load_graph(path, rules, fingerprint, session)
+    if root is not None:
+        debug("loaded the graph for {!r} from {!r}", trgt, path)
+        return root
+    root = make_req(trgt, rules, session)
+    save_graph(path, root, rules, fingerprint)
+    return root
+
+
+class GraphFeed():
+    """Check requirements as make_req() makes them, and pass on each one
+    which is certain to be needed, to start it before the graph is done.
+
+    make_req() works depth-first, so when a requirement is made, the
+    targets on the path to it are still being made.  A requirement is
+    certainly needed once every one of them is certain to be out of date:
+
+    - by contents, once any requirement below it is out of date, which
+      makes every requirement above it out of date in turn
+    - by modification times, when an output is missing, or is not newer
+      than a requirement checked below it
+
+    """
+
+    # Needed requirements are passed on in lists of up to *chunk*, or of
+    # whatever was found in *delay* seconds.
+    chunk = 256
+    delay = 0.01
+
+    def __init__(self, session, need):
+        """Create a new GraphFeed.
+
+        *need* - called with lists of the requirements found to be needed
+
+        """
+        self.session = session
+        self.need = need
+        self.pending = []
+        self.flushed = time.monotonic()
+        # [out of date, last update] for each target being made.
+        self.path = []
+        self.undecided = 0
+
+    def push(self, trgt, rule, groups):
+        """Note that *trgt* is being made by *rule*."""
+        if self.session.state_db is not None:
+            frame = [False, None]
+        else:
+            mtimes = [self.session.stat_cache.getmtime(output)
+                      for output in rule.get_outputs(trgt, groups)]
+            last_update = float('nan') if any(map(math.isnan, mtimes)) \
+                          else min(mtimes)
+            if not rule.recipe_template:
+                # Only a missing target settles a DummyReq.
+                last_update = float('nan') if math.isnan(last_update) \
+                              else float('inf')
+            frame = [math.isnan(last_update), last_update]
+        self.path.append(frame)
+        if not frame[0]:
+            self.undecided += 1
+
+    def _settle(self, frame):
+        frame[0] = True
+        self.undecided -= 1
+
+    def made(self, req):
+        """Check *req*, which was just added to the target being made."""
+        if isinstance(req, HierReq) and not req.checked:
+            # Its own frame is done.
+            if not self.path.pop()[0]:
+                self.undecided -= 1
+        if not req.checked:
+            req.check_result = req.evaluate()
+            req.checked = True
+        if self.session.state_db is not None:
+            if req.check_result is False:
+                for frame in reversed(self.path):
+                    if frame[0]:
+                        break
+                    self._settle(frame)
+        elif self.path and not self.path[-1][0]:
+            result = req.check_result
+            if not math.isnan(result) and result >= self.path[-1][1]:
+                self._settle(self.path[-1])
+        if self.undecided == 0:
+            self.pending.append(req)
+            if len(self.pending) >= self.chunk or \
+                    time.monotonic() - self.flushed > self.delay:
+                self.flush()
+
+    def flush(self):
+        """Pass on the needed requirements found since the last flush."""
+        if self.pending:
+            self.need(self.pending)
+            self.pending = []
+        self.flushed = time.monotonic()
+
+
+def postorder(root, skip=None):
+    """Return a list of *root* and every requirement below it.
+
+    Each requirement comes after all of its prerequisites.  Requirements
+    for which *skip*(req) is true are left out, along with everything
+    reachable only through them.
+
+    """
+    order = []
+    seen = {id(root)}
+    stack = [(root, iter(getattr(root, 'requires', ())))]
+    while stack:
+        req, preqs = stack[-1]
+        for preq in preqs:
+            if id(preq) not in seen and not (skip and skip(preq)):
+                seen.add(id(preq))
+                stack.append((preq, iter(getattr(preq, 'requires', ()))))
+                break
+        else:
+            stack.pop()
+            order.append(req)
+    return order
+
+
+def iter_reqs(root):
+    """Yield *root* and every requirement below it, each exactly once."""
+    seen = {root}
+    stack = [root]
+    while stack:
+        req = stack.pop()
+        yield req
+        for preq in getattr(req, 'requires', ()):
+            if preq not in seen:
+                seen.add(preq)
+                stack.append(preq)
+
+
+# Guards the creation of Req.err_event.
+_EVENT_LOCK = threading.Lock()
+
+
+class Req():
+    """The base class for all requirements.
+
+    Graphs can have millions of requirements, so they have no __dict__,
+    their targets are interned, and their err_event is only created when
+    it is first used.
+
+    """
+
+    __slots__ = ('trgt', 'session', 'checked', 'check_result', '_err_event')
+
+    def __init__(self, trgt, session=None):
+        """Create a new Req object for trgt.
+
+        *session* - [optional] the BuildSession to register the Req in
+                    (DEFAULT: a new BuildSession)
+
+        """
+        self.trgt = trgt = sys.intern(trgt)
+        if session is None:
+            session = BuildSession()
+        self.session = session
+        session.instances[trgt] = self
+        self._err_event = None
+        self.checked = False
+        self.check_result = None
+
+    @property
+    def err_event(self):
+        """A threading.Event which is set if the requirement failed."""
+        if self._err_event is None:
+            with _EVENT_LOCK:
+                if self._err_event is None:
+                    self._err_event = threading.Event()
+        return self._err_event
+
+    def failed(self):
+        """Return if the requirement failed, without creating an Event."""
+        return self._err_event is not None and self._err_event.is_set()
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.trgt!r})".format(self=self)
+
+    def __str__(self):
+##        return "{self.__class__.__name__}({self.trgt!r})".format(self=self)
+        return Req.__repr__(self)
+
+    def formatted(self):
+        return self.__str__()
+
+    def __eq__(self, other):
+        """req1 == req2 <==> req1.trgt == req2.trgt"""
+        return self.trgt == other.trgt
+
+    def trgt_exists(self):
+        return self.session.stat_cache.exists(self.trgt)
+
+    def __hash__(self):
+        return hash(self.trgt)
+
+    def last_update(self):
+        """Return the last time *trgt* was updated."""
+        raise NotImplementedError("last_update() has not been implemented "
+                                  "for this class, which is therefore not "
+                                  "a functioning Req subclass.")
+
+    def check_uptodate(self):
+        """Determine if the requirement needs to be updated.
+
+        Every requirement below this one is evaluated first, exactly once,
+        in post-order and without recursion; see evaluate().  Returns the
+        result of evaluate() for this requirement.
+
+        """
+        if not self.checked:
+            for req in postorder(self, skip=lambda req: req.checked):
+                req.check_result = req.evaluate()
+                req.checked = True
+        return self.check_result
+
+    def evaluate(self):
+        """Determine if the requirement needs to be updated, given that all
+        of its prerequisites have been checked.
+
+        """
+        raise NotImplementedError("evaluate() has not been "
+                                  "implemented for this class, which is "
+                                  "therefore not a functioning Req subclass.")
+
+
+class FileReq(Req):
+    """Subclass of Req for files."""
+
+    __slots__ = ()
+
+    def last_update(self):
+        """Return the last time the file, *trgt*, was updated.
+
+        Returns float('nan') if *trgt* does not exist.
+
+        """
+        return self.session.stat_cache.getmtime(self.trgt)
+
+    def evaluate(self):
+        """Return the last time *self.trgt* was updated.
+
+        Since FileReq objects are always up-to-date if they exist,
+        this doesn't actually set a property.deleter(
+
+        It just returns the last update time for recursive purposes.  In
+        content-hash mode it returns whether the file exists.
+
+        """
+        if self.session.state_db is not None:
+            return self.trgt_exists()
+        return self.last_update()
+
+    def content_id(self):
+        """Return the hash of the contents of *trgt*, or None if missing."""
+        return self.session.file_hash(self.trgt)
+
+    def run(self, **kwargs):
+        """Ensure that *self.trgt* exists, and return True.
+
+        Like HierReq.run(), so make() succeeds for an existing file.
+
+        """
+        if not self.trgt_exists():
+            self.err_event.set()
+            raise ValueError(("{self.trgt!r} not found. "
+                              "Did you expect this file to exist? "
+                              "Maybe you're missing a rule...?").\
+                             format(self=self))
+        debug("{self!s} exists", self=self)
+        return True
+
+
+def of_non_nan(func, iterable):
+    """Return the value of func for non-NaN elements of *iterable*.
+
+    If all values are NaN or iterable is of length zero, return NaN.
+
+    """
+    non_nan_vals = [val for val in iterable if not math.isnan(val)]
+    if non_nan_vals:
+        return func(non_nan_vals)
+    else:
+        return float('nan')
+
+
+class HierReq(Req):
+    """Subclass of Req for any target that is runnable or has prerequisites.
+
+    """
+
+    __slots__ = ('requires', 'rule', 'uptodate', 'done', '_cached_max_usts')
+
+    order_only = False
+
+    def __init__(self, trgt, requires, rule=None, session=None):
+        """Create a new HierReq object for *trgt*, given *requires*.
+
+        *rule* - [optional] the Rule which the requirement was made from
+
+        """
+        super(HierReq, self).__init__(trgt, session=session)
+        self.requires = tuple(requires)
+        self.rule = rule
+        self.uptodate = False
+        self.done = False
+
+    def __repr__(self):
+        return super(HierReq, self).__repr__().rstrip(')') + \
+               ", {self.requires})".format(self=self)
+
+    def formatted(self):
+        """Return a pretty-formatted description of the Req."""
+        out_string = super(HierReq, self).formatted()
+        out_string += "\n  |UP TO DATE| {}".format(self.uptodate)
+        req_strings = []
+        for req in self.requires:
+            for line in req.formatted().split('\n'):
+                req_strings += ["    {}".format(line)]
+        if req_strings:
+            out_string += '\n'.join(["\n  |REQUIRES|"] + req_strings)
+        return out_string
+
+
+    def evaluate(self):
+        """Determine if the requirement needs to be updated.
+
+        An update is required if any upstream requirements exist and
+        they are newer than *trgt*, or if neither upstream requirements
+        nor *trgt* exist.
+
+        """
+        if self.session.state_db is not None:
+            return self.check_hashes()
+        if self.uptodate:
+            debug(("{self!s} is flagged up-to-date and will not be "
+                   "re-checked."), self=self)
+            if not self.order_only:
+                return self.last_update()
+            else:
+                return self._cached_max_usts
+        last_update = self.last_update()
+        self._cached_max_usts = max_usts = \
+                of_non_nan(max, (preq.check_result
+                                  for preq in self.requires))
+        if not self.trgt_exists():
+            debug(("since {self.trgt!r} does not exist, flagging "
+                   "{self!s} as not up-to-date"), self=self)
+            self.uptodate = False
+            return max_usts
+        elif math.isnan(max_usts):
+            debug(("since {self.trgt!r} exists, and no preqs exist, "
+                   "flagging {self!s} as up-to-date"), self=self)
+            self.uptodate = True
+            if not self.order_only:
+                return last_update
+            else:
+                return max_usts
+        elif last_update > max_usts:
+            debug(("{self.trgt!r} is newer than all preqs; "
+                   "flagging {self!s} as up-to-date."), self=self)
+            self.uptodate = True
+            if not self.order_only:
+                return last_update
+            else:
+                return max_usts
+        elif last_update <= max_usts:
+            debug(("{self.trgt!r} is not newer ({}) than at least "
+                   "one preq (max={}); flagging {self!s} as not "
+                   "up-to-date."), last_update, max_usts, self=self)
+            self.uptodate = False
+            return max_usts
+        else:
+            raise ValueError(("Somehow the up-to-date status of {self!s} "
+                              "cannot be determined.").format(self=self))
+
+    def check_hashes(self):
+        """Determine by content if the requirement needs to be updated.
+
+        The requirement is up-to-date if the recipe and the contents of its
+        prerequisites and of *trgt* are all what they were when it was last
+        built.  Returns whether the contents of *trgt* will stay the same
+        in this build.
+
+        """
+        if self.uptodate:
+            return True
+        stable = all(preq.check_result for preq in self.requires)
+        self.uptodate = stable and self.matches_record()
+        debug("flagging {self!s} as {state}up-to-date",
+              self=self, state="" if self.uptodate else "not ")
+        return self.uptodate
+
+    def inputs_signature(self):
+        """Return a hash of the names and contents of the prerequisites.
+
+        Returns None if any prerequisite is missing.
+
+        """
+        ids = []
+        for preq in self.requires:
+            content_id = preq.content_id()
+            if content_id is None:
+                return None
+            ids += [preq.trgt, content_id]
+        return signature(ids)
+
+    def matches_record(self):
+        """Return if the state database shows that *trgt* is current."""
+        return False
+
+    def do(self, **kwargs):
+        """Execute the work defined for the requirement.""" 
+        raise NotImplementedError("do() has not been implemented "
+                                  "for this class, which is therefore not "
+                                  "a functioning HierReq subclass.")
+
+    def run(self, jobs=None, parallel=True, engine="threads", **kwargs):
+        """Run the requirement and all of its prerequisites.
+
+        Requirements which are already up-to-date are not run and neither are
+        their prerequisites.  At most *jobs* recipes are executed at once;
+        *parallel*=False is equivalent to *jobs*=1.  *engine* is one of
+        ENGINES; see make_scheduler().  Returns True if everything finished
+        without errors.
+
+        """
+        if not parallel:
+            jobs = 1
+        return make_scheduler(engine, jobs=jobs, **kwargs).run(self)
+
+
+class TaskReq(HierReq, FileReq):
+    """Subclass of HierReq for a requirement which involves _doing_ something.
+
+    A TaskReq may have several *outputs*, all made by one run of the
+    recipe.  It is then named by the first of them and is only up-to-date
+    if all of them exist and the oldest is newer than the prerequisites.
+
+    """
+
+    __slots__ = ('order_only', '_recipe', '_outputs')
+
+    def __init__(self, trgt, requires, recipe=None, order_only=False,
+                 rule=None, session=None, outputs=None):
+        """Create a new TaskReq.
+
+        *recipe* - [optional] the filled recipe (DEFAULT: filled from
+                   *rule* when it is first needed)
+        *outputs* - [optional] every file the recipe makes, starting with
+                    *trgt* (DEFAULT: just *trgt*)
+
+        """
+        if recipe is None and rule is None:
+            raise ValueError("a TaskReq needs a recipe or a rule")
+        self.order_only = order_only
+        self._recipe = recipe
+        super(TaskReq, self).__init__(trgt, requires, rule=rule,
+                                      session=session)
+        self._outputs = None
+        if outputs and len(outputs) > 1:
+            self._outputs = tuple(sys.intern(output) for output in outputs)
+            for output in self._outputs[1:]:
+                self.session.instances[output] = self
+
+    @property
+    def recipe(self):
+        """The recipe, filled from the rule the first time it is used."""
+        if self._recipe is None:
+            groups = self.rule._match(self.trgt)
+            self._recipe = self.rule.get_recipe(self.trgt, groups)
+        return self._recipe
+
+    @property
+    def outputs(self):
+        """Every file the recipe makes, starting with *trgt*."""
+        if self._outputs is None:
+            return (self.trgt,)
+        return self._outputs
+
+    def trgt_exists(self):
+        """Return if all of the outputs exist."""
+        return all(self.session.stat_cache.exists(output)
+                   for output in self.outputs)
+
+    def last_update(self):
+        """Return the last time the oldest output was updated.
+
+        Returns float('nan') if any output does not exist.
+
+        """
+        if len(self.outputs) == 1:
+            return super(TaskReq, self).last_update()
+        times = [self.session.stat_cache.getmtime(output)
+                 for output in self.outputs]
+        if any(math.isnan(mtime) for mtime in times):
+            return float('nan')
+        return min(times)
+
+    def content_id(self):
+        """Return a hash of the contents of the outputs, or None if any is
+        missing.
+
+        """
+        if len(self.outputs) == 1:
+            return super(TaskReq, self).content_id()
+        ids = []
+        for output in self.outputs:
+            content_id = self.session.file_hash(output)
+            if content_id is None:
+                return None
+            ids += [output, content_id]
+        return signature(ids)
+
+    @contextlib.contextmanager
+    def _backup(self):
+        """Back up all outputs while the recipe runs, and forget what was
+        known about them afterwards.
+
+        """
+        try:
+            with contextlib.ExitStack() as stack:
+                for output in self.outputs:
+                    stack.enter_context(backup(output,
+                                               append="~pymake-backup",
+                                               prepend=".",
+                                               on_fail=os.remove))
+                yield
+        finally:
+            for output in self.outputs:
+                self.session.stat_cache.invalidate(output)
+
+
+    def __repr__(self):
+        return super(TaskReq, self).__repr__().rstrip(')') + \
+               (", {self.recipe!r}, order_only={self.order_only})").\
+               format(self=self)
+
+    def formatted(self):
+        """Return a pretty-formatted description of the Req."""
+        out_string = super(TaskReq, self).formatted()
+        recipe_strings = []
+        for line in self.recipe.split('\n'):
+            recipe_strings += ["    {}".format(line)]
+        out_string += '\n'.join(["\n  |RECIPE|"] + recipe_strings)
+        return out_string
+
+
+    def matches_record(self):
+        """Return if the state database shows that *trgt* is current.
+
+        That is, *trgt* exists and was built by the same recipe from
+        prerequisites with the same contents, and has not changed since.
+
+        """
+        if not self.trgt_exists():
+            return False
+        elif self.order_only:
+            return True
+        record = self.session.state_db.get_target(self.trgt)
+        return record is not None and \
+               record == (self.recipe, self.inputs_signature(),
+                          self.content_id())
+
+    def resources(self):
+        """Return the number of CPUs and the bytes of memory the recipe
+        uses.
+
+        """
+        if self.rule is None:
+            return 1, 0
+        return self.rule.resources()
+
+    def record_state(self):
+        """Record the recipe and contents that *trgt* was built from."""
+        self.session.state_db.set_target(self.trgt, self.recipe,
+                                self.inputs_signature(), self.content_id())
+
+    def do(self, execute=True, print_out=True, runner=None,
+           output="stream", log_dir=LOG_DIR, **kwargs):
+        """Print and execute the recipe.
+
+        *runner* - [optional] what executes the recipe (DEFAULT: a
+                   LocalRunner)
+        *output* - how the output of the recipe is handled; one of the
+                   OUTPUT_MODES (see LocalRunner)
+        *log_dir* - where the log files go in "log" mode
+
+        """
+        if self.order_only and self.trgt_exists():
+            LOG.debug("order-only requirement; will not be executed")
+        else:
+            LOG.info(self.recipe)
+            if execute:
+                with self._backup():
+                    if runner is None:
+                        runner = LocalRunner()
+                    log_file = None
+                    if output == "log":
+                        log_file = log_path(self.trgt, log_dir)
+                    returncode = runner.run(self.recipe, print_out=print_out,
+                                            output=output, log_file=log_file)
+                    if returncode != 0:
+                        self.err_event.set()
+                        raise subprocess.CalledProcessError(returncode,
+                                                            self.recipe)
+
+    async def do_async(self, execute=True, print_out=True, runner=None,
+                       output="stream", log_dir=LOG_DIR, **kwargs):
+        """Like do(), but as a coroutine, using the run_async() method of
+        *runner*.
+
+        """
+        if self.order_only and self.trgt_exists():
+            LOG.debug("order-only requirement; will not be executed")
+        else:
+            LOG.info(self.recipe)
+            if execute:
+                with self._backup():
+                    if runner is None:
+                        runner = LocalRunner()
+                    log_file = None
+                    if output == "log":
+                        log_file = log_path(self.trgt, log_dir)
+                    returncode = await runner.run_async(
+                            self.recipe, print_out=print_out, output=output,
+                            log_file=log_file)
+                    if returncode != 0:
+                        self.err_event.set()
+                        raise subprocess.CalledProcessError(returncode,
+                                                            self.recipe)
+
+
+class DummyReq(HierReq):
+    """Subclass of HierReq for a requirement which has preqs, but no recipe.
+
+    """
+
+    __slots__ = ()
+
+    def last_update(self):
+        return float('nan')
+
+    def check_hashes(self):
+        """Return whether the contents of all prerequisites will stay the
+        same in this build.
+
+        """
+        return all(preq.check_result for preq in self.requires)
+
+    def content_id(self):
+        """Return a hash of the contents of the prerequisites."""
+        return self.inputs_signature()
+
+    def do(self, **kwargs):
+        LOG.info("**finished {self.trgt!r}**".format(self=self))
+
+
+def batch_script(reqs, status_path):
+    """Return a shell script running the recipe of each of *reqs* in turn.
+
+    Each recipe runs in a subshell, after which a line with the position
+    of the task and its exit status is appended to *status_path*.
+
+    """
+    return "\n".join("(\n{recipe}\n)\necho {i} $? >> {path}".\
+                     format(recipe=req.recipe, i=i,
+                            path=shlex.quote(status_path))
+                     for i, req in enumerate(reqs))
+
+
+def members(job):
+    """Return the TaskReq objects in *job*, a TaskReq or TaskBatch."""
+    return getattr(job, 'reqs', [job])
+
+
+class TaskBatch():
+    """TaskReq objects made from one rule, run by one shell process.
+
+    Without a *batch_recipe* for the rule, the recipes of the tasks are run
+    one after another, each in a subshell, and each task succeeds or fails
+    by its own exit status.  With one, the batch recipe is run instead; if
+    it fails, only the tasks all of whose outputs were made succeed.
+    Either way, the outputs of each task are backed up, and restored if
+    the task fails, separately.
+
+    """
+
+    def __init__(self, reqs):
+        """Create a new TaskBatch of the TaskReq objects *reqs*."""
+        self.reqs = reqs
+        self.rule = reqs[0].rule
+        self.session = reqs[0].session
+        self.trgt = "{} (+{} batched)".format(reqs[0].trgt, len(reqs) - 1)
+        self.errors = {}
+
+    def __repr__(self):
+        return "{self.__class__.__name__}({self.trgt!r})".format(self=self)
+
+    def resources(self):
+        """Return the number of CPUs and the bytes of memory the batch
+        uses.
+
+        """
+        return self.rule.resources()
+
+    def _statuses(self, reqs, returncode, status_path):
+        """Return the exit status of each of *reqs*."""
+        if status_path is None:
+            if returncode == 0:
+                return [0] * len(reqs)
+            # The previous outputs were moved aside by the backups, so
+            # every output which exists now was made by the batch.
+            return [0 if req.trgt_exists() else returncode for req in reqs]
+        statuses = [returncode or 1] * len(reqs)
+        with open(status_path) as handle:
+            for line in handle:
+                i, status = line.split()
+                statuses[int(i)] = int(status)
+        return statuses
+
+    def do(self, reqs=None, execute=True, print_out=True, runner=None,
+           output="stream", log_dir=LOG_DIR, **kwargs):
+        """Print and execute the recipes.
+
+        *reqs* - [optional] the tasks to run (DEFAULT: all of them)
+
+        The tasks which fail are added to *self.errors*, with the
+        exception for each.
+
+        """
+        if reqs is None:
+            reqs = self.reqs
+        status_path = None
+        if self.rule.batch_recipe:
+            recipe = self.rule.get_batch_recipe(reqs)
+            LOG.info(recipe)
+        else:
+            for req in reqs:
+                LOG.info(req.recipe)
+        if not execute:
+            return
+        if not self.rule.batch_recipe:
+            os.makedirs(self.session.state_dir, exist_ok=True)
+            fd, status_path = tempfile.mkstemp(prefix="batch-",
+                                               dir=self.session.state_dir)
+            os.close(fd)
+            recipe = batch_script(reqs, status_path)
+        backups = [req._backup() for req in reqs]
+        for context in backups:
+            context.__enter__()
+        try:
+            if runner is None:
+                runner = LocalRunner()
+            log_file = None
+            if output == "log":
+                log_file = log_path(reqs[0].trgt, log_dir)
+            returncode = runner.run(recipe, print_out=print_out,
+                                    output=output, log_file=log_file)
+            for req in reqs:
+                for path in req.outputs:
+                    self.session.stat_cache.invalidate(path)
+            statuses = self._statuses(reqs, returncode, status_path)
+        except BaseException as err:
+            for context in backups:
+                context.__exit__(type(err), err, err.__traceback__)
+            raise
+        finally:
+            if status_path is not None:
+                os.remove(status_path)
+        for req, context, status in zip(reqs, backups, statuses):
+            if status == 0:
+                context.__exit__(None, None, None)
+            else:
+                err = subprocess.CalledProcessError(status, req.recipe)
+                req.err_event.set()
+                self.errors[req] = err
+                context.__exit__(type(err), err, None)
+
+
+def default_jobs():
+    """Return the default number of concurrent jobs (the CPU count)."""
+    return os.cpu_count() or 1
+
+
+def log_path(trgt, log_dir=LOG_DIR):
+    """Return the file in *log_dir* which the output for *trgt* goes to.
+
+    >>> log_path("out/a.txt", "logs")
+    'logs/out%2Fa.txt.log'
+
+    """
+    return os.path.join(log_dir, urllib.parse.quote(trgt, safe="") + ".log")
+
+
+def tail_lines(lines, count):
+    """Return the last *count* of *lines*, keeping no more than that.
+
+    >>> tail_lines(iter("abcde"), 2)
+    ['d', 'e']
+
+    """
+    return list(collections.deque(lines, maxlen=count))
+
+
+def tail_file(path, count, block=1 << 16):
+    """Return the last *count* lines of the file at *path*.
+
+    Only the final *block* bytes are read.
+
+    """
+    try:
+        with open(path, 'rb') as handle:
+            handle.seek(max(0, os.fstat(handle.fileno()).st_size - block))
+            return [line.decode(errors='replace')
+                    for line in tail_lines(handle, count)]
+    except OSError:
+        return []
+
+
+def read_output(fd, chunk=1 << 16):
+    """Read all of the file descriptor *fd*, in big chunks, and decode it."""
+    chunks = []
+    while True:
+        data = os.read(fd, chunk)
+        if not data:
+            break
+        chunks.append(data)
+    return b"".join(chunks).decode(errors='replace')
+
+
+def log_tail(lines, log_file):
+    """Log the final *lines* of *log_file* from a failed recipe."""
+    LOG.error("last lines of {}:\n{}".format(log_file,
+                                             "".join(lines).rstrip("\n")))
+
+
+class LocalRunner():
+    """Run recipes in shell processes on this machine.
+
+    The combined stdout and stderr of a recipe is handled in one of the
+    OUTPUT_MODES:
+
+    "stream" - each line is logged as it is written
+    "buffer" - all of the output is logged in one block once the recipe
+               finishes, so the output of parallel recipes never interleaves
+    "log" - the output goes straight to a log file; nothing is copied
+            through Python
+    "none" - the output is thrown away without being read
+
+    In "log" mode, the last *tail* lines of the log file are logged when a
+    recipe fails.
+
+    """
+
+    tail = 20
+    read_size = 1 << 16
+
+    def __init__(self, jobs=None):
+        """Create a new LocalRunner.
+
+        *jobs* - [optional] the number of recipes which can run at once
+                 (DEFAULT: the number of CPUs)
+
+        """
+        self.jobs = jobs or default_jobs()
+
+    def slots(self):
+        """Return the number of recipes which can run at once."""
+        return self.jobs
+
+    def run(self, recipe, print_out=True, output="stream", log_file=None):
+        """Run *recipe* in a shell and return its exit status.
+
+        *print_out* - if not set, the output is handled as in "none" mode
+        *output* - one of the OUTPUT_MODES
+        *log_file* - where the output goes in "log" mode
+
+        """
+        if not print_out or output == "none":
+            return subprocess.call(recipe, shell=True,
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.STDOUT)
+        if output == "log":
+            os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+            with open(log_file, 'wb') as handle:
+                status = subprocess.call(recipe, shell=True, stdout=handle,
+                                         stderr=subprocess.STDOUT)
+            if status != 0:
+                log_tail(tail_file(log_file, self.tail), log_file)
+            return status
+        proc = subprocess.Popen(recipe, shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        with proc.stdout:
+            if output == "buffer":
+                text = read_output(proc.stdout.fileno())
+                if text:
+                    LOG.info(text.rstrip("\n"))
+            else:
+                for encoded_line in proc.stdout:
+                    LOG.info(encoded_line.decode(errors='replace').\
+                             rstrip("\n"))
+        return proc.wait()
+
+    async def run_async(self, recipe, print_out=True, output="stream",
+                        log_file=None):
+        """Like run(), but as a coroutine waiting on an asyncio subprocess.
+
+        """
+        if not print_out or output == "none":
+            proc = await asyncio.create_subprocess_shell(
+                    recipe, stdout=subprocess.DEVNULL,
+                    stderr=subprocess.STDOUT)
+            return await proc.wait()
+        if output == "log":
+            os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+            with open(log_file, 'wb') as handle:
+                proc = await asyncio.create_subprocess_shell(
+                        recipe, stdout=handle, stderr=subprocess.STDOUT)
+            status = await proc.wait()
+            if status != 0:
+                log_tail(tail_file(log_file, self.tail), log_file)
+            return status
+        proc = await asyncio.create_subprocess_shell(
+                recipe, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        try:
+            if output == "buffer":
+                text = (await proc.stdout.read()).decode(errors='replace')
+                if text:
+                    LOG.info(text.rstrip("\n"))
+            else:
+                # Split the lines here: StreamReader.readline() fails on
+                # lines longer than its buffer.
+                parts = []
+                while True:
+                    chunk = await proc.stdout.read(self.read_size)
+                    if not chunk:
+                        break
+                    *lines, rest = chunk.split(b"\n")
+                    for encoded_line in lines:
+                        parts.append(encoded_line)
+                        LOG.info(b"".join(parts).decode(errors='replace'))
+                        parts = []
+                    if rest:
+                        parts.append(rest)
+                if parts:
+                    LOG.info(b"".join(parts).decode(errors='replace'))
+        finally:
+            status = await proc.wait()
+        return status
+
+    def close(self):
+        """Release any resources held by the runner."""
+        pass
+
+
+class PoolShell():
+    """A long-lived shell process which reads recipes on its stdin."""
+
+    def __init__(self, shell="/bin/sh"):
+        self.proc = subprocess.Popen([shell], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        self.token = "__pymake_done_{}__".format(os.urandom(8).hex())
+
+    def close(self):
+        try:
+            self.proc.stdin.write(b"exit\n")
+            self.proc.stdin.close()
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc.stdout.close()
+
+
+class ShellPoolRunner(LocalRunner):
+    """Run recipes on a pool of persistent shells on this machine.
+
+    Rather than starting a new shell for each recipe, each of *jobs* shells
+    is sent recipes one at a time over a pipe.  A recipe runs in a subshell
+    of its shell, in the current working directory and with nothing on its
+    stdin, so a `cd`, `export` or `exit` in one recipe does not carry over
+    to the next.  The shells inherit the environment as it was when the
+    pool started.
+
+    The output modes are those of LocalRunner.  The end of a recipe's
+    output, and its exit status, are marked by a line with a token unique
+    to the shell.  A shell which dies is replaced, and the recipe it was
+    running fails with the shell's exit status.
+
+    """
+
+    def __init__(self, jobs=None, shell="/bin/sh"):
+        """Create a new ShellPoolRunner.
+
+        *jobs* - [optional] the number of shells, and so recipes which can
+                 run at once (DEFAULT: the number of CPUs)
+        *shell* - the shell to run (DEFAULT: /bin/sh)
+
+        """
+        super(ShellPoolRunner, self).__init__(jobs)
+        self.shell = shell
+        self.idle = queue.LifoQueue()
+        self.shells = []
+        self.lock = threading.Lock()
+        # For run_async(); the event loop's default executor may have
+        # fewer threads than there are shells.
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.jobs, thread_name_prefix="pymake-shell")
+        for _ in range(self.jobs):
+            self.idle.put(self._start_shell())
+
+    def _start_shell(self):
+        shell = PoolShell(self.shell)
+        with self.lock:
+            self.shells.append(shell)
+        return shell
+
+    def _script(self, shell, recipe, output, log_file):
+        """Return the line which runs *recipe* in a subshell of *shell*."""
+        if output == "none":
+            redirect = " >/dev/null 2>&1"
+        elif output == "log":
+            redirect = " >{} 2>&1".format(shlex.quote(
+                    os.path.abspath(log_file)))
+        else:
+            redirect = ""
+        return ("(cd {} && eval {}) </dev/null{}; "
+                "printf '\\n%s %d\\n' {} \"$?\"\n").\
+               format(shlex.quote(os.getcwd()), shlex.quote(recipe),
+                      redirect, shell.token).encode()
+
+    def _communicate(self, shell, script, output):
+        """Send *script* to *shell*, handle its output and return its status.
+
+        Returns None if the shell died.
+
+        """
+        try:
+            shell.proc.stdin.write(script)
+            shell.proc.stdin.flush()
+        except OSError:
+            return None
+        marker = shell.token.encode() + b" "
+        chunks = []
+        held = None
+        for encoded_line in shell.proc.stdout:
+            if encoded_line.startswith(marker):
+                # The newline before the marker ended the last line.
+                if held is not None:
+                    chunks.append(held[:-1])
+                if chunks and output in ("stream", "buffer"):
+                    text = b"".join(chunks).decode(errors='replace')
+                    if text:
+                        LOG.info(text.rstrip("\n"))
+                return int(encoded_line[len(marker):])
+            if held is not None:
+                if output == "stream":
+                    LOG.info(held.decode(errors='replace').rstrip("\n"))
+                else:
+                    chunks.append(held)
+            held = encoded_line
+        return None
+
+    def run(self, recipe, print_out=True, output="stream", log_file=None):
+        """Run *recipe* on an idle shell and return its exit status.
+
+        *print_out*, *output* and *log_file* are as for LocalRunner.run().
+        Blocks until a shell is idle.
+
+        """
+        if not print_out:
+            output = "none"
+        if output == "log":
+            os.makedirs(os.path.dirname(log_file) or ".", exist_ok=True)
+        shell = self.idle.get()
+        status = self._communicate(
+                shell, self._script(shell, recipe, output, log_file), output)
+        if status is None:
+            status = shell.proc.wait() or 127
+            LOG.warning("a pool shell exited with status {}; starting "
+                        "another".format(status))
+            with self.lock:
+                self.shells.remove(shell)
+            shell.close()
+            shell = self._start_shell()
+        self.idle.put(shell)
+        if status != 0 and output == "log":
+            log_tail(tail_file(log_file, self.tail), log_file)
+        return status
+
+    async def run_async(self, recipe, print_out=True, output="stream",
+                        log_file=None):
+        """Like run(), but as a coroutine, waiting for run() in a thread
+        of the runner's own, one per shell.
+
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(
+                        self.run, recipe, print_out=print_out,
+                        output=output, log_file=log_file))
+
+    def close(self):
+        """Stop all of the shells."""
+        self.executor.shutdown()
+        with self.lock:
+            shells, self.shells = self.shells, []
+        for shell in shells:
+            shell.close()
+
+
+def parse_address(address):
+    """Return the socket family and address for *address*.
+
+    *address* is "HOST:PORT" for TCP or otherwise the path of a Unix socket.
+
+    >>> parse_address("localhost:8000")
+    (<AddressFamily.AF_INET: 2>, ('localhost', 8000))
+    >>> parse_address("/tmp/pymake.sock")
+    (<AddressFamily.AF_UNIX: 1>, '/tmp/pymake.sock')
+
+    """
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        return socket.AF_INET, (host or "localhost", int(port))
+    return socket.AF_UNIX, address
+
+
+class Connection():
+    """A socket carrying newline-delimited JSON messages."""
+
+    def __init__(self, sock):
+        """Wrap the connected socket *sock*."""
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        """Send *message*; safe to call from several threads."""
+        data = (json.dumps(message) + "\n").encode()
+        with self.lock:
+            self.sock.sendall(data)
+
+    def __iter__(self):
+        """Yield messages until the connection is closed."""
+        for line in self.reader:
+            yield json.loads(line)
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+
+class RemoteWorker():
+    """What a RemoteRunner knows about a connected worker."""
+
+    def __init__(self, name, slots):
+        self.name = name
+        self.slots = slots
+        self.free = slots
+        self.jobs = set()
+
+
+class RemoteJob():
+    """A recipe sent to a worker by a RemoteRunner."""
+
+    def __init__(self, output):
+        self.output = output
+        self.chunks = []
+        self.returncode = None
+        self.finished = threading.Event()
+
+
+class RemoteRunner():
+    """Run recipes on pymake-worker processes connected over sockets.
+
+    Workers connect to *address*, say how many slots they have, and are
+    sent recipes, with the working directory to run them in, while they
+    have free slots.  Their output and exit status are streamed back,
+    except in "log" mode, where workers write the log files themselves,
+    and "none" mode, where the output is never read.  A filesystem shared
+    with the workers is assumed.
+
+    """
+
+    def __init__(self, address):
+        """Listen for workers on *address* (see parse_address())."""
+        family, self.address = parse_address(address)
+        self.server = socket.socket(family, socket.SOCK_STREAM)
+        if family == socket.AF_INET:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        elif os.path.exists(self.address) and \
+                stat.S_ISSOCK(os.stat(self.address).st_mode):
+            os.remove(self.address)
+        self.server.bind(self.address)
+        self.server.listen()
+        self.lock = threading.Condition()
+        self.workers = {}
+        self.jobs = {}
+        self.job_ids = itertools.count()
+        self.closing = False
+        threading.Thread(target=self._accept, name="pymake-coordinator",
+                         daemon=True).start()
+        LOG.info("waiting for workers on {}".format(address))
+
+    def slots(self):
+        """Return the total number of slots of the connected workers."""
+        with self.lock:
+            return sum(worker.slots for worker in self.workers.values())
+
+    def _accept(self):
+        while True:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(Connection(sock),),
+                             daemon=True).start()
+
+    def _serve(self, conn):
+        """Handle the messages from one worker."""
+        worker = None
+        try:
+            for message in conn:
+                if message['op'] == 'hello':
+                    worker = RemoteWorker(message['name'], message['slots'])
+                    with self.lock:
+                        self.workers[conn] = worker
+                        self.lock.notify_all()
+                    LOG.info("worker {} joined with {} slots".\
+                             format(worker.name, worker.slots))
+                elif message['op'] == 'output':
+                    job = self.jobs[message['id']]
+                    if job.output == "buffer":
+                        job.chunks.append(message['data'])
+                    else:
+                        LOG.info(message['data'].rstrip("\n"))
+                elif message['op'] == 'exit':
+                    job = self.jobs[message['id']]
+                    job.returncode = message['status']
+                    with self.lock:
+                        worker.free += 1
+                        worker.jobs.discard(message['id'])
+                        self.lock.notify_all()
+                    job.finished.set()
+        except (OSError, ValueError, KeyError) as err:
+            debug("error reading from a worker: {}", err)
+        finally:
+            with self.lock:
+                worker = self.workers.pop(conn, None)
+                jobs = [] if worker is None else \
+                       [self.jobs[job_id] for job_id in worker.jobs
+                        if job_id in self.jobs]
+            if worker is not None and not self.closing:
+                LOG.warning("worker {} left".format(worker.name))
+                for job in jobs:
+                    job.finished.set()
+            conn.close()
+
+    def run(self, recipe, print_out=True, output="stream", log_file=None):
+        """Run *recipe* on the least busy worker and return its exit status.
+
+        *print_out*, *output* and *log_file* are as for LocalRunner.run().
+        Blocks until a worker has a free slot.  Raises ConnectionError if
+        the worker leaves before the recipe finishes.
+
+        """
+        if not print_out:
+            output = "none"
+        job = RemoteJob(output)
+        with self.lock:
+            while True:
+                free = [conn for conn, worker in self.workers.items()
+                        if worker.free > 0]
+                if free:
+                    break
+                self.lock.wait()
+            conn = max(free, key=lambda conn: self.workers[conn].free)
+            worker = self.workers[conn]
+            worker.free -= 1
+            job_id = next(self.job_ids)
+            worker.jobs.add(job_id)
+            self.jobs[job_id] = job
+        try:
+            conn.send(op='run', id=job_id, recipe=recipe, cwd=os.getcwd(),
+                      output=output, log_file=log_file)
+        except Exception:
+            # Give the slot back, or it is lost for the rest of the run.
+            with self.lock:
+                worker.free += 1
+                worker.jobs.discard(job_id)
+                del self.jobs[job_id]
+                self.lock.notify_all()
+            raise
+        try:
+            job.finished.wait()
+        finally:
+            with self.lock:
+                del self.jobs[job_id]
+        if job.chunks:
+            LOG.info("".join(job.chunks).rstrip("\n"))
+        if job.returncode is None:
+            raise ConnectionError("worker {} left while running the recipe".\
+                                  format(worker.name))
+        if job.returncode != 0 and output == "log":
+            log_tail(tail_file(log_file, LocalRunner.tail), log_file)
+        return job.returncode
+
+    def close(self):
+        """Stop listening and disconnect all workers."""
+        self.closing = True
+        self.server.close()
+        with self.lock:
+            conns = list(self.workers)
+        for conn in conns:
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+
+def _work(conn, message):
+    """Run the recipe in *message* and report back over *conn*."""
+    output = message.get('output', "stream")
+    try:
+        if output == "none":
+            status = subprocess.call(message['recipe'], shell=True,
+                                     cwd=message['cwd'],
+                                     stdout=subprocess.DEVNULL,
+                                     stderr=subprocess.STDOUT)
+        elif output == "log":
+            log_file = os.path.join(message['cwd'], message['log_file'])
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+            with open(log_file, 'wb') as handle:
+                status = subprocess.call(message['recipe'], shell=True,
+                                         cwd=message['cwd'], stdout=handle,
+                                         stderr=subprocess.STDOUT)
+        else:
+            proc = subprocess.Popen(message['recipe'], shell=True,
+                                    cwd=message['cwd'],
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+            with proc.stdout:
+                if output == "buffer":
+                    conn.send(op='output', id=message['id'],
+                              data=read_output(proc.stdout.fileno()))
+                else:
+                    for encoded_line in proc.stdout:
+                        conn.send(op='output', id=message['id'],
+                                  data=encoded_line.decode(errors='replace'))
+            status = proc.wait()
+    except OSError as err:
+        conn.send(op='output', id=message['id'], data=str(err))
+        status = 127
+    conn.send(op='exit', id=message['id'], status=status)
+
+
+def run_worker(address, slots=None, retry=1.0, once=False):
+    """Run recipes sent by a pymake coordinator listening on *address*.
+
+    Announces *slots* (DEFAULT: the number of CPUs) and runs each recipe
+    sent in its own thread.  When the coordinator goes away, connects
+    again every *retry* seconds, unless *once* is set.
+
+    """
+    slots = slots or default_jobs()
+    family, sock_address = parse_address(address)
+    name = "{}:{}".format(socket.gethostname(), os.getpid())
+    while True:
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.connect(sock_address)
+        except OSError:
+            sock.close()
+            time.sleep(retry)
+            continue
+        LOG.info("connected to {}".format(address))
+        conn = Connection(sock)
+        try:
+            conn.send(op='hello', name=name, slots=slots)
+            for message in conn:
+                if message['op'] == 'run':
+                    LOG.debug(message['recipe'])
+                    threading.Thread(target=_work, args=(conn, message),
+                                     daemon=True).start()
+        except OSError as err:
+            debug("lost the connection: {}", err)
+        conn.close()
+        LOG.info("disconnected from {}".format(address))
+        if once:
+            return
+
+
+def worker_main(argv=None):
+    """Run a pymake worker from the command line."""
+    usage = "usage: %prog [options] ADDRESS"
+    parser = optparse.OptionParser(usage=usage,
+                                   description=("Run recipes for a pymake "
+                                                "coordinator listening on "
+                                                "ADDRESS (HOST:PORT or the "
+                                                "path of a Unix socket)."))
+    parser.add_option("-s", "--slots", dest="slots", type="int",
+                      default=default_jobs(), metavar="N",
+                      help=("run at most N recipes at once. "
+                            "DEFAULT: the number of CPUs"))
+    parser.add_option("-1", "--once", dest="once",
+                      default=False, action="store_true",
+                      help=("exit when the coordinator disconnects. "
+                            "DEFAULT: connect again"))
+    parser.add_option("-v", "--verbose", action="store_true",
+                      dest="verbose", default=False,
+                      help="print each recipe received. DEFAULT: False")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("expected one ADDRESS")
+    logging.basicConfig(level=logging.DEBUG if opts.verbose else logging.INFO,
+                        format="%(message)s")
+    try:
+        run_worker(args[0], slots=opts.slots, once=opts.once)
+    except KeyboardInterrupt:
+        pass
+
+
+def parse_shard(text):
+    """Return the (index, count) of a shard given as "I/N", counting from 1.
+
+    >>> parse_shard("2/4")
+    (2, 4)
+    >>> parse_shard("5/4")
+    Traceback (most recent call last):
+      ...
+    ValueError: not a shard: '5/4'; expected I/N with 1 <= I <= N
+
+    """
+    index, sep, count = text.partition("/")
+    if sep and index.isdigit() and count.isdigit() and \
+            1 <= int(index) <= int(count):
+        return int(index), int(count)
+    raise ValueError("not a shard: {!r}; expected I/N with 1 <= I <= N".\
+                     format(text))
+
+
+def shard_of(trgt, count):
+    """Return the shard, from 1 to *count*, which *trgt* belongs to.
+
+    Depends only on *trgt*, so every machine agrees.
+
+    >>> shard_of("a.txt", 1)
+    1
+
+    """
+    digest = hashlib.sha1(trgt.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % count + 1
+
+
+def shard_graph(root, index, count):
+    """Return the DummyReqs requiring the parts of *root* that shard
+    *index* of *count* builds, to be run in turn.
+
+    The top-level tasks under *root*, those which no other task requires,
+    are split between the shards by shard_of() their targets.  While
+    there are fewer tasks than shards, e.g. below one task aggregating
+    every sample, the split moves down to the tasks they require, and the
+    tasks above it are left to the last shard.  That shard builds them
+    in a second part, after its own share, taking over whatever of the
+    others' shares is not done yet.
+
+    Where the split falls depends only on the graph, not on what is out
+    of date, so shards started at different times agree.  A shard builds
+    its share and everything it needs; tasks needed by several shards
+    are kept from running twice by ShardLocks.  *root* must have been
+    checked.
+
+    """
+    has_task_parent = set()
+    tasks = []
+    for req in iter_reqs(root):
+        if isinstance(req, TaskReq):
+            tasks.append(req)
+            for preq in req.requires:
+                has_task_parent.add(preq)
+    level = [req for req in tasks if req not in has_task_parent]
+    above = []
+    while 0 < len(level) < count:
+        below = list(dict.fromkeys(preq for req in level
+                                   for preq in req.requires
+                                   if isinstance(preq, TaskReq)))
+        if not below:
+            break
+        above.extend(level)
+        level = below
+    if len(level) < count:
+        LOG.warning("only {} tasks to split between {} shards".\
+                    format(len(level), count))
+    mine = [req for req in level if shard_of(req.trgt, count) == index]
+    LOG.info("shard {}/{} builds {} of {} tasks{}".\
+             format(index, count, len(mine), len(level),
+                    ", then the {} above them".format(len(above))
+                    if above and index == count else ""))
+    parts = [DummyReq("shard {}/{}".format(index, count), mine,
+                      session=root.session)]
+    if above and index == count:
+        parts.append(DummyReq("shard {}/{} (top)".format(index, count),
+                              [req for req in above
+                               if req not in has_task_parent],
+                              session=root.session))
+    for part in parts:
+        part.check_uptodate()
+    return parts
+
+
+class ShardLocks():
+    """Lock files keeping the shards of a build from running the same task
+    at once.
+
+    A lock is a file in *directory*, created exclusively and holding the
+    host and process id of its owner, so *directory* must be on a
+    filesystem shared by all of the shards.  A lock left behind by a
+    process on this host which has exited is removed.
+
+    """
+
+    poll = 0.5
+
+    def __init__(self, directory):
+        """Keep locks in *directory*, creating it if needed."""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+
+    def path(self, key):
+        """Return the lock file for *key*."""
+        return os.path.join(self.directory,
+                            hashlib.sha1(key.encode()).hexdigest() + ".lock")
+
+    def acquire(self, key):
+        """Wait until the lock for *key* is ours."""
+        path = self.path(key)
+        waiting = False
+        while True:
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY,
+                             0o644)
+            except FileExistsError:
+                if self._remove_stale(path):
+                    continue
+                if not waiting:
+                    LOG.info("waiting for another shard to finish {!r}".\
+                             format(key))
+                    waiting = True
+                time.sleep(self.poll)
+                continue
+            with os.fdopen(fd, 'w') as handle:
+                handle.write(self.owner)
+            return
+
+    def release(self, key):
+        """Give up the lock for *key*."""
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def _remove_stale(self, path):
+        """Remove the lock file *path* and return True if its owner is a
+        process on this host which no longer exists.
+
+        """
+        try:
+            with open(path) as handle:
+                owner = handle.read()
+        except FileNotFoundError:
+            return True
+        host, _, pid = owner.rpartition(":")
+        if host != socket.gethostname() or not pid.isdigit():
+            return False
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            return False
+        else:
+            return False
+        LOG.warning("removing the stale lock {} of {}".format(path, owner))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+def format_duration(seconds):
+    """Return *seconds* as H:MM:SS.
+
+    >>> format_duration(3725.4)
+    '1:02:05'
+    >>> format_duration(float('nan'))
+    '?'
+
+    """
+    if math.isnan(seconds) or math.isinf(seconds):
+        return "?"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}:{:02d}:{:02d}".format(hours, minutes, seconds)
+
+
+class Progress():
+    """The progress of a build, reported as its tasks start and finish.
+
+    A Scheduler tells its Progress about each task as it is added, started
+    and finished, and nothing is counted by walking the graph.  Reports
+    are made at most every *interval* seconds, as a status line on
+    *stream* and as a JSON snapshot (see snapshot()) atomically replacing
+    the file *path*.  When *stream* is not a terminal, a line is written
+    every *line_interval* seconds instead.
+
+    The ETA is the expected time of the tasks yet to finish, from the
+    durations in the History, spread over the slots of the scheduler.
+
+    A Progress is also a logging filter: added to the handlers writing to
+    *stream*, it clears the status line before each log message.
+
+    """
+
+    line_interval = 10.0
+
+    def __init__(self, stream=None, path=None, interval=0.2):
+        """Create a new Progress.
+
+        *stream* - [optional] where the status line is written
+        *path* - [optional] the file the metrics are written to
+        *interval* - the shortest time between reports
+
+        """
+        self.stream = stream
+        self.path = path
+        self.interval = interval
+        self.tty = stream is not None and stream.isatty()
+        if stream is not None and not self.tty:
+            self.interval = max(interval, self.line_interval)
+        self.lock = threading.Lock()
+        self.shown = False
+        self.begin()
+
+    def begin(self, slots=default_jobs):
+        """Start counting a new build run with *slots*() slots."""
+        self.slots = slots
+        self.start = time.monotonic()
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.uptodate = 0
+        self.restored = 0
+        self.running = {}
+        self.estimates = {}
+        self.remaining = 0.0
+        self.rules = {}
+        self.next_report = self.start + self.interval
+
+    def add(self, req, seconds):
+        """Count the task *req*, expected to take *seconds*."""
+        self.total += 1
+        if not (req.done or req.uptodate):
+            self.estimates[req] = seconds
+            self.remaining += seconds
+        self.update()
+
+    def started(self, job):
+        """Note that *job*, a TaskReq or TaskBatch, was started."""
+        reqs = members(job)
+        now = time.monotonic()
+        for req in reqs:
+            self.running[req] = (now, len(reqs))
+        self.update()
+
+    def finished(self, req, outcome="done"):
+        """Note that the task *req* is resolved with *outcome*: "done" if
+        its recipe ran, "failed", "uptodate" if it needed no recipe run
+        or "restored" if its outputs came from the cache.
+
+        """
+        self.remaining -= self.estimates.pop(req, 0.0)
+        start = self.running.pop(req, None)
+        if outcome == "failed":
+            self.failed += 1
+        elif outcome == "uptodate":
+            self.uptodate += 1
+        elif outcome == "restored":
+            self.restored += 1
+        else:
+            self.done += 1
+            if start is not None:
+                begun, share = start
+                pattern = req.rule.trgt_pattern \
+                          if req.rule is not None else ""
+                count, total = self.rules.get(pattern, (0, 0.0))
+                self.rules[pattern] = (
+                        count + 1, total + (time.monotonic() - begun) / share)
+        self.update()
+
+    def snapshot(self):
+        """Return the counts, rates and estimates as a dict."""
+        elapsed = time.monotonic() - self.start
+        left = self.total - self.done - self.failed - self.uptodate - \
+               self.restored
+        slots = max(1, min(self.slots() or 1, left))
+        return dict(total=self.total, done=self.done,
+                    running=len(self.running), failed=self.failed,
+                    uptodate=self.uptodate, restored=self.restored,
+                    waiting=left - len(self.running),
+                    elapsed=elapsed,
+                    tasks_per_second=self.done / max(elapsed, 1e-9),
+                    eta=max(self.remaining, 0.0) / slots if left else 0.0,
+                    rules={pattern: dict(count=count, mean=total / count)
+                           for pattern, (count, total) in
+                           self.rules.items()},
+                    time=time.time())
+
+    def status(self, snapshot):
+        """Return the status line for *snapshot*."""
+        return ("[{resolved}/{total}] {running} running, {failed} failed, "
+                "{uptodate} up-to-date, {restored} restored, "
+                "{tasks_per_second:.1f} tasks/s, ETA {eta}").\
+               format(resolved=snapshot['done'] + snapshot['failed'] +
+                               snapshot['uptodate'] + snapshot['restored'],
+                      eta=format_duration(snapshot['eta']),
+                      **{key: value for key, value in snapshot.items()
+                         if key != 'eta'})
+
+    def update(self):
+        """Report, unless the last report was too recent."""
+        if time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self, final=False):
+        """Write the status line and the metrics file now."""
+        self.next_report = time.monotonic() + self.interval
+        snapshot = self.snapshot()
+        if self.stream is not None:
+            with self.lock:
+                if self.tty:
+                    self.stream.write("\r\x1b[K" + self.status(snapshot) +
+                                      ("\n" if final else ""))
+                    self.shown = not final
+                else:
+                    self.stream.write(self.status(snapshot) + "\n")
+                self.stream.flush()
+        if self.path is not None:
+            directory = os.path.dirname(os.path.abspath(self.path))
+            with tempfile.NamedTemporaryFile('w', dir=directory,
+                                             delete=False) as handle:
+                json.dump(snapshot, handle)
+            os.replace(handle.name, self.path)
+
+    def end(self):
+        """Make the last report of the build."""
+        self.report(final=True)
+
+    def filter(self, record):
+        """Clear the status line before *record* is logged."""
+        if self.shown:
+            with self.lock:
+                if self.shown:
+                    self.stream.write("\r\x1b[K")
+                    self.shown = False
+        return True
+
+
+class Scheduler():
+    """Run a requirement graph using a ready queue and a bounded worker pool.
+
+    Only TaskReq objects whose prerequisites are all done are dispatched to
+    the pool; FileReq leaves and DummyReq nodes are resolved in the
+    scheduling thread.  When a task fails, everything downstream of it fails
+    too, but every other task still runs.
+
+    Ready tasks are dispatched critical path first: the task with the
+    longest expected time from its start to the end of the build (using the
+    durations in the session's History) goes first.  Tasks are only
+    started while the CPUs and memory declared by the rules of the running
+    tasks fit in the budgets, and while the load average is below a
+    limit.  A task which does not fit keeps its place: lower priority
+    tasks only start beside it if they leave room for it.  A task that
+    would not fit even on an idle machine runs alone.
+
+    With a cache, each task is looked up in a pool of threads as soon as
+    its prerequisites are done, and only joins the ready queue if its
+    outputs could not be restored, so lookups overlap the running recipes
+    and restored tasks never take a slot.
+
+    Ready tasks of a rule with a *batch* size above one wait, for up to
+    the *batch_wait* of the rule, until that many are ready or no more
+    tasks of the rule can become ready, and then run together as a
+    TaskBatch.  Each task in a batch still succeeds or fails on its own.
+
+    """
+
+    max_threads = 1024
+
+    def __init__(self, jobs=None, runner=None, cpus=None, mem=None,
+                 load=None, locks=None, progress=None, **kwargs):
+        """Create a new Scheduler.
+
+        *jobs* - [optional] the maximum number of recipes run at once
+                 (DEFAULT: as many as *runner* has slots for)
+        *runner* - [optional] what executes the recipes (DEFAULT: a
+                   LocalRunner with *jobs* slots)
+        *cpus* - [optional] the CPU budget (DEFAULT: *jobs* or the number
+                 of CPUs, or no limit when *runner* is not a LocalRunner)
+        *mem* - [optional] the memory budget; see parse_size() (DEFAULT:
+                the physical memory, or no limit when *runner* is not a
+                LocalRunner)
+        *load* - [optional] don't start recipes while others are running
+                 and the load average is at least *load*
+        *locks* - [optional] the ShardLocks to hold while running each
+                  task, when other shards of the build run beside this one
+        *progress* - [optional] the Progress to tell as tasks are added,
+                     started and finished
+        *kwargs* - passed to the do() method of each requirement
+
+        Raises ValueError if *jobs* is less than 1.
+
+        """
+        if jobs is not None and jobs < 1:
+            raise ValueError("at least 1 job is needed, not {}".format(jobs))
+        if runner is None:
+            runner = LocalRunner(jobs)
+        local = isinstance(runner, LocalRunner)
+        if cpus is None and local:
+            cpus = jobs or default_jobs()
+        if mem is None and local:
+            mem = total_memory()
+        elif mem is not None:
+            mem = parse_size(mem)
+        self.jobs = jobs
+        self.runner = runner
+        self.budget = (float('inf') if cpus is None else cpus,
+                       float('inf') if mem is None else mem)
+        self.load = load
+        self.locks = locks
+        self.progress = progress
+        self.kwargs = kwargs
+
+    def capacity(self):
+        """Return the number of recipes which may run at once right now."""
+        slots = self.runner.slots()
+        if self.jobs is None:
+            return slots
+        return min(self.jobs, slots)
+
+    def _collect(self, root):
+        """Find the requirements under *root* that still need to run.
+
+        Sets *self.waiting*, the number of outstanding prerequisites of each
+        requirement, *self.parents*, the requirements which are waiting
+        on each requirement, and *self.priority*, the expected time from
+        the start of each requirement to the end of the build.
+
+        """
+        preqs_of = {}
+        stack = [root]
+        self.parents[root] = []
+        while stack:
+            req = stack.pop()
+            if isinstance(req, HierReq):
+                preqs = [] if (req.done or req.uptodate) else \
+                        list(dict.fromkeys(req.requires))
+            else:
+                preqs = []
+            self.waiting[req] = len(preqs)
+            preqs_of[req] = preqs
+            for preq in preqs:
+                if preq not in self.parents:
+                    self.parents[preq] = []
+                    stack.append(preq)
+                self.parents[preq].append(req)
+        # Visit parents before their prerequisites.
+        unvisited = {req: len(parents)
+                     for req, parents in self.parents.items()}
+        stack = [root]
+        while stack:
+            req = stack.pop()
+            self.priority[req] = self._estimate(req) + \
+                    max((self.priority[parent]
+                         for parent in self.parents[req]), default=0.0)
+            for preq in preqs_of[req]:
+                unvisited[preq] -= 1
+                if unvisited[preq] == 0:
+                    stack.append(preq)
+
+    def _estimate(self, req):
+        """Note what *req* needs to run, and return how long it is expected
+        to take.
+
+        """
+        if not isinstance(req, TaskReq):
+            return 0.0
+        self.needs[req] = req.resources()
+        if req.rule is not None and req.rule.batch > 1 and \
+                not (req.done or req.uptodate):
+            self.unready[req.rule] += 1
+            self.batchable.add(req)
+        history = req.session.history
+        seconds = history.estimate(req) if history else History.default
+        if self.progress is not None:
+            self.progress.add(req, seconds)
+        return seconds
+
+    def _need(self, reqs):
+        """Add *reqs* and whatever they need to what is to be run.
+
+        Used while the graph is still being made, so they may already be
+        needed and their prerequisites may already be resolved.
+
+        """
+        added = []
+        stack = []
+        for req in reqs:
+            if req not in self.parents:
+                self.parents[req] = []
+                stack.append((req, None))
+        while stack:
+            req, parent = stack.pop()
+            if parent is not None and req in self.resolved:
+                if self.resolved[req]:
+                    self.failed_preqs.add(parent)
+                self.waiting[parent] -= 1
+                continue
+            if parent is not None:
+                known = req in self.parents
+                self.parents.setdefault(req, []).append(parent)
+                if known:
+                    continue
+            if isinstance(req, HierReq) and not (req.done or req.uptodate):
+                preqs = list(dict.fromkeys(req.requires))
+            else:
+                preqs = []
+            self.waiting[req] = len(preqs)
+            self.priority[req] = self._estimate(req) + \
+                    max((self.priority[parent]
+                         for parent in self.parents[req]), default=0.0)
+            added.append(req)
+            stack.extend((preq, req) for preq in preqs)
+        self.resolvable.extend(req for req in added
+                               if self.waiting[req] == 0)
+        self._drain()
+
+    def _overloaded(self):
+        """Return if the load average is too high to start more recipes."""
+        if self.load is None or not self.running:
+            return False
+        try:
+            return os.getloadavg()[0] >= self.load
+        except OSError:
+            return False
+
+    def _hold(self, req):
+        """Return if *req* should wait for more tasks to batch it with."""
+        rule = req.rule
+        return req in self.batchable and \
+               len(self.batches[rule]) < rule.batch and \
+               self.unready[rule] > 0 and \
+               time.monotonic() < self.batch_deadline[rule]
+
+    def _gather(self, req):
+        """Return *req*, or a TaskBatch of it and other ready tasks of its
+        rule.
+
+        """
+        if req not in self.batchable:
+            return req
+        rule = req.rule
+        members = self.batches[rule]
+        del members[req]
+        reqs = [req]
+        while members and len(reqs) < rule.batch:
+            other = next(iter(members))
+            del members[other]
+            # Its entry in the ready queue is skipped when popped.
+            self.batched.add(other)
+            reqs.append(other)
+        if not members:
+            del self.batches[rule]
+            del self.batch_deadline[rule]
+        if len(reqs) == 1:
+            return req
+        return TaskBatch(reqs)
+
+    def _timeout(self):
+        """Return how long to wait for a task to finish before checking
+        for new work.
+
+        """
+        # Runner capacity and the load average change over time.
+        timeout = 1.0
+        if self.batch_deadline:
+            timeout = min(timeout, min(self.batch_deadline.values()) -
+                                   time.monotonic())
+        return max(timeout, 0.0)
+
+    def _admit(self, capacity):
+        """Pop and return the ready tasks and batches which can start now.
+
+        """
+        admitted = []
+        skipped = []
+        held = []
+        reserved = (0, 0)
+        # Admitted jobs are added to self.running as they start.
+        while self.ready and len(self.running) < capacity:
+            if self._overloaded():
+                break
+            item = heapq.heappop(self.ready)
+            req = item[2]
+            if req in self.batched:
+                self.batched.discard(req)
+                continue
+            if self._hold(req):
+                held.append(item)
+                continue
+            cpus, mem = needs = self.needs[req]
+            idle = not (self.running or admitted or skipped)
+            if idle or \
+                    (self.used[0] + reserved[0] + cpus <= self.budget[0] and
+                     self.used[1] + reserved[1] + mem <= self.budget[1]):
+                if idle and (cpus > self.budget[0] or mem > self.budget[1]):
+                    LOG.warning(("{self!s} needs more resources than the "
+                                 "budget; running it alone").\
+                                format(self=req))
+                self.used = (self.used[0] + cpus, self.used[1] + mem)
+                job = self._gather(req)
+                self.running[job] = needs
+                admitted.append(job)
+                if self.tracer is not None:
+                    self._trace_admit(job)
+                if self.progress is not None:
+                    self.progress.started(job)
+            else:
+                if not skipped:
+                    reserved = needs
+                skipped.append(item)
+        for item in skipped + held:
+            heapq.heappush(self.ready, item)
+        if admitted and self.tracer is not None:
+            self._trace_counts()
+        return admitted
+
+    def _trace_admit(self, job):
+        """Trace the wait of *job* for a slot and give it a slot track."""
+        now = self.tracer.now()
+        for req in members(job):
+            start, sequence = self.queued.pop(req)
+            self.tracer.waited(req.trgt, "queued", start, now, sequence)
+        slot = heapq.heappop(self.free_slots) if self.free_slots else \
+               len(self.slots) + 1
+        self.slots[job] = slot
+        self.tracer.name_track(slot, "slot {}".format(slot))
+
+    def _trace_counts(self):
+        """Trace the number of tasks running and waiting for a slot."""
+        self.tracer.counter("tasks", running=len(self.running),
+                            ready=len(self.ready))
+
+    def _resolve(self, req):
+        """Handle *req*, all of whose prerequisites have been resolved."""
+        if req in self.batchable:
+            self.unready[req.rule] -= 1
+        if req in self.failed_preqs:
+            LOG.critical(("a preq of {self!s} had an error; not "
+                          "running.").format(self=req))
+            self._finish(req, failed=True)
+        elif not isinstance(req, HierReq):
+            try:
+                req.run()
+            except ValueError as err:
+                LOG.error(err)
+                self._finish(req, failed=True)
+            else:
+                self._finish(req)
+        elif req.done or req.uptodate:
+            debug("{self!s} already up-to-date", self=req)
+            self._finish(req, outcome="uptodate")
+        elif isinstance(req, TaskReq) and self.lookup_pool is not None:
+            future = self.lookup_pool.submit(self._lookup, req)
+            self.lookups[future] = req
+            self._watch(future)
+        elif isinstance(req, TaskReq):
+            self._push(req)
+        else:
+            req.do(**self.kwargs)
+            self._finish(req)
+
+    def _push(self, req):
+        """Add *req* to the ready queue."""
+        if self.expand_error is not None:
+            return
+        sequence = next(self.sequence)
+        heapq.heappush(self.ready, (-self.priority[req], sequence, req))
+        if req in self.batchable:
+            self.batches.setdefault(req.rule, {})[req] = None
+            self.batch_deadline.setdefault(
+                    req.rule, time.monotonic() + req.rule.batch_wait)
+        if self.tracer is not None:
+            self.queued[req] = (self.tracer.now(), sequence)
+
+    def _lookup(self, req):
+        """Return if *req* needs no recipe run after all, because it is
+        up-to-date or its outputs were restored from the cache.
+
+        Runs in the lookup pool.
+
+        """
+        if self._cutoff(req):
+            return True
+        key = self.keys[req] = self._cache_key(req)
+        return self._restore(req, key)
+
+    def _watch(self, future):
+        """Have the scheduling loop handle the lookup *future* when it is
+        done.
+
+        """
+        future.add_done_callback(
+                lambda future: self._post(self._looked_up, future))
+
+    def _post(self, func, *args):
+        """Have the scheduling loop call *func*(*args); thread-safe."""
+        self.finished.put(functools.partial(func, *args))
+
+    def _looked_up(self, future):
+        """Handle the end of the lookup *future*."""
+        req = self.lookups.pop(future)
+        err = future.exception()
+        if err is not None:
+            LOG.error("{self!s} had an error: {err}".\
+                      format(self=req, err=err))
+            self._finish(req, failed=True)
+        elif future.result():
+            self._finish(req, outcome=self.outcomes.pop(req))
+        else:
+            self._push(req)
+        self._drain()
+
+    def _finish(self, req, failed=False, outcome="done"):
+        """Mark *req* as resolved and release the requirements waiting on it.
+
+        *outcome* - how *req* was resolved without failing; see
+                    Progress.finished()
+
+        """
+        self.resolved[req] = failed
+        if self.progress is not None and isinstance(req, TaskReq):
+            self.progress.finished(req, "failed" if failed else outcome)
+        if failed:
+            req.err_event.set()
+        elif isinstance(req, HierReq):
+            req.done = True
+            debug("{self!s} done", self=req)
+        for parent in self.parents[req]:
+            if failed:
+                self.failed_preqs.add(parent)
+            self.waiting[parent] -= 1
+            if self.waiting[parent] == 0:
+                self.resolvable.append(parent)
+
+    def _drain(self):
+        """Resolve requirements until only dispatched tasks remain."""
+        while self.resolvable:
+            self._resolve(self.resolvable.pop())
+
+    def _cutoff(self, req):
+        """Return if *req* turns out not to need running after all."""
+        if req.session.state_db is not None and \
+                self.kwargs.get('execute', True) and req.matches_record():
+            # Early cutoff: the prerequisites were rebuilt with unchanged
+            # contents.
+            debug("{self!s} is up-to-date after all", self=req)
+            req.uptodate = True
+            self.outcomes[req] = "uptodate"
+            return True
+        debug("Doing {self!s}", self=req)
+        return False
+
+    def _record(self, req, seconds):
+        """Record how long *req* took and what it was built from."""
+        if not self.kwargs.get('execute', True):
+            return
+        if req.session.history is not None:
+            req.session.history.record(req, seconds)
+        if req.session.state_db is not None:
+            req.record_state()
+
+    def _cache_key(self, req):
+        """Return the key of *req* in the ArtifactCache, or None if its
+        output is not cached.
+
+        """
+        cache = req.session.cache
+        if cache is None or req.order_only or \
+                not self.kwargs.get('execute', True):
+            return None
+        return cache.key(req)
+
+    def _restore(self, req, key):
+        """Return if the output of *req* was restored from the cache."""
+        if key is None or not req.session.cache.restore(key, req.outputs):
+            return False
+        LOG.info("restored {self.trgt!r} from the cache".format(self=req))
+        for output in req.outputs:
+            req.session.stat_cache.invalidate(output)
+        if req.session.state_db is not None:
+            req.record_state()
+        self.outcomes[req] = "restored"
+        return True
+
+    def _store(self, req, key):
+        """Store the output of *req* in the cache under *key*."""
+        if key is not None:
+            req.session.cache.store(key, req.outputs,
+                                    [req.session.file_hash(output)
+                                     for output in req.outputs])
+
+    @contextlib.contextmanager
+    def _claim(self, reqs):
+        """Hold the shard locks of *reqs* and yield those which still need
+        running.
+
+        """
+        if self.locks is None:
+            yield reqs
+            return
+        # Always in the same order, so that shards never wait on each other
+        # in a cycle.
+        keys = sorted({min(req.outputs) for req in reqs})
+        held = []
+        try:
+            for key in keys:
+                self.locks.acquire(key)
+                held.append(key)
+            yield [req for req in reqs if not self._built_elsewhere(req)]
+        finally:
+            for key in held:
+                self.locks.release(key)
+
+    def _built_elsewhere(self, req):
+        """Return if every output of *req* has changed since it was checked,
+        because another shard has built it.
+
+        """
+        stat_cache = req.session.stat_cache
+        before = [stat_cache.stat(output) for output in req.outputs]
+        for output in req.outputs:
+            stat_cache.invalidate(output)
+        for output, old in zip(req.outputs, before):
+            new = stat_cache.stat(output)
+            if new is None or (old is not None and
+                               (new.st_ino, new.st_size, new.st_mtime_ns) ==
+                               (old.st_ino, old.st_size, old.st_mtime_ns)):
+                return False
+        LOG.info("{self.trgt!r} was built by another shard".format(self=req))
+        self.outcomes[req] = "uptodate"
+        return True
+
+    def _do(self, req):
+        """Execute *req*, a TaskReq or TaskBatch, in a worker thread."""
+        if isinstance(req, TaskBatch):
+            return self._do_batch(req)
+        with req.session.span(req.trgt, cat="recipe",
+                              tid=self.slots.get(req)), \
+                self._claim([req]) as todo:
+            if not todo:
+                return
+            if req in self.keys:
+                key = self.keys.pop(req)
+            elif self._lookup(req):
+                return
+            else:
+                key = self.keys.pop(req)
+            start = time.monotonic()
+            req.do(runner=self.runner, **self.kwargs)
+            self._record(req, time.monotonic() - start)
+            self._store(req, key)
+
+    def _do_batch(self, batch):
+        """Execute the tasks in *batch* which still need running."""
+        with batch.session.span(batch.trgt, cat="recipe",
+                                tid=self.slots.get(batch)), \
+                self._claim(batch.reqs) as claimed:
+            todo = []
+            keys = {}
+            for req in claimed:
+                if req.order_only and req.trgt_exists():
+                    debug("{self!s} is order-only and exists", self=req)
+                    continue
+                if req in self.keys:
+                    keys[req] = self.keys.pop(req)
+                elif self._lookup(req):
+                    continue
+                else:
+                    keys[req] = self.keys.pop(req)
+                todo.append(req)
+            if not todo:
+                return
+            start = time.monotonic()
+            batch.do(todo, runner=self.runner, **self.kwargs)
+            seconds = (time.monotonic() - start) / len(todo)
+            for req in todo:
+                if req not in batch.errors:
+                    self._record(req, seconds)
+                    self._store(req, keys[req])
+
+    def _init(self, session):
+        """Prepare to run requirements in *session*."""
+        self.waiting = {}
+        self.parents = {}
+        self.priority = {}
+        self.resolved = {}
+        self.needs = {}
+        self.failed_preqs = set()
+        self.unready = collections.Counter()
+        self.batchable = set()
+        self.ready = []
+        self.sequence = itertools.count()
+        self.resolvable = []
+        self.running = {}
+        self.used = (0, 0)
+        self.tracer = session.tracer
+        self.queued = {}
+        self.slots = {}
+        self.free_slots = []
+        self.batches = {}
+        self.batch_deadline = {}
+        self.batched = set()
+        self.lookups = {}
+        self.keys = {}
+        self.outcomes = {}
+        self.lookup_pool = None
+        self.root = None
+        self.expanding = False
+        self.expand_error = None
+        if session.cache is not None and self.kwargs.get('execute', True):
+            self.lookup_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=getattr(session.cache, 'workers', 4),
+                    thread_name_prefix="pymake-lookup")
+        if self.tracer is not None:
+            self.tracer.name_track(0, "pymake")
+        if self.progress is not None:
+            self.progress.begin(self.capacity)
+
+    def _start(self, root):
+        """Prepare to run *root* and resolve everything that needs no
+        recipe run.
+
+        """
+        self._init(root.session)
+        self.root = root
+        self._collect(root)
+        self.resolvable = [req for req, count in self.waiting.items()
+                           if count == 0]
+        self._drain()
+
+    def _expand(self, trgt, rules, session):
+        """Make the graph for *trgt*, handing requirements to the
+        scheduling loop as soon as they are known to be needed.
+
+        Runs in its own thread.
+
+        """
+        try:
+            feed = GraphFeed(session,
+                             lambda reqs: self._post(self._need, reqs))
+            with session.span("make_req", trgt=trgt):
+                root = make_req(trgt, rules, session, visitor=feed)
+            feed.flush()
+        except BaseException as err:
+            self._post(self._expand_failed, err)
+        else:
+            self._post(self._expanded, root)
+
+    def _expanded(self, root):
+        """Handle the end of the graph, *root*."""
+        self.root = root
+        self.expanding = False
+        self._need([root])
+
+    def _expand_failed(self, err):
+        """Stop starting tasks because making the graph raised *err*.
+
+        Tasks already running are left to finish.
+
+        """
+        LOG.error("could not make the graph: {}".format(err))
+        self.expanding = False
+        self.expand_error = err
+        self.ready = []
+        self.batches = {}
+        self.batch_deadline = {}
+
+    def _complete(self, job, err):
+        """Handle the end of *job*, a TaskReq or TaskBatch, which raised
+        *err*.
+
+        """
+        cpus, mem = self.running.pop(job)
+        self.used = (self.used[0] - cpus, self.used[1] - mem)
+        if self.tracer is not None:
+            heapq.heappush(self.free_slots, self.slots.pop(job))
+            self._trace_counts()
+        errors = getattr(job, 'errors', {})
+        for req in members(job):
+            req_err = err or errors.get(req)
+            if req_err is not None or req.failed():
+                LOG.error("{self!s} had an error: {err}".\
+                          format(self=req, err=req_err))
+                self._finish(req, failed=True)
+            else:
+                self._finish(req, outcome=self.outcomes.pop(req, "done"))
+        self._drain()
+
+    def run(self, root):
+        """Run *root* and all of the prerequisites which are out of date.
+
+        Returns True if everything finished without errors.
+
+        """
+        self.finished = queue.Queue()
+        self._start(root)
+        return self._loop()
+
+    def run_pipelined(self, trgt, rules, session):
+        """Make the graph for *trgt* from *rules* in *session* and run it,
+        starting tasks while the rest of the graph is still being made.
+
+        Each requirement is checked as soon as it is made.  It is only
+        started early if every requirement on the path to it from *trgt*
+        is certain to be out of date, so exactly the tasks that run() would
+        run are run.  Returns True if everything finished without errors.
 
-    def applies(self, trgt):
-        """Return if the value of *trgt* matches the target pattern."""
+        """
+        self.finished = queue.Queue()
+        self._init(session)
+        self.expanding = True
+        thread = threading.Thread(target=self._expand,
+                                  args=(trgt, rules, session),
+                                  name="pymake-expand", daemon=True)
+        thread.start()
         try:
-            self._match(trgt)
-        except ValueError:
-            return False
-        else:
-            return True
+            return self._loop()
+        finally:
+            thread.join()
 
-    def get_preqs(self, trgt):
-        """Return the prerequisite templates filled for *trgt*."""
-        groups = self._match(trgt)
-        preqs = [template.format(*groups, trgt=trgt, **self.env)
-                 for template in self.preqs_template]
-        return preqs
+    def _loop(self):
+        """Dispatch tasks until everything is resolved."""
+        try:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=self.max_threads,
+                    thread_name_prefix="pymake-worker") as pool:
+                while self.expanding or self.running or self.ready or \
+                        self.lookups:
+                    for job in self._admit(self.capacity()):
+                        future = pool.submit(self._do, job)
+                        future.add_done_callback(
+                            lambda future, job=job: self._post(
+                                    self._complete, job, future.exception()))
+                    if self.progress is not None:
+                        self.progress.update()
+                    try:
+                        callback = self.finished.get(timeout=self._timeout())
+                    except queue.Empty:
+                        continue
+                    callback()
+        finally:
+            self._stop()
+        if self.expand_error is not None:
+            raise self.expand_error
+        return not self.root.failed()
 
-    def get_recipe(self, trgt):
-        """Return the recipe template filled for *trgt*."""
-        groups = self._match(trgt)
-        preqs = self.get_preqs(trgt)
-        # Make the str representation of *preqs* a space delimited list.
-        class list_wrapper(list):
-            def __str__(self):
-                return " ".join(self.__iter__())
-        wrapped_preqs = list_wrapper(preqs)
-        recipe = self.recipe_template.format(*groups, trgt=trgt,
-                                             preqs=wrapped_preqs, **self.env)
-        return recipe
+    def _stop(self):
+        """Release what the run needed."""
+        if self.lookup_pool is not None:
+            self.lookup_pool.shutdown(cancel_futures=True)
+        if self.progress is not None:
+            self.progress.end()
 
 
-@contextlib.contextmanager
-def backup(path, append="~", prepend="", on_fail=None):
-    """Backup path while context manager is active.
+def pidfd_supported():
+    """Return if this system can open pidfds."""
+    try:
+        os.close(os.pidfd_open(os.getpid()))
+    except (AttributeError, OSError):
+        return False
+    return True
 
-    Names the backup using the prefix *prepend* and the suffix *append*.
 
-    If an error occurs while active, *on_fail* is called on *path* before
-    exiting.
+@contextlib.contextmanager
+def pidfd_child_watcher():
+    """Have asyncio wait for subprocesses with pidfds, not a thread each.
+
+    Python 3.12 and later already do so where pidfds are supported.
 
     """
-    backup_path = os.path.join(os.path.dirname(path),
-                               prepend + os.path.basename(path) + append)
-    original_exists = os.path.exists(path)
-    if original_exists:
-        os.rename(path, backup_path)
+    if sys.version_info >= (3, 12) or not pidfd_supported():
+        yield
+        return
+    previous = asyncio.get_child_watcher()
+    asyncio.set_child_watcher(asyncio.PidfdChildWatcher())
     try:
         yield
-    except Exception as err:
-        new_exists = os.path.exists(path)
-        if original_exists:
-            os.rename(backup_path, path)
-        elif new_exists and on_fail:
-            on_fail(path)
-        raise err
-    else:
-        if original_exists:
-            os.remove(backup_path)
+    finally:
+        asyncio.set_child_watcher(previous)
 
 
-def extract_rule(trgt, rules):
-    """Return the first rule in *rules* that matches *trgt* and the remainder.
+class AsyncScheduler(Scheduler):
+    """Run a requirement graph on an asyncio event loop.
+
+    Dispatches tasks like Scheduler, but each running recipe is a
+    coroutine waiting on an asyncio subprocess rather than a thread
+    blocked in Popen.wait(), so many concurrent recipes cost coroutines,
+    not OS threads.  Recipes are run in threads only with runners which
+    have no run_async() method, like RemoteRunner.  Those threads, and
+    the ones for other blocking work, come from a pool of the scheduler's
+    own, not the event loop's default executor, so they are limited by the
+    capacity of the runner rather than by the number of CPUs.  Use
+    run_async() to run a graph from a coroutine without blocking the event
+    loop.
 
     """
-    rules = list(rules)
-    req = None
-    for i, rule in enumerate(rules):
-        if rule.applies(trgt):
-            del rules[i]
-            return rule, rules
-    else:
-        return None, rules
 
+    def run(self, root):
+        """Run *root* on a new event loop; see Scheduler.run()."""
+        with pidfd_child_watcher():
+            return asyncio.run(self.run_async(root))
 
-def make_req(trgt, rules):
-    """Return a fully initialized Req object for *trgt*.
+    def run_pipelined(self, trgt, rules, session):
+        """Make the graph and run it on a new event loop; see
+        Scheduler.run_pipelined().
 
-    Will fill the requirements of trgt recursively.
+        """
+        with pidfd_child_watcher():
+            return asyncio.run(self.run_pipelined_async(trgt, rules,
+                                                        session))
 
-    """
-    if trgt in Req.instances:
-        return Req.instances[trgt]
-    rule, remaining = extract_rule(trgt, rules)
-    if rule:
-        requires = [make_req(preq, remaining)
-                    for preq in rule.get_preqs(trgt)]
-        recipe = rule.get_recipe(trgt)
-        if recipe:
-            return TaskReq(trgt, requires, recipe,
-                           order_only=rule.order_only)
-        else:
-            return DummyReq(trgt, requires)
-    else:
-        return FileReq(trgt)
+    async def _do_async(self, req):
+        """Execute *req* as a coroutine."""
+        if isinstance(req, TaskBatch) or self.locks is not None:
+            # A batch runs its recipes through the runner's run(), and
+            # waiting for shard locks blocks.
+            return await self._in_thread(self._do, req)
+        # Hashing contents, the state database and the cache may block.
+        blocking = req.session.state_db is not None or \
+                   req.session.cache is not None
 
+        async def call(func, *args):
+            if blocking:
+                return await self._in_thread(func, *args)
+            return func(*args)
 
-class Req():
-    """The base class for all requirements.
+        with req.session.span(req.trgt, cat="recipe",
+                              tid=self.slots.get(req)):
+            if req in self.keys:
+                key = self.keys.pop(req)
+            elif await call(self._lookup, req):
+                return
+            else:
+                key = self.keys.pop(req)
+            start = time.monotonic()
+            if hasattr(self.runner, 'run_async'):
+                await req.do_async(runner=self.runner, **self.kwargs)
+            else:
+                await self._in_thread(req.do, runner=self.runner,
+                                      **self.kwargs)
+            await call(self._record, req, time.monotonic() - start)
+            await call(self._store, req, key)
 
-    """
+    async def _in_thread(self, func, *args, **kwargs):
+        """Call *func* in a thread of the scheduler's pool and return its
+        result.
 
-    instances = {}
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+                self.pool, functools.partial(func, *args, **kwargs))
 
-    def __init__(self, trgt):
-        """Create a new Req object for trgt."""
-        self.trgt = trgt
-        Req.instances[trgt] = self
-        self.err_event = threading.Event()
+    async def run_async(self, root):
+        """Run *root* and all of the prerequisites which are out of date.
 
-    def __repr__(self):
-        return "{self.__class__.__name__}({self.trgt!r})".format(self=self)
+        Returns True if everything finished without errors.
 
-    def __str__(self):
-##        return "{self.__class__.__name__}({self.trgt!r})".format(self=self)
-        return Req.__repr__(self)
+        """
+        self.lookup_tasks = {}
+        self._start(root)
+        return await self._loop_async()
 
-    def formatted(self):
-        return self.__str__()
+    async def run_pipelined_async(self, trgt, rules, session):
+        """Like run_pipelined(), but as a coroutine."""
+        self.lookup_tasks = {}
+        self.loop = asyncio.get_running_loop()
+        self.posted = asyncio.Event()
+        self._init(session)
+        self.expanding = True
+        expansion = asyncio.ensure_future(asyncio.to_thread(
+                self._expand, trgt, rules, session))
+        try:
+            return await self._loop_async()
+        finally:
+            await expansion
 
-    def __eq__(self, other):
-        """req1 == req2 <==> req1.trgt == req2.trgt"""
-        return self.trgt == other.trgt
+    async def _loop_async(self):
+        """Dispatch tasks until everything is resolved."""
+        running = {}
+        posted = None
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_threads,
+                thread_name_prefix="pymake-worker")
+        try:
+            while self.expanding or self.running or self.ready or \
+                    self.lookups:
+                for req in self._admit(self.capacity()):
+                    running[asyncio.ensure_future(self._do_async(req))] = req
+                if self.progress is not None:
+                    self.progress.update()
+                waits = set(running) | set(self.lookup_tasks)
+                if self.expanding:
+                    if posted is None:
+                        self.posted.clear()
+                        posted = asyncio.ensure_future(self.posted.wait())
+                    waits.add(posted)
+                if not waits:
+                    # Wait for the runner to get capacity, or for a batch
+                    # to fill.
+                    await asyncio.sleep(self._timeout())
+                    continue
+                done, _ = await asyncio.wait(
+                        waits, timeout=self._timeout(),
+                        return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is posted:
+                        posted = None
+                    elif task in running:
+                        self._complete(running.pop(task), task.exception())
+                    else:
+                        self._looked_up(self.lookup_tasks.pop(task))
+        finally:
+            if posted is not None:
+                posted.cancel()
+            self.pool.shutdown(wait=False)
+            self._stop()
+        if self.expand_error is not None:
+            raise self.expand_error
+        return not self.root.failed()
 
-    def trgt_exists(self):
-        return os.path.exists(self.trgt)
+    def _watch(self, future):
+        """Have the event loop handle the lookup *future* when it is done.
 
-    def __hash__(self):
-        return hash(self.trgt)
+        """
+        self.lookup_tasks[asyncio.wrap_future(future)] = future
 
-    def last_update(self):
-        """Return the last time *trgt* was updated."""
-        raise NotImplementedError("last_update() has not been implemented "
-                                  "for this class, which is therefore not "
-                                  "a functioning Req subclass.")
+    def _post(self, func, *args):
+        """Have the event loop call *func*(*args); thread-safe."""
+        self.loop.call_soon_threadsafe(self._call_posted, func, args)
 
-    def check_uptodate(self):
-        """Determine if the requirement needs to be updated."""
-        raise NotImplementedError("find_needs_update() has not been "
-                                  "implemented for this class, which is "
-                                  "therefore not a functioning Req subclass.")
+    def _call_posted(self, func, args):
+        func(*args)
+        self.posted.set()
 
 
-class FileReq(Req):
-    """Subclass of Req for files."""
+def make_scheduler(engine="threads", **kwargs):
+    """Return a new scheduler for *engine*, one of ENGINES.
 
-    def last_update(self):
-        """Return the last time the file, *trgt*, was updated.
+    "threads" runs each recipe in a thread (see Scheduler) and "asyncio"
+    runs them as coroutines on an event loop (see AsyncScheduler).
+    *kwargs* are passed to the scheduler.
 
-        Returns float('nan') if *trgt* does not exist.
+    """
+    if engine == "asyncio":
+        return AsyncScheduler(**kwargs)
+    elif engine == "threads":
+        return Scheduler(**kwargs)
+    raise ValueError("unknown engine: {}".format(engine))
 
-        """
-        if os.path.exists(self.trgt):
-            return os.path.getmtime(self.trgt)
-        else:
-            return float('nan')
 
-    def check_uptodate(self):
-        """Return the last time *self.trgt* was updated.
+def run_pipelined(trgt, rules, session, jobs=None, parallel=True,
+                  engine="threads", **kwargs):
+    """Make the graph for *trgt* and run it at the same time; see
+    Scheduler.run_pipelined().  The arguments and the result are as for
+    HierReq.run().
 
-        Since FileReq objects are always up-to-date if they exist,
-        this doesn't actually set a property.deleter(
+    """
+    if not parallel:
+        jobs = 1
+    return make_scheduler(engine, jobs=jobs, **kwargs).\
+           run_pipelined(trgt, rules, session)
 
-        It just returns the last update time for recursive purposes.
 
-        """
-        return self.last_update()
+class PollWatcher():
+    """Watch files for changes by polling their status."""
 
-    def run(self, **kwargs):
-        """Ensure that *self.trgt* exists."""
-        if not self.trgt_exists():
-            self.err_event.set()
-            raise ValueError(("{self.trgt!r} not found. "
-                              "Did you expect this file to exist? "
-                              "Maybe you're missing a rule...?").\
-                             format(self=self))
-        LOG.debug("{self!s} exists".format(self=self))
+    def __init__(self, paths, interval=1.0):
+        """Start watching *paths*, polling every *interval* seconds."""
+        self.paths = set(paths)
+        self.interval = interval
+        self.states = {}
+        self.refresh(self.paths)
 
+    def _state(self, path):
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino
 
-def of_non_nan(func, iterable):
-    """Return the value of func for non-NaN elements of *iterable*.
+    def refresh(self, paths):
+        """Take the current status of *paths* as unchanged."""
+        for path in paths:
+            self.states[path] = self._state(path)
 
-    If all values are NaN or iterable is of length zero, return NaN.
+    def candidates(self, timeout):
+        """Return the paths which may have changed within *timeout* seconds.
 
-    """
-    non_nan_vals = [val for val in iterable if not math.isnan(val)]
-    if non_nan_vals:
-        return func(non_nan_vals)
-    else:
-        return float('nan')
+        *timeout* may be None to wait as long as needed.
 
+        """
+        time.sleep(self.interval if timeout is None else
+                   min(timeout, self.interval))
+        return self.paths
 
-class HierReq(Req):
-    """Subclass of Req for any target that is runnable or has prerequisites.
+    def wait(self, settle=0.2):
+        """Block until some paths change, and return the set of them.
 
-    """
+        Changes are collected until none arrive for *settle* seconds, so
+        that changes made together are returned together.
 
+        """
+        changed = set()
+        timeout = None
+        while True:
+            more = {path for path in self.candidates(timeout)
+                    if path not in changed and
+                    self._state(path) != self.states.get(path)}
+            if changed and not more:
+                break
+            changed |= more
+            if changed:
+                timeout = settle
+        self.refresh(changed)
+        return changed
 
-    def __init__(self, trgt, requires):
-        """Create a new HierReq object for *trgt*, given *requires*."""
-        super(HierReq, self).__init__(trgt)
-        self.requires = requires
-        self.uptodate = False
-        self.done = False
-        self.run_lock = threading.Lock()
+    def close(self):
+        """Stop watching."""
+        pass
 
-    def __repr__(self):
-        return super(HierReq, self).__repr__().rstrip(')') + \
-               ", {self.requires})".format(self=self)
 
-    def formatted(self):
-        """Return a pretty-formatted description of the Req."""
-        out_string = super(HierReq, self).formatted()
-        out_string += "\n  |UP TO DATE| {}".format(self.uptodate)
-        req_strings = []
-        for req in self.requires:
-            for line in req.formatted().split('\n'):
-                req_strings += ["    {}".format(line)]
-        if req_strings:
-            out_string += '\n'.join(["\n  |REQUIRES|"] + req_strings)
-        return out_string
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
 
 
-    def check_uptodate(self):
-        """Determine if the requirement needs to be updated.
+class InotifyWatcher(PollWatcher):
+    """Watch files for changes using Linux inotify.
 
-        An update is required if any upstream requirements exist and
-        they are newer than *trgt*, or if neither upstream requirements
-        nor *trgt* exist.
+    Each directory containing a watched path is watched; paths in
+    directories which cannot be watched are polled instead.
 
-        """
-        if self.uptodate:
-            LOG.debug(("{self!s} is flagged up-to-date and will not be "
-                       "re-checked.").format(self=self))
-            if not self.order_only:
-                return self.last_update()
-            else:
-                return self._cached_max_usts
-        last_update = self.last_update()
-        self._cached_max_usts = max_usts = \
-                of_non_nan(max, (preq.check_uptodate()
-                                  for preq in self.requires))
-        if not self.trgt_exists():
-            LOG.debug(("since {self.trgt!r} does not exist, flagging "
-                       "{self!s} as not up-to-date").format(self=self))
-            self.uptodate = False
-            return max_usts
-        elif math.isnan(max_usts):
-            LOG.debug(("since {self.trgt!r} exists, and no preqs exist, "
-                       "flagging {self!s} as up-to-date").format(self=self))
-            self.uptodate = True
-            if not self.order_only:
-                return last_update
-            else:
-                return max_usts
-        elif last_update > max_usts:
-            LOG.debug(("{self.trgt!r} is newer than all preqs; "
-                        "flagging {self!s} as up-to-date.").format(self=self))
-            self.uptodate = True
-            if not self.order_only:
-                return last_update
-            else:
-                return max_usts
-        elif last_update <= max_usts:
-            LOG.debug(("{self.trgt!r} is not newer ({}) than at least "
-                       "one preq (max={}); flagging {self!s} as not "
-                       "up-to-date.").\
-                      format(last_update, max_usts, self=self))
-            self.uptodate = False
-            return max_usts
-        else:
-            raise ValueError(("Somehow the up-to-date status of {self!s} "
-                              "cannot be determined.").format(self=self))
+    """
 
-    def do(self, **kwargs):
-        """Execute the work defined for the requirement.""" 
-        raise NotImplementedError("do() has not been implemented "
-                                  "for this class, which is therefore not "
-                                  "a functioning HierReq subclass.")
+    mask = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+            IN_CREATE | IN_DELETE)
 
-    def run(self, parallel=True, **kwargs):
-        """Run, recursively, the requirement and all of its prerequisites.
+    def __init__(self, paths, interval=1.0):
+        """Start watching *paths*.
 
-        Requirements which are already up-to-date are not run and neither are
-        their prerequisites.
+        Raises OSError if inotify is not available.
 
         """
-        kwargs['parallel'] = parallel
-        self.run_lock.acquire()
-        if self.done:
-            LOG.debug("{self!s} already done".format(self=self))
-            self.run_lock.release()
-            return
-        elif self.uptodate:
-            LOG.debug("{self!s} already up-to-date".format(self=self))
-            self.done = True
-            self.run_lock.release()
-            return
-        elif self.err_event.is_set():
-            LOG.debug("{self!s} had an error".format(self=self))
-            self.run_lock.release()
-            return
-        else:
-            LOG.debug("attempting to run {self!s}".format(self=self))
-            if self.requires:
-                if parallel:
-                    LOG.debug("running all preqs of {self!s} in parallel".\
-                              format(self=self))
-                    preq_threads = []
-                    for preq in self.requires:
-                        thread = threading.Thread(target=preq.run,
-                                                  kwargs=kwargs)
-                        preq_threads += [thread]
-                        thread.start()
-                        LOG.debug(("{self!s} spawned {thread.name} for "
-                                   "{preq!s}").\
-                                  format(self=self, thread=thread, preq=preq))
-                    for preq, thread in zip(self.requires, preq_threads):
-                        thread.join()
-                        if preq.err_event.is_set():
-                            LOG.critical(("preq: {preq!s} had an error; "
-                                          "exiting.").format(preq=preq))
-                            self.err_event.set()
-                            self.run_lock.release()
-                            return
-                else:
-                    LOG.debug("running all preqs of {self!s} in series".\
-                            format(self=self))
-                    for preq in self.requires:
-                        thread = threading.Thread(target=preq.run,
-                                                  kwargs=kwargs)
-                        thread.start()
-                        LOG.debug("{self!s} spawned {thread.name}".\
-                                  format(self=self, thread=thread))
-                        thread.join()
-                        if preq.err_event.is_set():
-                            LOG.critical(("preq: {preq!s} had an error; "
-                                          "exiting.").format(preq=preq))
-                            self.err_event.set()
-                            self.run_lock.release()
-                            return
-            LOG.debug("Doing {self!s} (id={obj})".\
-                      format(self=self, obj=id(self)))
-            self.do(**kwargs)
-            if self.err_event.is_set():
-                LOG.critical("{self!s} had an error; exiting".\
-                             format(self=self))
-                self.run_lock.release()
-                return
-            self.done = True
-            LOG.debug("{self!s} done".format(self=self))
-            self.run_lock.release()
-            return
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        self.dirs = {}
+        self.polled = set()
+        by_dir = {}
+        for path in paths:
+            by_dir.setdefault(os.path.dirname(path), []).append(path)
+        for dirpath, dir_paths in by_dir.items():
+            wd = libc.inotify_add_watch(self.fd,
+                                        os.fsencode(dirpath or os.curdir),
+                                        self.mask)
+            if wd < 0:
+                self.polled.update(dir_paths)
+            else:
+                self.dirs.setdefault(wd, []).append(dirpath)
+        super(InotifyWatcher, self).__init__(paths, interval)
 
+    def candidates(self, timeout):
+        if self.polled and (timeout is None or timeout > self.interval):
+            timeout = self.interval
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return self.polled
+        try:
+            data = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return self.polled
+        candidates = set(self.polled)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = \
+                    INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b"\0"))
+            offset += length
+            for dirpath in self.dirs.get(wd, ()):
+                path = os.path.join(dirpath, name)
+                if path in self.paths:
+                    candidates.add(path)
+        return candidates
+
+    def close(self):
+        os.close(self.fd)
 
-class TaskReq(HierReq, FileReq):
-    """Subclass of HierReq for a requirement which involves _doing_ something.
+
+def make_watcher(paths, poll=False, interval=1.0):
+    """Return an InotifyWatcher for *paths*, or a PollWatcher if *poll* is
+    set or inotify is not available.
 
     """
+    if not poll:
+        try:
+            return InotifyWatcher(paths, interval)
+        except (OSError, AttributeError) as err:
+            debug("cannot use inotify ({}); polling instead", err)
+    return PollWatcher(paths, interval)
 
-    def __init__(self, trgt, requires, recipe, order_only=False):
-        """Create a new TaskReq."""
-        self.order_only = order_only
-        self.recipe = recipe
-        super(TaskReq, self).__init__(trgt, requires)
 
+def watch_graph(root, poll=False, interval=1.0, settle=0.2, jobs=None,
+                parallel=True, engine="threads", **kwargs):
+    """Run *root*, then run it again whenever a file in its graph changes.
 
-    def __repr__(self):
-        return super(TaskReq, self).__repr__().rstrip(')') + \
-               (", {self.recipe!r}, order_only={self.order_only})").\
-               format(self=self)
+    The graph stays in memory.  After a change, only the requirements
+    which depend on the changed files, and those which ran in the
+    previous build, are checked again.  Returns when interrupted, with
+    whether the last build finished without errors.
 
-    def formatted(self):
-        """Return a pretty-formatted description of the Req."""
-        out_string = super(TaskReq, self).formatted()
-        recipe_strings = []
-        for line in self.recipe.split('\n'):
-            recipe_strings += ["    {}".format(line)]
-        out_string += '\n'.join(["\n  |RECIPE|"] + recipe_strings)
-        return out_string
+    """
+    if not parallel:
+        jobs = 1
+    session = root.session
+    parents = {}
+    for req in iter_reqs(root):
+        for preq in getattr(req, 'requires', ()):
+            parents.setdefault(preq, []).append(req)
+    watcher = make_watcher([output for req in iter_reqs(root)
+                            for output in getattr(req, 'outputs',
+                                                  (req.trgt,))],
+                           poll=poll, interval=interval)
+    ok = True
+    try:
+        while True:
+            root.check_uptodate()
+            scheduler = make_scheduler(engine, jobs=jobs, **kwargs)
+            ok = scheduler.run(root)
+            session.flush()
+            stale = list(scheduler.waiting)
+            watcher.refresh(output for req in stale
+                            for output in getattr(req, 'outputs',
+                                                  (req.trgt,)))
+            LOG.info("**watching for changes**")
+            changed = watcher.wait(settle)
+            LOG.info("changed: {}".format(" ".join(sorted(changed))))
+            for path in changed:
+                session.stat_cache.invalidate(path)
+            stack = [session.instances[path] for path in changed]
+            seen = set()
+            while stack:
+                req = stack.pop()
+                if req not in seen:
+                    seen.add(req)
+                    stack.extend(parents.get(req, ()))
+            for req in stale + list(seen):
+                req.checked = False
+                req._err_event = None
+                if isinstance(req, HierReq):
+                    req.uptodate = False
+                    req.done = False
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return ok
 
 
-    def do(self, execute=True, print_out=True, **kwargs):
-        """Print and execute the recipe."""
-        if self.order_only and self.trgt_exists():
-            LOG.debug("order-only requirement; will not be executed")
+def build_graph(trgt, rules, session, cache_graph=False):
+    """Return the dependency graph rooted at *trgt*, checked against the
+    files on disk.
+
+    """
+    with session.span("make_req", trgt=trgt):
+        if cache_graph:
+            root_req = cached_make_req(trgt, rules, session)
         else:
-            LOG.info(self.recipe)
-            if execute:
-                with backup(self.trgt, append="~pymake-backup", prepend=".",
-                            on_fail=os.remove):
-                    proc = subprocess.Popen(self.recipe, shell=True,
-                                            stdout=subprocess.PIPE,
-                                            stderr=subprocess.STDOUT,
-                                            bufsize=4096)
-                    for encoded_line in proc.stdout:
-                        line = encoded_line.decode()
-                        if print_out:
-                            LOG.info(line.rstrip("\n"))
-                    if proc.wait() != 0:
-                        self.err_event.set()
-                        raise subprocess.CalledProcessError(proc.returncode,
-                                                            self.recipe)
+            root_req = make_req(trgt, rules, session)
+    with session.span("prefetch"):
+        session.prefetch(root_req)
+    with session.span("check_uptodate"):
+        root_req.check_uptodate()
+    return root_req
 
 
-class DummyReq(HierReq):
-    """Subclass of HierReq for a requirement which has preqs, but no recipe.
+def make(trgt, rules, env={}, session=None, use_hash=False,
+         cache_graph=False, history=True, state_dir=STATE_DIR, watch=False,
+         trace=None, cache=None, pipeline=False, shard=None, **kwargs):
+    """Construct the dependency graph rooted at trgt and run it.
+
+    *session* - [optional] the BuildSession to build in (DEFAULT: a new
+                BuildSession made with *use_hash*, *history* and
+                *state_dir*, which is closed afterwards)
+    *use_hash* - decide what is up-to-date by comparing contents and
+                 recipes with those recorded in *state_dir*, rather than by
+                 modification times
+    *cache_graph* - save the dependency graph in *state_dir* and reuse it
+                    while *trgt*, *rules* and *env* are unchanged
+    *history* - record task durations in *state_dir* and run the tasks on
+                the longest paths first
+    *watch* - keep the graph and run it again whenever files in it change,
+              until interrupted; see watch_graph()
+    *trace* - [optional] write a Chrome trace of the build to this file
+    *cache* - [optional] an ArtifactCache or RemoteCache to restore
+              outputs from and store them in
+    *pipeline* - start running tasks while the graph is still being made;
+                 see run_pipelined().  Ignored with *cache_graph*, *watch*
+                 or *shard*, which need the whole graph first.
+    *shard* - [optional] an (index, count) pair, counting from 1; only
+              build this shard of the graph (see shard_graph()), taking
+              locks in *state_dir* to share tasks with the other shards.
+              Cannot be combined with *watch*.
+    *kwargs* are passed to the run() method of the root requirement (or
+    to watch_graph()); e.g. *jobs*=N runs at most N recipes at once and
+    *engine*="asyncio" runs them on an event loop.  Returns True if
+    everything finished without errors.  Raises ValueError, before any
+    work is done, if a template of a rule has a field which is in
+    neither the env of the rule nor *env*.
 
     """
+    if watch and shard is not None:
+        raise ValueError("a shard of a build cannot be watched")
+    for rule in rules:
+        rule.update_env(env)
+        rule.check()
+    own_session = session is None
+    if own_session:
+        session = BuildSession(state_dir, use_hash=use_hash,
+                               history=history, trace=trace is not None,
+                               cache=cache)
+    else:
+        if trace is not None and session.tracer is None:
+            session.tracer = Tracer()
+        if cache is not None:
+            session.cache = cache
+    try:
+        if pipeline and not (cache_graph or watch or shard):
+            return run_pipelined(trgt, rules, session, **kwargs)
+        root_req = build_graph(trgt, rules, session, cache_graph)
+        if watch:
+            return watch_graph(root_req, **kwargs)
+        elif shard is not None:
+            kwargs['locks'] = ShardLocks(os.path.join(session.state_dir,
+                                                      "locks"))
+            return all(part.run(**kwargs)
+                       for part in shard_graph(root_req, *shard))
+        else:
+            return root_req.run(**kwargs)
+    finally:
+        if trace is not None:
+            session.tracer.save(trace)
+        if own_session:
+            session.close()
+        else:
+            session.flush()
 
-    def last_update(self):
-        return float('nan')
 
-    def do(self, **kwargs):
-        LOG.info("**finished {self.trgt!r}**".format(self=self))
+async def make_async(trgt, rules, env={}, session=None, use_hash=False,
+                     cache_graph=False, history=True, state_dir=STATE_DIR,
+                     trace=None, cache=None, jobs=None, **kwargs):
+    """Like make(), but a coroutine which runs the recipes on the running
+    event loop with an AsyncScheduler.
 
+    Building the graph and other blocking work is done in a thread, so
+    the event loop is never blocked.  Returns True if everything
+    finished without errors.  Raises TypeError if asked to build
+    pipelined, a shard, or in watch mode, which only make() does, or
+    with an *engine* other than "asyncio".
 
-def make(trgt, rules, env={}, **kwargs):
-    """Construct the dependency graph rooted at trgt and run it."""
+    """
+    unsupported = [name for name in ("pipeline", "shard", "watch")
+                   if kwargs.get(name)]
+    if kwargs.pop('engine', "asyncio") != "asyncio":
+        unsupported.append("engine")
+    if unsupported:
+        raise TypeError("make_async() does not support {}".\
+                        format(", ".join(unsupported)))
     for rule in rules:
         rule.update_env(env)
-    root_req = make_req(trgt, rules)
-    root_req.check_uptodate()
-    root_req.run(**kwargs)
+        rule.check()
+    own_session = session is None
+    if own_session:
+        session = await asyncio.to_thread(BuildSession, state_dir,
+                                          use_hash=use_hash, history=history,
+                                          trace=trace is not None,
+                                          cache=cache)
+    else:
+        if trace is not None and session.tracer is None:
+            session.tracer = Tracer()
+        if cache is not None:
+            session.cache = cache
+    try:
+        root_req = await asyncio.to_thread(build_graph, trgt, rules,
+                                           session, cache_graph)
+        scheduler = AsyncScheduler(jobs=jobs, **kwargs)
+        return await scheduler.run_async(root_req)
+    finally:
+        if trace is not None:
+            await asyncio.to_thread(session.tracer.save, trace)
+        if own_session:
+            await asyncio.to_thread(session.close)
+        else:
+            await asyncio.to_thread(session.flush)
+
 
 def make_multi(trgts, rules, env={}, **kwargs):
     """Make a temporary rule which covers all targets and run it.
 
     Because of this method, having a target of the same name will
-    interfere with constructing multiple targets
+    interfere with constructing multiple targets.  Returns True if
+    everything finished without errors.
 
     """
     tmp_rule_trgt = r"all targets"
     tmp_rule = Rule(tmp_rule_trgt, trgts)
-    rules += [tmp_rule]
-    make(tmp_rule_trgt, rules, env, **kwargs)
+    rules = list(rules) + [tmp_rule]
+    return make(tmp_rule_trgt, rules, env, **kwargs)
 
 
 def maker(rules):
@@ -528,18 +4903,137 @@ def maker(rules):
                       help=("print recipes. "
                             "Increment the logging level by 1. "
                             "DEFAULT: verbosity level 1 ('INFO')"))
-    parser.add_option("-O", "--no-stdout", dest="print_out",
-                      action="store_false", default=True,
-                      help=("don't print stdout and stderr from processes. "
+    parser.add_option("-O", "--no-stdout", dest="output",
+                      action="store_const", const="none",
+                      help=("don't read stdout and stderr from processes "
+                            "(same as '--output none'). "
                             "DEFAULT: print"))
+    parser.add_option("--output", dest="output", default="stream",
+                      type="choice", choices=OUTPUT_MODES, metavar="MODE",
+                      help=("handle the stdout and stderr from processes "
+                            "by MODE: 'stream' each line as it comes, "
+                            "'buffer' it and print it all when the recipe "
+                            "finishes, write it straight to a 'log' file "
+                            "per target, or 'none'. "
+                            "DEFAULT: stream"))
+    parser.add_option("--log-dir", dest="log_dir", default=LOG_DIR,
+                      metavar="DIR",
+                      help=("write the log files in DIR. "
+                            "DEFAULT: '{}'").format(LOG_DIR))
     parser.add_option("-n", "--dry", action="store_false",
                       dest="execute", default=True,
                       help=("Dry run.  Don't execute the recipes. "
                             "DEFAULT: execute recipes"))
+    parser.add_option("-j", "--jobs", dest="jobs", type="int",
+                      default=None, metavar="N",
+                      help=("execute at most N recipes at once. "
+                            "DEFAULT: the number of CPUs, or of worker "
+                            "slots with '--coordinate'"))
+    parser.add_option("--cpus", dest="cpus", type="int", default=None,
+                      metavar="N",
+                      help=("run recipes while the threads declared by "
+                            "their rules add up to at most N. "
+                            "DEFAULT: the number of jobs"))
+    parser.add_option("--mem", dest="mem", default=None, metavar="SIZE",
+                      help=("run recipes while the memory declared by "
+                            "their rules adds up to at most SIZE (e.g. "
+                            "'64G'; plain numbers are megabytes). "
+                            "DEFAULT: the physical memory"))
+    parser.add_option("-l", "--load-average", dest="load", type="float",
+                      default=None, metavar="LOAD",
+                      help=("don't start recipes while others are running "
+                            "and the load average is at least LOAD. "
+                            "DEFAULT: no limit"))
+    parser.add_option("--cache", dest="cache_dir", default=None,
+                      metavar="DIR",
+                      help=("restore outputs from the cache in DIR (e.g. "
+                            "'{}'), or served at an http:// URL by "
+                            "pymake-cache-server, rather than running "
+                            "recipes whose recipe and inputs are "
+                            "unchanged, and store new outputs there. "
+                            "DEFAULT: no cache").format(CACHE_DIR))
+    parser.add_option("--cache-size", dest="cache_size", default="10G",
+                      metavar="SIZE",
+                      help=("evict the least recently used outputs to keep "
+                            "the cache within SIZE. "
+                            "DEFAULT: %default"))
+    parser.add_option("--cache-link", dest="cache_link",
+                      action="store_true", default=False,
+                      help=("restore outputs as hard links when they "
+                            "cannot be cloned; targets must then never be "
+                            "modified in place. "
+                            "DEFAULT: copy"))
+    parser.add_option("--cache-stats", dest="cache_stats",
+                      action="store_true", default=False,
+                      help=("log a summary of the cache after the "
+                            "build. "
+                            "DEFAULT: False"))
+    parser.add_option("--trace", dest="trace", default=None, metavar="FILE",
+                      help=("write a timeline of the build to FILE, for "
+                            "chrome://tracing or Perfetto. "
+                            "DEFAULT: don't trace"))
+    parser.add_option("--progress", dest="progress",
+                      default=False, action="store_true",
+                      help=("show a status line with the number of tasks "
+                            "done, running and failed, and an ETA. "
+                            "DEFAULT: False"))
+    parser.add_option("--metrics", dest="metrics", default=None,
+                      metavar="FILE",
+                      help=("keep the progress of the build, as JSON, in "
+                            "FILE. DEFAULT: don't"))
+    parser.add_option("-P", "--pipeline", dest="pipeline",
+                      default=False, action="store_true",
+                      help=("start running recipes while the rest of the "
+                            "dependency graph is still being made. "
+                            "DEFAULT: make the whole graph first"))
+    parser.add_option("--engine", dest="engine", default="threads",
+                      type="choice", choices=ENGINES,
+                      help=("run recipes in 'threads' or as coroutines "
+                            "on an 'asyncio' event loop. "
+                            "DEFAULT: threads"))
     parser.add_option("-s", "--series", "--not-parallel",
-                      action="store_false", dest="parallel", default=True,
-                      help=("execute the recipes in series. "
+                      action="store_const", const=1, dest="jobs",
+                      help=("execute the recipes in series; same as '-j 1'. "
                             "DEFAULT: parallel"))
+    parser.add_option("-H", "--hash", dest="use_hash",
+                      default=False, action="store_true",
+                      help=("decide what is up-to-date using file contents "
+                            "and recipes recorded in '{}/' rather than "
+                            "modification times. "
+                            "DEFAULT: modification times").format(STATE_DIR))
+    parser.add_option("-G", "--cache-graph", dest="cache_graph",
+                      default=False, action="store_true",
+                      help=("save the dependency graph in '{}/' and reuse "
+                            "it while the rules are unchanged. "
+                            "DEFAULT: False").format(STATE_DIR))
+    parser.add_option("--no-history", dest="history",
+                      default=True, action="store_false",
+                      help=("don't record how long recipes take in '{}/' "
+                            "or use that to order them. "
+                            "DEFAULT: record").format(STATE_DIR))
+    parser.add_option("-w", "--watch", dest="watch",
+                      default=False, action="store_true",
+                      help=("keep running, and rebuild whenever files in "
+                            "the graph change. DEFAULT: False"))
+    parser.add_option("--poll", dest="poll",
+                      default=False, action="store_true",
+                      help=("in watch mode, poll files for changes instead "
+                            "of using inotify. DEFAULT: False"))
+    parser.add_option("--coordinate", dest="coordinate", default=None,
+                      metavar="ADDRESS",
+                      help=("run the recipes on pymake-worker processes "
+                            "which connect to ADDRESS (HOST:PORT or the "
+                            "path of a Unix socket); assumes a shared "
+                            "filesystem. DEFAULT: run recipes locally"))
+    parser.add_option("--shell-pool", dest="shell_pool",
+                      default=False, action="store_true",
+                      help=("run the recipes on a pool of persistent "
+                            "shells, rather than starting a shell for "
+                            "each. DEFAULT: False"))
+    parser.add_option("--shard", dest="shard", default=None, metavar="I/N",
+                      help=("build only shard I of N, splitting the graph "
+                            "with N-1 other pymake runs sharing this "
+                            "directory. DEFAULT: build everything"))
     parser.add_option("-V", "--var", "--additional-var", dest="env_items",
                       default=[], action="append",
                       nargs=2, metavar="[KEY] [VALUE]",
@@ -553,6 +5047,8 @@ def maker(rules):
                       help=("display full debug messages with headers. "
                             "DEFAULT: False"))
     opts, args = parser.parse_args()
+    if opts.jobs is not None and opts.jobs < 1:
+        parser.error("-j needs at least 1 job, not {}".format(opts.jobs))
 
     if opts.debug:
         logging.basicConfig(level=logging.DEBUG, format=("(%(threadName)s:"
@@ -567,18 +5063,87 @@ def maker(rules):
                             format="%(message)s")
 
     make_opts = dict(env=dict(opts.env_items), execute=opts.execute,
-                     parallel=opts.parallel, print_out=opts.print_out)
-    if len(args) == 1:
-        target = args[0]
-        make(target, rules, **make_opts)
-    elif len(args) == 0:
-        target = rules[0].trgt_pattern
-        make(target, rules, **make_opts)
-    else:
-        make_multi(args, rules, **make_opts)
+                     jobs=opts.jobs, output=opts.output,
+                     log_dir=opts.log_dir,
+                     use_hash=opts.use_hash, cache_graph=opts.cache_graph,
+                     history=opts.history, cpus=opts.cpus, mem=opts.mem,
+                     load=opts.load, engine=opts.engine,
+                     trace=opts.trace, pipeline=opts.pipeline)
+    if opts.watch:
+        make_opts.update(watch=True, poll=opts.poll)
+    if opts.progress or opts.metrics is not None:
+        progress = Progress(sys.stderr if opts.progress else None,
+                            opts.metrics)
+        make_opts['progress'] = progress
+        if opts.progress:
+            for handler in logging.getLogger().handlers:
+                handler.addFilter(progress)
+    if opts.shard is not None and opts.watch:
+        parser.error("--shard and --watch cannot be combined")
+    if opts.shard is not None:
+        try:
+            make_opts['shard'] = parse_shard(opts.shard)
+        except ValueError as err:
+            parser.error(str(err))
+    if opts.coordinate and opts.shell_pool:
+        parser.error("--shell-pool and --coordinate cannot be combined")
+    if opts.coordinate:
+        make_opts['runner'] = RemoteRunner(opts.coordinate)
+    elif opts.shell_pool:
+        make_opts['runner'] = ShellPoolRunner(opts.jobs)
+    if opts.cache_dir is not None and \
+            opts.cache_dir.startswith(("http://", "https://")):
+        make_opts['cache'] = RemoteCache(opts.cache_dir)
+    elif opts.cache_dir is not None:
+        make_opts['cache'] = ArtifactCache(opts.cache_dir,
+                                           max_size=opts.cache_size,
+                                           link=opts.cache_link)
+    elif opts.cache_stats:
+        parser.error("--cache-stats needs --cache")
+    try:
+        if len(args) == 1:
+            target = args[0]
+            ok = make(target, rules, **make_opts)
+        elif len(args) == 0:
+            target = rules[0].trgt_pattern
+            ok = make(target, rules, **make_opts)
+        else:
+            ok = make_multi(args, rules, **make_opts)
+    finally:
+        if 'runner' in make_opts:
+            make_opts['runner'].close()
+        if opts.cache_dir is not None:
+            if opts.cache_stats:
+                LOG.info(make_opts['cache'].summary())
+            make_opts['cache'].close()
+    if not ok:
+        sys.exit(1)
+
 
+def test(cases=10):
+    """Run the doctests and the checks in tests/pymake_checks.py on the
+    cases of *cases* seeds each, then a small build in a temporary
+    directory.
 
-def test():
+    The checks are only run when pymake is run from the repository, where
+    they can be found.  Returns True if the doctests and checks passed.
+
+    """
+    import doctest
+    ok = doctest.testmod(sys.modules[__name__]).failed == 0
+    tests_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             os.pardir, "tests")
+    sys.path.insert(0, tests_dir)
+    try:
+        import pymake_checks
+    except ImportError:
+        LOG.warning("no checks found in {}; only running the doctests".\
+                    format(tests_dir))
+    else:
+        ok = pymake_checks.run_checks(pymake_checks.CHECKS,
+                                      range(cases)) == 0 and ok
+    finally:
+        sys.path.remove(tests_dir)
     logging.basicConfig(level=logging.DEBUG,
                         format=("(%(threadName)s):"
                                 "%(levelname)s\t"
@@ -590,10 +5155,17 @@ def test():
                   "cat required_to_make.txt > to_make.txt"),
              Rule("required_to_make.txt", [],
                   "echo 'this is a msg' > required_to_make.txt")]
-    requirement = make_req("all", rules)
-    requirement.check_uptodate()
-    requirement.run(execute=True)
-    pass  # Breakpoint
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pymake-test-") as directory:
+        os.chdir(directory)
+        try:
+            requirement = make_req("all", rules)
+            requirement.check_uptodate()
+            requirement.run(execute=True)
+        finally:
+            os.chdir(start_dir)
+    return ok
+
 
 if __name__ == '__main__':
-    test()
+    sys.exit(0 if test() else 1)
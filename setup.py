@@ -8,4 +8,5 @@ setup(name='pymake',
       author='Byron J Smith',
       author_email='bsmith89@gmail.com',
       py_modules=['pymake'],
+      scripts=['scripts/pymake-worker', 'scripts/pymake-cache-server'],
       package_dir = {'': 'lib'})
@@ -0,0 +1,472 @@
+"""Check on random rule sets that two ways of building agree.
+
+pymake.test() runs these checks with the doctests when it is run from the
+repository.  They can also be run alone, with more cases and with the
+pymake under test on the path, e.g.
+
+PYTHONPATH=lib python tests/pymake_checks.py -n 150
+
+Each check handles the cases made from a range of seeds in two ways, in
+temporary directories, and reports every case where they differ:
+
+"pipelined" - building phased and pipelined, with each engine, by
+              modification times and by contents
+"recursive" - making and checking the graph as make_req() and
+              check_uptodate() do, and as their recursive versions did
+"jobs" - running independent tasks, which each wait until all have
+         started, under -j as many as there are tasks
+"roots" - building a file which exists and has no rule, phased,
+          pipelined and as the only shard
+
+The exit status is 1 if any case differed.  A failing case can be run
+again alone with --seed.
+
+"""
+
+import os
+import sys
+import json
+import math
+import random
+import logging
+import optparse
+import itertools
+import tempfile
+import collections
+
+import pymake
+
+
+LOG = logging.getLogger(pymake.__name__)
+
+
+def pipeline_case(seed):
+    """Return a function making a random rule set, and the files to make
+    before building "n0" with it.
+
+    The files map to their modification times.  Recipes append their
+    target to ../runs.  No file is made for a rule without a recipe.
+
+    """
+    rnd = random.Random(seed)
+    count = rnd.randint(3, 25)
+    specs = []
+    for i in range(count):
+        preqs = ["n{}".format(j) for j in range(i + 1, count)
+                 if rnd.random() < 0.3]
+        preqs += ["src{}".format(rnd.randint(0, 3))
+                  for _ in range(rnd.randint(0, 2))]
+        dummy = i > 0 and rnd.random() < 0.15
+        specs.append((i, preqs, dummy))
+    files = {}
+    start = 1000000
+    for k in range(4):
+        if rnd.random() < 0.9:
+            files["src{}".format(k)] = start + rnd.randint(0, 100)
+    for i, preqs, dummy in specs:
+        if not dummy and rnd.random() < 0.6:
+            files["n{}".format(i)] = start + rnd.randint(0, 100)
+
+    def make_rules():
+        return [pymake.Rule("n{}".format(i), preqs) if dummy else
+                pymake.Rule("n{}".format(i), preqs,
+                            "echo {{trgt}} >> ../runs; echo {} > {{trgt}}".\
+                            format(i))
+                for i, preqs, dummy in specs]
+    return make_rules, files
+
+
+def build(seed, use_hash=False, **kwargs):
+    """Build the pipeline_case() of *seed* in a new directory.
+
+    In content-hash mode the case is built once, some files are changed
+    or removed, and then it is built again.  *kwargs* are passed to
+    make() for the last build.  Returns the sorted targets whose recipes
+    ran, the contents of the files afterwards, and the name of the error
+    raised, if any.
+
+    """
+    make_rules, files = pipeline_case(seed)
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pymake-check-") as directory:
+        os.chdir(directory)
+        try:
+            os.mkdir("w")
+            os.chdir("w")
+            for path, mtime in files.items():
+                with open(path, 'w') as handle:
+                    handle.write(path)
+                os.utime(path, (mtime, mtime))
+            if use_hash:
+                pymake.make("n0", make_rules(), use_hash=True,
+                            output="none", history=False)
+                rnd = random.Random(seed + 1)
+                for path in sorted(os.listdir(".")):
+                    if path.startswith(("src", "n")) and rnd.random() < 0.2:
+                        with open(path, 'a') as handle:
+                            handle.write("x")
+                    elif path.startswith("n") and rnd.random() < 0.1:
+                        os.remove(path)
+                if os.path.exists("../runs"):
+                    os.remove("../runs")
+            error = None
+            try:
+                pymake.make("n0", make_rules(), use_hash=use_hash,
+                            output="none", history=False, **kwargs)
+            except Exception as err:
+                error = type(err).__name__
+            runs = []
+            if os.path.exists("../runs"):
+                with open("../runs") as handle:
+                    runs = sorted(handle.read().split())
+            state = {}
+            for path in sorted(os.listdir(".")):
+                if not path.startswith("."):
+                    with open(path) as handle:
+                        state[path] = handle.read()
+        finally:
+            os.chdir(start_dir)
+    return runs, state, error
+
+
+def check_pipelined(seed):
+    """Yield how a pipelined build of the case for *seed* differs from a
+    phased one, with either engine and in either mode.
+
+    """
+    for use_hash in (False, True):
+        phased = build(seed, use_hash, jobs=3)
+        for engine in pymake.ENGINES:
+            pipelined = build(seed, use_hash, jobs=3, pipeline=True,
+                              engine=engine)
+            if pipelined != phased:
+                yield ("use_hash={} engine={}: phased ran {}, pipelined "
+                       "ran {}").format(use_hash, engine, phased[0],
+                                        pipelined[0])
+
+
+def recursive_case(seed):
+    """Return a random rule set, mixing literal and pattern rules, and the
+    files to make before building "n0" with it.
+
+    The files map to their modification times.
+
+    """
+    rnd = random.Random(seed)
+    suffixes = ["s{}".format(k) for k in range(rnd.randint(1, 4))]
+    count = rnd.randint(2, 10)
+
+    def recipe():
+        return "" if rnd.random() < 0.2 else "touch {trgt}"
+    rules = []
+    for i in range(count):
+        preqs = ["n{}".format(j) for j in range(i + 1, count)
+                 if rnd.random() < 0.3]
+        preqs += ["n{}.{}".format(rnd.randint(0, count - 1),
+                                  rnd.choice(suffixes))
+                  for _ in range(rnd.randint(0, 2))]
+        rules.append(pymake.Rule("n{}".format(i), preqs, recipe()))
+    for suffix in suffixes:
+        preqs = [rnd.choice(["{0}", "{0}." + rnd.choice(suffixes),
+                             "src{}".format(rnd.randint(0, 3))])
+                 for _ in range(rnd.randint(0, 2))]
+        rules.append(pymake.Rule(r"(.*)\.{}".format(suffix), preqs,
+                                 recipe()))
+    rnd.shuffle(rules)
+    names = ["src{}".format(k) for k in range(4)] + \
+            ["n{}".format(i) for i in range(count)] + \
+            ["n{}.{}".format(i, suffix) for i in range(count)
+             for suffix in suffixes]
+    files = {name: 1000000 + rnd.randint(0, 100) for name in names
+             if rnd.random() < 0.5}
+    return rules, files
+
+
+Node = collections.namedtuple("Node", ["kind", "trgt", "recipe", "requires"])
+
+
+def reference_graph(trgt, rules, made):
+    """Return the Node for *trgt* as the recursive make_req() made it.
+
+    *made* maps targets to the Nodes made so far.  As in the recursive
+    version, a target is only registered once its prerequisites are made,
+    so a target met again below itself gets a Node of its own.
+
+    """
+    if trgt in made:
+        return made[trgt]
+    rule, remaining = pymake.extract_rule(trgt, rules)
+    if rule is None:
+        node = Node("file", trgt, None, ())
+    else:
+        requires = tuple(reference_graph(preq, remaining, made)
+                         for preq in rule.get_preqs(trgt))
+        recipe = rule.get_recipe(trgt)
+        node = Node("task" if recipe else "dummy", trgt, recipe or None,
+                    requires)
+    made[trgt] = node
+    return node
+
+
+def reference_check(node, flags):
+    """Return the value of the recursive check_uptodate() for *node*,
+    setting the up-to-date flags, by id(), of the Nodes below it.
+
+    As in the recursive version, a Node is evaluated again from each
+    parent unless it is already flagged up-to-date.
+
+    """
+    exists = os.path.exists(node.trgt)
+    last_update = os.path.getmtime(node.trgt) \
+            if exists and node.kind != "dummy" else float('nan')
+    if node.kind == "file" or flags.get(id(node)):
+        return last_update
+    max_usts = pymake.of_non_nan(max, [reference_check(preq, flags)
+                                       for preq in node.requires])
+    if not exists:
+        flags[id(node)] = False
+        return max_usts
+    elif math.isnan(max_usts):
+        flags[id(node)] = True
+        return last_update
+    elif last_update > max_usts:
+        flags[id(node)] = True
+        return last_update
+    elif last_update <= max_usts:
+        flags[id(node)] = False
+        return max_usts
+    raise ValueError("the up-to-date status of {!r} cannot be determined".\
+                     format(node.trgt))
+
+
+def pair_graphs(root, node):
+    """Return (req, Node) pairs matching the graph of *root* with that of
+    *node*, or None if they differ.
+
+    """
+    kinds = {pymake.TaskReq: "task", pymake.DummyReq: "dummy",
+             pymake.FileReq: "file"}
+    paired = {}
+    stack = [(root, node)]
+    while stack:
+        req, node = stack.pop()
+        if id(node) in paired:
+            if paired[id(node)][0] is not req:
+                return None
+            continue
+        paired[id(node)] = (req, node)
+        requires = getattr(req, 'requires', ())
+        if (kinds[type(req)], req.trgt, getattr(req, 'recipe', None),
+                len(requires)) != node[:3] + (len(node.requires),):
+            return None
+        stack.extend(zip(requires, node.requires))
+    if len({id(req) for req, _ in paired.values()}) != len(paired):
+        return None
+    return list(paired.values())
+
+
+def check_recursive(seed):
+    """Yield how the graph made by make_req() for the case of *seed*, or
+    its up-to-date flags, differ from those of the recursive versions.
+
+    """
+    rules, files = recursive_case(seed)
+    start_dir = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="pymake-check-") as directory:
+        os.chdir(directory)
+        try:
+            for path, mtime in files.items():
+                with open(path, 'w'):
+                    pass
+                os.utime(path, (mtime, mtime))
+            node = reference_graph("n0", rules, {})
+            root = pymake.make_req("n0", rules)
+            pairs = pair_graphs(root, node)
+            if pairs is None:
+                yield "the graphs differ"
+                return
+            flags = {}
+            try:
+                reference_check(node, flags)
+                expected = None
+            except ValueError:
+                expected = "ValueError"
+            try:
+                root.check_uptodate()
+                error = None
+            except ValueError:
+                error = "ValueError"
+            if error != expected:
+                yield "the recursive check raised {}, the iterative {}".\
+                      format(expected, error)
+                return
+            if error is None:
+                for req, node in pairs:
+                    if isinstance(req, pymake.HierReq) and \
+                            req.uptodate != flags.get(id(node), False):
+                        yield "{!r} is flagged {}, recursively {}".\
+                              format(req.trgt, req.uptodate,
+                                     flags.get(id(node), False))
+        finally:
+            os.chdir(start_dir)
+
+
+def most_at_once(spans):
+    """Return the most of the (start, end) *spans* which overlap."""
+    events = sorted([(start, 1) for start, _ in spans] +
+                    [(end, -1) for _, end in spans])
+    most = current = 0
+    for _, change in events:
+        current += change
+        most = max(most, current)
+    return most
+
+
+def check_jobs(seed):
+    """Yield how a build of N independent tasks under -j N fails to run
+    them all at once, with either engine, in either mode, as the only
+    shard, which runs each task in a thread with either engine, and on a
+    pool of N shells.
+
+    The trace of the build must show all N started by the first
+    admission.  Each recipe records when it starts and ends, and waits
+    for up to ten seconds for all N to start, so they all overlap if
+    nothing keeps some of them from running; the wait only bounds how
+    long a failing case takes.  N is 2 to 16, depending on *seed*.
+
+    """
+    count = 2 + seed % 15
+    # A task is only counted once its start time is in the file.
+    recipe = ("date +%s.%N > ../{{trgt}}; mv ../{{trgt}} ../times; i=0; "
+              "while [ $(ls ../times | wc -l) -lt {0} ] && "
+              "[ $i -lt 200 ]; do sleep 0.05; i=$((i+1)); done; "
+              "date +%s.%N >> ../times/{{trgt}}; touch {{trgt}}").\
+             format(count)
+    trgts = ["t{}".format(i) for i in range(count)]
+    start_dir = os.getcwd()
+    for use_hash, shard, pool, engine in itertools.product(
+            (False, True), (None, (1, 1)), (False, True), pymake.ENGINES):
+        runner = pymake.ShellPoolRunner(count) if pool else None
+        rules = [pymake.Rule("all", trgts)] + \
+                [pymake.Rule(trgt, [], recipe) for trgt in trgts]
+        with tempfile.TemporaryDirectory(prefix="pymake-check-") \
+                as directory:
+            os.chdir(directory)
+            try:
+                os.mkdir("times")
+                os.mkdir("w")
+                os.chdir("w")
+                ok = pymake.make("all", rules, use_hash=use_hash,
+                                 output="none", history=False, shard=shard,
+                                 jobs=count, runner=runner, engine=engine,
+                                 trace="../trace.json")
+                with open("../trace.json") as handle:
+                    first = next(event['args']['running'] for event
+                                 in json.load(handle)['traceEvents']
+                                 if event['ph'] == "C")
+                spans = []
+                for trgt in os.listdir("../times"):
+                    with open(os.path.join("../times", trgt)) as handle:
+                        spans.append(tuple(map(float, handle.read().split())))
+            finally:
+                os.chdir(start_dir)
+                if runner is not None:
+                    runner.close()
+        case = "use_hash={} shard={} pool={} engine={}".\
+               format(use_hash, shard, pool, engine)
+        if not ok:
+            yield "{}: the build failed".format(case)
+        elif first != count:
+            yield "{}: {} of {} tasks under -j {} started at first".\
+                  format(case, first, count, count)
+        elif most_at_once(spans) != count:
+            yield "{}: at most {} of {} tasks under -j {} ran at once".\
+                  format(case, most_at_once(spans), count, count)
+
+
+def check_roots(seed):
+    """Yield the ways of building in which make() does not return True for
+    an existing file with no rule, or for a rule needing only that file.
+
+    The file is made by the case of *seed* for check_pipelined().
+
+    """
+    _, files = pipeline_case(seed)
+    path = sorted(files)[0]
+    rules = [pymake.Rule("all", [path])]
+    start_dir = os.getcwd()
+    for trgt, use_hash, engine, how in itertools.product(
+            (path, "all"), (False, True), pymake.ENGINES,
+            ("phased", "pipeline", "shard")):
+        kwargs = dict(pipeline=how == "pipeline",
+                      shard=(1, 1) if how == "shard" else None)
+        with tempfile.TemporaryDirectory(prefix="pymake-check-") \
+                as directory:
+            os.chdir(directory)
+            try:
+                with open(path, 'w') as handle:
+                    handle.write(path)
+                result = pymake.make(trgt, rules, use_hash=use_hash,
+                                     history=False, engine=engine, **kwargs)
+            finally:
+                os.chdir(start_dir)
+        if result is not True:
+            yield ("{} use_hash={} engine={} {}: make() returned {!r}").\
+                  format(trgt, use_hash, engine, how, result)
+
+
+CHECKS = collections.OrderedDict([("pipelined", check_pipelined),
+                                  ("recursive", check_recursive),
+                                  ("jobs", check_jobs),
+                                  ("roots", check_roots)])
+
+
+def run_checks(names, seeds):
+    """Run the CHECKS called *names* on the cases of *seeds*, printing
+    every difference, and return the number of differences.
+
+    """
+    level = LOG.level
+    LOG.setLevel(logging.CRITICAL + 1)
+    failures = 0
+    try:
+        for name in names:
+            for seed in seeds:
+                for difference in CHECKS[name](seed):
+                    failures += 1
+                    print("{} seed {}: {}".format(name, seed, difference))
+            print("{}: {} cases checked".format(name, len(seeds)))
+    finally:
+        LOG.setLevel(level)
+    return failures
+
+
+def main():
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("-c", "--checks", dest="checks",
+                      default=",".join(CHECKS),
+                      help=("comma separated checks to run. "
+                            "DEFAULT: %default"))
+    parser.add_option("-n", "--cases", dest="cases", type="int",
+                      default=100, metavar="N",
+                      help=("check the cases of N seeds. "
+                            "DEFAULT: %default"))
+    parser.add_option("--seed", dest="seed", type="int", default=None,
+                      metavar="SEED",
+                      help=("only check the case of SEED. "
+                            "DEFAULT: seeds 0 to N-1"))
+    opts, args = parser.parse_args()
+    names = opts.checks.split(",")
+    for name in names:
+        if name not in CHECKS:
+            parser.error("unknown check: {}".format(name))
+    seeds = range(opts.cases) if opts.seed is None else [opts.seed]
+    failures = run_checks(names, seeds)
+    if failures:
+        print("{} differences".format(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()